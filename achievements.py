@@ -2,27 +2,34 @@
 import os
 import json
 import sqlite3
-from contextlib import closing
 from datetime import datetime, timezone
 from html import escape
-from typing import Any
+from typing import Any, Sequence
 
 from aiogram import F, Router
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 from aiogram.enums import ContentType
 
+from utils import counters, metrics, storage
+from utils.message_log import message_log
+from utils.achievement_rules import RuleRegistry, load_registry_conn
 from utils.achievements_format import format_achievement_message
+from utils.migrations import Migration, python_migration, run_script
 from utils.sender import send_achievement_award
 
 # =========
 # Конфиг
 # =========
-DB = os.getenv("DB_PATH", "bot.sqlite3")
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "320872593").replace(" ", "").split(",") if x}
 
 router = Router(name="achievements")
 
+ACH_UNLOCKED = metrics.counter("achievements_unlocked_total", "Achievement tiers awarded.")
+ACH_ENGINE_SECONDS = metrics.histogram(
+    "achievement_engine_seconds", "Time to evaluate metric rules for one event.", ("metric",)
+)
+
 METRIC_ALIASES = {
     "voice": "voice",
     "voices": "voice",
@@ -42,18 +49,11 @@ def _canonical_metric(metric: str) -> str:
 # =========
 # DB utils
 # =========
-def _conn():
-    return sqlite3.connect(DB)
-
-def _exec(sql: str, params: tuple = ()):
-    with closing(_conn()) as c:
-        c.execute(sql, params)
-        c.commit()
+async def _exec(sql: str, params: tuple = ()):
+    await storage.execute(sql, params)
 
-def _q(sql: str, params: tuple = ()) -> list[tuple]:
-    with closing(_conn()) as c:
-        cur = c.execute(sql, params)
-        return cur.fetchall()
+async def _q(sql: str, params: tuple = ()) -> list[tuple]:
+    return await storage.fetch(sql, params)
 
 def _now_ts() -> int:
     return int(datetime.now(timezone.utc).timestamp())
@@ -61,17 +61,15 @@ def _now_ts() -> int:
 # =========
 # Init schema + миграции (все таблицы)
 # =========
-def _table_exists(name: str) -> bool:
-    with closing(_conn()) as c:
-        cur = c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (name,))
-        return cur.fetchone() is not None
+async def _table_exists(name: str) -> bool:
+    rows = await _q("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (name,))
+    return bool(rows)
 
-def _table_cols(name: str) -> list[str]:
-    if not _table_exists(name):
+async def _table_cols(name: str) -> list[str]:
+    if not await _table_exists(name):
         return []
-    with closing(_conn()) as c:
-        cur = c.execute(f"PRAGMA table_info({name});")
-        return [r[1] for r in cur.fetchall()]  # name = index 1
+    rows = await _q(f"PRAGMA table_info({name});")
+    return [r[1] for r in rows]  # name = index 1
 
 
 def _table_exists_conn(conn: sqlite3.Connection, name: str) -> bool:
@@ -142,117 +140,71 @@ def _truncate_table(conn: sqlite3.Connection, table: str) -> int:
     return cur.rowcount
 
 
-def _get_progress_value_conn(
-    conn: sqlite3.Connection,
-    chat_id: int,
-    user_id: int,
-    ach_id: int,
-) -> int:
-    cur = conn.execute(
-        "SELECT progress FROM achievement_progress WHERE chat_id=? AND user_id=? AND achievement_id=?;",
-        (chat_id, user_id, ach_id),
-    )
-    row = cur.fetchone()
-    return int(row[0]) if row and row[0] is not None else 0
+async def _get_progress_value(chat_id: int, user_id: int, ach_id: int) -> int:
+    return await counters.achievement_progress.get((chat_id, user_id, ach_id))
 
 
-def _get_progress_value(chat_id: int, user_id: int, ach_id: int) -> int:
-    with closing(_conn()) as conn:
-        return _get_progress_value_conn(conn, chat_id, user_id, ach_id)
-
-
-def _increment_progress(chat_id: int, user_id: int, ach_id: int, delta: int) -> int:
-    if delta <= 0:
-        return _get_progress_value(chat_id, user_id, ach_id)
-    now = _now_ts()
-    with closing(_conn()) as conn:
-        conn.execute("PRAGMA foreign_keys=ON;")
-        conn.execute(
-            """
-            INSERT OR IGNORE INTO achievement_progress(chat_id, user_id, achievement_id, progress, updated_at)
-            VALUES(?,?,?,?,?);
-            """,
-            (chat_id, user_id, ach_id, 0, now),
-        )
-        conn.execute(
-            """
-            UPDATE achievement_progress
-            SET progress = progress + ?, updated_at=?
-            WHERE chat_id=? AND user_id=? AND achievement_id=?;
-            """,
-            (delta, now, chat_id, user_id, ach_id),
-        )
-        conn.commit()
-        return _get_progress_value_conn(conn, chat_id, user_id, ach_id)
-
-
-def _get_user_metric_value(chat_id: int, user_id: int, metric: str) -> int:
-    with closing(_conn()) as conn:
-        cur = conn.execute(
-            "SELECT count FROM user_metrics WHERE chat_id=? AND user_id=? AND metric=?;",
-            (chat_id, user_id, metric),
-        )
-        row = cur.fetchone()
-        return int(row[0]) if row and row[0] is not None else 0
+async def _increment_progress(chat_id: int, user_id: int, ach_id: int, delta: int) -> int:
+    return await counters.achievement_progress.incr((chat_id, user_id, ach_id), delta)
 
 
 async def get_user_metric(chat_id: int, user_id: int, metric: str) -> int:
-    return _get_user_metric_value(chat_id, user_id, metric)
+    return await counters.user_metrics.get((chat_id, user_id, metric))
 
 
 async def inc_user_metric(chat_id: int, user_id: int, metric: str, delta: int = 1) -> int:
-    if delta <= 0:
-        return await get_user_metric(chat_id, user_id, metric)
-    now = _now_ts()
-    with closing(_conn()) as conn:
-        conn.execute("PRAGMA foreign_keys=ON;")
-        conn.execute(
-            """
-            INSERT OR IGNORE INTO user_metrics(chat_id, user_id, metric, count, updated_at)
-            VALUES(?,?,?,?,?);
-            """,
-            (chat_id, user_id, metric, 0, now),
-        )
-        conn.execute(
-            """
-            UPDATE user_metrics
-            SET count = count + ?, updated_at=?
-            WHERE chat_id=? AND user_id=? AND metric=?;
-            """,
-            (delta, now, chat_id, user_id, metric),
+    return await counters.user_metrics.incr((chat_id, user_id, metric), delta)
+
+
+def _forget_cached(
+    *,
+    ach_id: int | None = None,
+    chat_id: int | None = None,
+    user_id: int | None = None,
+    tiers: bool = True,
+) -> None:
+    # ключи прогресса и уровней: (chat_id, user_id, achievement_id)
+    def match(key: tuple) -> bool:
+        return (
+            (chat_id is None or key[0] == chat_id)
+            and (user_id is None or key[1] == user_id)
+            and (ach_id is None or key[2] == ach_id)
         )
-        conn.commit()
-    return _get_user_metric_value(chat_id, user_id, metric)
 
+    counters.achievement_progress.forget(match)
+    if tiers:
+        for key in [k for k in _tier_cache if match(k)]:
+            del _tier_cache[key]
 
-def _fetch_user_profiles(user_ids: set[int]) -> dict[int, tuple[str | None, str | None]]:
-    if not user_ids or not _table_exists("users"):
+
+async def _fetch_user_profiles(user_ids: set[int]) -> dict[int, tuple[str | None, str | None]]:
+    if not user_ids:
         return {}
-    cols = set(_table_cols("users"))
+    cols = set(await _table_cols("users"))
     if "user_id" not in cols:
         return {}
     placeholders = ",".join("?" for _ in user_ids)
     sel_display = "display_name" if "display_name" in cols else "username" if "username" in cols else "NULL"
     sel_username = "username" if "username" in cols else "NULL"
-    rows = _q(
+    rows = await _q(
         f"SELECT user_id, {sel_display}, {sel_username} FROM users WHERE user_id IN ({placeholders});",
         tuple(user_ids),
     )
     return {int(uid): (display_name, username) for uid, display_name, username in rows}
 
 
-def _format_user_mention(user_id: int, profiles: dict[int, tuple[str | None, str | None]] | None = None) -> str:
+async def _format_user_mention(user_id: int, profiles: dict[int, tuple[str | None, str | None]] | None = None) -> str:
     display = None
     username = None
     if profiles and user_id in profiles:
         display, username = profiles[user_id]
-    elif _table_exists("users"):
-        cols = set(_table_cols("users"))
+    else:
+        cols = set(await _table_cols("users"))
         if "user_id" in cols:
             sel_display = "display_name" if "display_name" in cols else "username" if "username" in cols else "NULL"
             sel_username = "username" if "username" in cols else "NULL"
             order = " ORDER BY updated_at DESC" if "updated_at" in cols else ""
-            rows = _q(
+            rows = await _q(
                 f"SELECT {sel_display}, {sel_username} FROM users WHERE user_id=?{order} LIMIT 1;",
                 (user_id,),
             )
@@ -264,439 +216,531 @@ def _format_user_mention(user_id: int, profiles: dict[int, tuple[str | None, str
     return f'<a href="tg://user?id={user_id}">{escape(name)}</a>'
 
 
-def delete_user_achievement(chat_id: int, user_id: int, ach_code: str) -> int:
-    with closing(_conn()) as conn:
-        conn.execute("PRAGMA foreign_keys=ON;")
-        conn.execute("BEGIN")
-        try:
-            ach_row = conn.execute(
-                "SELECT COALESCE(id,rowid) FROM achievements WHERE LOWER(code)=LOWER(?) LIMIT 1;",
-                (ach_code,),
-            ).fetchone()
-            if not ach_row:
-                conn.rollback()
-                return 0
-            ach_id = int(ach_row[0])
-            total = 0
-            total += _delete_optional_records(
-                conn,
-                "user_achievements",
-                {
-                    "chat_id": chat_id,
-                    "user_id": user_id,
-                    "achievement_id": ach_id,
-                    "ach_id": ach_id,
-                    "achievement_code": ach_code,
-                    "ach_code": ach_code,
-                    "code": ach_code,
-                },
-            )
-            total += _remove_progress_records(
-                conn,
-                ach_code=ach_code,
-                ach_id=ach_id,
-                chat_id=chat_id,
-                user_id=user_id,
-            )
-            conn.commit()
-            return total
-        except Exception:
-            conn.rollback()
-            raise
+def _find_achievement_id_conn(conn: sqlite3.Connection, ach_code: str) -> int | None:
+    ach_row = conn.execute(
+        "SELECT COALESCE(id,rowid) FROM achievements WHERE LOWER(code)=LOWER(?) LIMIT 1;",
+        (ach_code,),
+    ).fetchone()
+    return int(ach_row[0]) if ach_row else None
 
 
-def global_reset_achievements() -> dict[str, int]:
-    with closing(_conn()) as conn:
-        conn.execute("PRAGMA foreign_keys=ON;")
-        conn.execute("BEGIN")
-        try:
-            stats: dict[str, int] = {}
-            stats["user_achievements"] = _truncate_table(conn, "user_achievements")
-            stats["achievement_progress"] = _truncate_table(conn, "achievement_progress")
-            for table in (
-                "achievements_progress",
-                "achievements_states",
-                "achievement_states",
-                "achievements_awards",
-            ):
-                stats[table] = _truncate_table(conn, table)
-            stats["achievements"] = _truncate_table(conn, "achievements")
-            conn.commit()
-            return stats
-        except Exception:
-            conn.rollback()
-            raise
+def _delete_user_achievement_conn(conn: sqlite3.Connection, chat_id: int, user_id: int, ach_code: str) -> int:
+    ach_id = _find_achievement_id_conn(conn, ach_code)
+    if ach_id is None:
+        return 0
+    total = 0
+    total += _delete_optional_records(
+        conn,
+        "user_achievements",
+        {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "achievement_id": ach_id,
+            "ach_id": ach_id,
+            "achievement_code": ach_code,
+            "ach_code": ach_code,
+            "code": ach_code,
+        },
+    )
+    total += _remove_progress_records(
+        conn,
+        ach_code=ach_code,
+        ach_id=ach_id,
+        chat_id=chat_id,
+        user_id=user_id,
+    )
+    return total
 
 
-def reset_user_achievement_progress(chat_id: int, user_id: int, ach_code: str) -> int:
-    with closing(_conn()) as conn:
-        conn.execute("PRAGMA foreign_keys=ON;")
-        conn.execute("BEGIN")
-        try:
-            ach_row = conn.execute(
-                "SELECT COALESCE(id,rowid) FROM achievements WHERE LOWER(code)=LOWER(?) LIMIT 1;",
-                (ach_code,),
-            ).fetchone()
-            if not ach_row:
-                conn.rollback()
-                return 0
-            ach_id = int(ach_row[0])
-            removed = _remove_progress_records(
-                conn,
-                ach_code=ach_code,
-                ach_id=ach_id,
-                chat_id=chat_id,
-                user_id=user_id,
-            )
-            conn.commit()
-            return removed
-        except Exception:
-            conn.rollback()
-            raise
+async def delete_user_achievement(chat_id: int, user_id: int, ach_code: str) -> int:
+    ach_id = await storage.read(_find_achievement_id_conn, ach_code)
+    if ach_id is not None:
+        _forget_cached(ach_id=ach_id, chat_id=chat_id, user_id=user_id)
+    return await storage.write(_delete_user_achievement_conn, chat_id, user_id, ach_code)
 
 
-def delete_achievement_globally(ach_code: str) -> int:
-    with closing(_conn()) as conn:
-        conn.execute("PRAGMA foreign_keys=ON;")
-        conn.execute("BEGIN")
-        try:
-            ach_row = conn.execute(
-                "SELECT COALESCE(id,rowid) FROM achievements WHERE LOWER(code)=LOWER(?) LIMIT 1;",
-                (ach_code,),
-            ).fetchone()
-            if not ach_row:
-                conn.rollback()
-                return 0
-            ach_id = int(ach_row[0])
-            total = 0
-            total += _delete_optional_records(
-                conn,
-                "user_achievements",
-                {
-                    "achievement_id": ach_id,
-                    "ach_id": ach_id,
-                    "achievement_code": ach_code,
-                    "ach_code": ach_code,
-                    "code": ach_code,
-                },
-            )
-            total += _remove_progress_records(
-                conn,
-                ach_code=ach_code,
-                ach_id=ach_id,
-                chat_id=None,
-                user_id=None,
-            )
-            total += _delete_optional_records(
-                conn,
-                "achievements",
-                {"id": ach_id, "code": ach_code},
-            )
-            conn.commit()
-            return total
-        except Exception:
-            conn.rollback()
-            raise
+def _global_reset_achievements_conn(conn: sqlite3.Connection) -> dict[str, int]:
+    stats: dict[str, int] = {}
+    stats["user_achievements"] = _truncate_table(conn, "user_achievements")
+    stats["achievement_progress"] = _truncate_table(conn, "achievement_progress")
+    for table in (
+        "achievements_progress",
+        "achievements_states",
+        "achievement_states",
+        "achievements_awards",
+    ):
+        stats[table] = _truncate_table(conn, table)
+    stats["achievements"] = _truncate_table(conn, "achievements")
+    return stats
+
 
-def _rebuild_achievements_if_needed():
-    cols = _table_cols("achievements")
+async def global_reset_achievements() -> dict[str, int]:
+    counters.achievement_progress.clear()
+    _tier_cache.clear()
+    return await storage.write(_global_reset_achievements_conn)
+
+
+def _reset_user_achievement_progress_conn(conn: sqlite3.Connection, chat_id: int, user_id: int, ach_code: str) -> int:
+    ach_id = _find_achievement_id_conn(conn, ach_code)
+    if ach_id is None:
+        return 0
+    return _remove_progress_records(
+        conn,
+        ach_code=ach_code,
+        ach_id=ach_id,
+        chat_id=chat_id,
+        user_id=user_id,
+    )
+
+
+async def reset_user_achievement_progress(chat_id: int, user_id: int, ach_code: str) -> int:
+    ach_id = await storage.read(_find_achievement_id_conn, ach_code)
+    if ach_id is not None:
+        _forget_cached(ach_id=ach_id, chat_id=chat_id, user_id=user_id, tiers=False)
+    return await storage.write(_reset_user_achievement_progress_conn, chat_id, user_id, ach_code)
+
+
+def _delete_achievement_globally_conn(conn: sqlite3.Connection, ach_code: str) -> int:
+    ach_id = _find_achievement_id_conn(conn, ach_code)
+    if ach_id is None:
+        return 0
+    total = 0
+    total += _delete_optional_records(
+        conn,
+        "user_achievements",
+        {
+            "achievement_id": ach_id,
+            "ach_id": ach_id,
+            "achievement_code": ach_code,
+            "ach_code": ach_code,
+            "code": ach_code,
+        },
+    )
+    total += _remove_progress_records(
+        conn,
+        ach_code=ach_code,
+        ach_id=ach_id,
+        chat_id=None,
+        user_id=None,
+    )
+    total += _delete_optional_records(
+        conn,
+        "achievements",
+        {"id": ach_id, "code": ach_code},
+    )
+    return total
+
+
+async def delete_achievement_globally(ach_code: str) -> int:
+    ach_id = await storage.read(_find_achievement_id_conn, ach_code)
+    if ach_id is not None:
+        _forget_cached(ach_id=ach_id)
+    return await storage.write(_delete_achievement_globally_conn, ach_code)
+
+def _rebuild_achievements_if_needed(c: sqlite3.Connection):
+    cols = _table_cols_conn(c, "achievements")
     need_rebuild = ("id" not in cols)
-    with closing(_conn()) as c:
-        if need_rebuild:
-            # создаём новую таблицу со всеми нужными полями
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS achievements_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
-                    title TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    kind TEXT NOT NULL CHECK(kind IN ('single','tiered')),
-                    condition_type TEXT NOT NULL CHECK(condition_type IN ('messages','date','keyword','voice','videonote','sticker')),
-                    metric TEXT NOT NULL,
-                    thresholds TEXT,
-                    target_ts INTEGER,
-                    active INTEGER NOT NULL DEFAULT 1,
-                    extra_json TEXT
-                );
+    if need_rebuild:
+        # создаём новую таблицу со всеми нужными полями
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS achievements_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT UNIQUE NOT NULL,
+                title TEXT NOT NULL,
+                description TEXT NOT NULL,
+                kind TEXT NOT NULL CHECK(kind IN ('single','tiered')),
+                condition_type TEXT NOT NULL CHECK(condition_type IN ('messages','date','keyword','voice','videonote','sticker')),
+                metric TEXT NOT NULL,
+                thresholds TEXT,
+                target_ts INTEGER,
+                active INTEGER NOT NULL DEFAULT 1,
+                extra_json TEXT
+            );
+        """)
+        # безопасный SELECT из старой
+        sel = {
+            "id":       "id" if "id" in cols else "rowid",
+            "code":     "code" if "code" in cols else "NULL",
+            "title":    "title" if "title" in cols else "''",
+            "desc":     "description" if "description" in cols else "''",
+            "kind":     "kind" if "kind" in cols else "'single'",
+            "ctype":    "condition_type" if "condition_type" in cols else "'messages'",
+            "metric":   "metric" if "metric" in cols else "condition_type",
+            "thr":      "thresholds" if "thresholds" in cols else "NULL",
+            "ts":       "target_ts" if "target_ts" in cols else "NULL",
+            "active":   "active" if "active" in cols else "1",
+            "extra":    "extra_json" if "extra_json" in cols else "NULL",
+        }
+        if cols:
+            c.execute(f"""
+                INSERT OR IGNORE INTO achievements_new
+                (id, code, title, description, kind, condition_type, metric, thresholds, target_ts, active, extra_json)
+                SELECT {sel['id']}, {sel['code']}, {sel['title']}, {sel['desc']},
+                       {sel['kind']}, {sel['ctype']}, {sel['metric']}, {sel['thr']}, {sel['ts']}, {sel['active']}, {sel['extra']}
+                FROM achievements;
             """)
-            # безопасный SELECT из старой
-            sel = {
-                "id":       "id" if "id" in cols else "rowid",
-                "code":     "code" if "code" in cols else "NULL",
-                "title":    "title" if "title" in cols else "''",
-                "desc":     "description" if "description" in cols else "''",
-                "kind":     "kind" if "kind" in cols else "'single'",
-                "ctype":    "condition_type" if "condition_type" in cols else "'messages'",
-                "metric":   "metric" if "metric" in cols else "condition_type",
-                "thr":      "thresholds" if "thresholds" in cols else "NULL",
-                "ts":       "target_ts" if "target_ts" in cols else "NULL",
-                "active":   "active" if "active" in cols else "1",
-                "extra":    "extra_json" if "extra_json" in cols else "NULL",
-            }
-            if cols:
-                c.execute(f"""
-                    INSERT OR IGNORE INTO achievements_new
-                    (id, code, title, description, kind, condition_type, metric, thresholds, target_ts, active, extra_json)
-                    SELECT {sel['id']}, {sel['code']}, {sel['title']}, {sel['desc']},
-                           {sel['kind']}, {sel['ctype']}, {sel['metric']}, {sel['thr']}, {sel['ts']}, {sel['active']}, {sel['extra']}
-                    FROM achievements;
-                """)
-                c.execute("DROP TABLE achievements;")
-            c.execute("ALTER TABLE achievements_new RENAME TO achievements;")
-            c.commit()
-        else:
-            # дозаводим недостающие поля через ALTER
-            need = {
-                "condition_type": "ALTER TABLE achievements ADD COLUMN condition_type TEXT",
-                "thresholds":     "ALTER TABLE achievements ADD COLUMN thresholds TEXT",
-                "metric":         "ALTER TABLE achievements ADD COLUMN metric TEXT",
-                "target_ts":      "ALTER TABLE achievements ADD COLUMN target_ts INTEGER",
-                "active":         "ALTER TABLE achievements ADD COLUMN active INTEGER NOT NULL DEFAULT 1",
-                "extra_json":     "ALTER TABLE achievements ADD COLUMN extra_json TEXT",
-            }
-            for col, ddl in need.items():
-                if col not in cols:
-                    try: c.execute(ddl + ";")
-                    except sqlite3.OperationalError: pass
-            if "metric" not in cols:
-                try:
-                    c.execute("UPDATE achievements SET metric=condition_type WHERE metric IS NULL;")
-                except sqlite3.OperationalError:
-                    pass
-            c.commit()
-
-def _rebuild_user_stats_if_needed():
-    cols = _table_cols("user_stats")
+            c.execute("DROP TABLE achievements;")
+        c.execute("ALTER TABLE achievements_new RENAME TO achievements;")
+    else:
+        # дозаводим недостающие поля через ALTER
+        need = {
+            "condition_type": "ALTER TABLE achievements ADD COLUMN condition_type TEXT",
+            "thresholds":     "ALTER TABLE achievements ADD COLUMN thresholds TEXT",
+            "metric":         "ALTER TABLE achievements ADD COLUMN metric TEXT",
+            "target_ts":      "ALTER TABLE achievements ADD COLUMN target_ts INTEGER",
+            "active":         "ALTER TABLE achievements ADD COLUMN active INTEGER NOT NULL DEFAULT 1",
+            "extra_json":     "ALTER TABLE achievements ADD COLUMN extra_json TEXT",
+        }
+        for col, ddl in need.items():
+            if col not in cols:
+                try: c.execute(ddl + ";")
+                except sqlite3.OperationalError: pass
+        if "metric" not in cols:
+            try:
+                c.execute("UPDATE achievements SET metric=condition_type WHERE metric IS NULL;")
+            except sqlite3.OperationalError:
+                pass
+
+def _rebuild_user_stats_if_needed(c: sqlite3.Connection):
+    cols = _table_cols_conn(c, "user_stats")
     # нужная схема: chat_id, user_id, messages_count
     need_rebuild = not cols or any(c not in cols for c in ("chat_id","user_id","messages_count"))
-    with closing(_conn()) as c:
-        if need_rebuild:
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS user_stats_new (
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    messages_count INTEGER NOT NULL DEFAULT 0,
-                    PRIMARY KEY(chat_id, user_id)
-                );
-            """)
-            if cols:
-                # попробуем скопировать, если есть пересекающиеся поля
-                sel_chat = "chat_id" if "chat_id" in cols else "0"
-                sel_user = "user_id" if "user_id" in cols else "user_id" if "id" not in cols else "0"
-                sel_cnt  = "messages_count" if "messages_count" in cols else "0"
-                try:
-                    c.execute(f"""
-                        INSERT OR IGNORE INTO user_stats_new (chat_id, user_id, messages_count)
-                        SELECT {sel_chat}, {sel_user}, {sel_cnt} FROM user_stats;
-                    """)
-                except sqlite3.OperationalError:
-                    pass
-                c.execute("DROP TABLE user_stats;")
-            c.execute("ALTER TABLE user_stats_new RENAME TO user_stats;")
-            c.commit()
-
-def _rebuild_user_achievements_if_needed():
-    cols = _table_cols("user_achievements")
+    if need_rebuild:
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS user_stats_new (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                messages_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY(chat_id, user_id)
+            );
+        """)
+        if cols:
+            # попробуем скопировать, если есть пересекающиеся поля
+            sel_chat = "chat_id" if "chat_id" in cols else "0"
+            sel_user = "user_id" if "user_id" in cols else "user_id" if "id" not in cols else "0"
+            sel_cnt  = "messages_count" if "messages_count" in cols else "0"
+            try:
+                c.execute(f"""
+                    INSERT OR IGNORE INTO user_stats_new (chat_id, user_id, messages_count)
+                    SELECT {sel_chat}, {sel_user}, {sel_cnt} FROM user_stats;
+                """)
+            except sqlite3.OperationalError:
+                pass
+            c.execute("DROP TABLE user_stats;")
+        c.execute("ALTER TABLE user_stats_new RENAME TO user_stats;")
+
+def _rebuild_user_achievements_if_needed(c: sqlite3.Connection):
+    cols = _table_cols_conn(c, "user_achievements")
     # нужная схема: chat_id, user_id, achievement_id, tier, unlocked_at
     need_rebuild = not cols or any(c not in cols for c in ("chat_id","user_id","achievement_id","tier","unlocked_at"))
-    with closing(_conn()) as c:
-        if need_rebuild:
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS user_achievements_new (
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    achievement_id INTEGER NOT NULL,
-                    tier INTEGER NOT NULL DEFAULT 1,
-                    unlocked_at INTEGER NOT NULL,
-                    PRIMARY KEY(chat_id, user_id, achievement_id, tier),
-                    FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
-                );
-            """)
-            if cols:
-                sel_chat = "chat_id" if "chat_id" in cols else "0"
-                sel_user = "user_id" if "user_id" in cols else "user_id" if "id" not in cols else "0"
-                sel_ach  = "achievement_id" if "achievement_id" in cols else "achievement_id" if "ach_id" in cols else "0"
-                sel_tier = "tier" if "tier" in cols else "1"
-                sel_time = "unlocked_at" if "unlocked_at" in cols else "strftime('%s','now')"
-                try:
-                    c.execute(f"""
-                        INSERT OR IGNORE INTO user_achievements_new
-                        (chat_id, user_id, achievement_id, tier, unlocked_at)
-                        SELECT {sel_chat}, {sel_user}, {sel_ach}, {sel_tier}, {sel_time}
-                        FROM user_achievements;
-                    """)
-                except sqlite3.OperationalError:
-                    pass
-                c.execute("DROP TABLE user_achievements;")
-            c.execute("ALTER TABLE user_achievements_new RENAME TO user_achievements;")
-            c.commit()
-
-
-def _rebuild_achievement_progress_if_needed():
-    cols = _table_cols("achievement_progress")
+    if need_rebuild:
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS user_achievements_new (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                achievement_id INTEGER NOT NULL,
+                tier INTEGER NOT NULL DEFAULT 1,
+                unlocked_at INTEGER NOT NULL,
+                PRIMARY KEY(chat_id, user_id, achievement_id, tier),
+                FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
+            );
+        """)
+        if cols:
+            sel_chat = "chat_id" if "chat_id" in cols else "0"
+            sel_user = "user_id" if "user_id" in cols else "user_id" if "id" not in cols else "0"
+            sel_ach  = "achievement_id" if "achievement_id" in cols else "achievement_id" if "ach_id" in cols else "0"
+            sel_tier = "tier" if "tier" in cols else "1"
+            sel_time = "unlocked_at" if "unlocked_at" in cols else "strftime('%s','now')"
+            try:
+                c.execute(f"""
+                    INSERT OR IGNORE INTO user_achievements_new
+                    (chat_id, user_id, achievement_id, tier, unlocked_at)
+                    SELECT {sel_chat}, {sel_user}, {sel_ach}, {sel_tier}, {sel_time}
+                    FROM user_achievements;
+                """)
+            except sqlite3.OperationalError:
+                pass
+            c.execute("DROP TABLE user_achievements;")
+        c.execute("ALTER TABLE user_achievements_new RENAME TO user_achievements;")
+
+
+def _rebuild_achievement_progress_if_needed(c: sqlite3.Connection):
+    cols = _table_cols_conn(c, "achievement_progress")
     need_rebuild = not cols or any(
         c not in cols for c in ("chat_id", "user_id", "achievement_id", "progress", "updated_at")
     )
-    with closing(_conn()) as c:
-        if need_rebuild:
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS achievement_progress_new (
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    achievement_id INTEGER NOT NULL,
-                    progress INTEGER NOT NULL DEFAULT 0,
-                    updated_at INTEGER NOT NULL,
-                    PRIMARY KEY(chat_id, user_id, achievement_id),
-                    FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
-                );
-                """
-            )
-            if cols:
-                available = set(cols)
-                try:
-                    select_cols = []
-                    for col in ("chat_id", "user_id", "achievement_id", "progress", "updated_at"):
-                        if col in available:
-                            select_cols.append(col)
-                        elif col == "updated_at":
-                            select_cols.append("strftime('%s','now')")
-                        else:
-                            select_cols.append("0")
-                    c.execute(
-                        """
-                        INSERT OR IGNORE INTO achievement_progress_new
-                        (chat_id, user_id, achievement_id, progress, updated_at)
-                        SELECT {chat_id}, {user_id}, {achievement_id}, {progress}, {updated_at}
-                        FROM achievement_progress;
-                        """.format(
-                            chat_id=select_cols[0],
-                            user_id=select_cols[1],
-                            achievement_id=select_cols[2],
-                            progress=select_cols[3],
-                            updated_at=select_cols[4],
-                        )
+    if need_rebuild:
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS achievement_progress_new (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                achievement_id INTEGER NOT NULL,
+                progress INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY(chat_id, user_id, achievement_id),
+                FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
+            );
+            """
+        )
+        if cols:
+            available = set(cols)
+            try:
+                select_cols = []
+                for col in ("chat_id", "user_id", "achievement_id", "progress", "updated_at"):
+                    if col in available:
+                        select_cols.append(col)
+                    elif col == "updated_at":
+                        select_cols.append("strftime('%s','now')")
+                    else:
+                        select_cols.append("0")
+                c.execute(
+                    """
+                    INSERT OR IGNORE INTO achievement_progress_new
+                    (chat_id, user_id, achievement_id, progress, updated_at)
+                    SELECT {chat_id}, {user_id}, {achievement_id}, {progress}, {updated_at}
+                    FROM achievement_progress;
+                    """.format(
+                        chat_id=select_cols[0],
+                        user_id=select_cols[1],
+                        achievement_id=select_cols[2],
+                        progress=select_cols[3],
+                        updated_at=select_cols[4],
                     )
-                except sqlite3.OperationalError:
-                    pass
-                c.execute("DROP TABLE achievement_progress;")
-            c.execute("ALTER TABLE achievement_progress_new RENAME TO achievement_progress;")
-            c.commit()
+                )
+            except sqlite3.OperationalError:
+                pass
+            c.execute("DROP TABLE achievement_progress;")
+        c.execute("ALTER TABLE achievement_progress_new RENAME TO achievement_progress;")
 
 
-def _rebuild_user_metrics_if_needed():
-    cols = _table_cols("user_metrics")
+def _rebuild_user_metrics_if_needed(c: sqlite3.Connection):
+    cols = _table_cols_conn(c, "user_metrics")
     required = {"chat_id", "user_id", "metric", "count", "updated_at"}
     need_rebuild = not cols or not required.issubset(set(cols))
-    with closing(_conn()) as c:
-        if need_rebuild:
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS user_metrics_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    metric TEXT NOT NULL,
-                    count INTEGER NOT NULL DEFAULT 0,
-                    updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
-                    UNIQUE(chat_id, user_id, metric)
-                );
-                """
-            )
-            if cols:
-                try:
-                    c.execute(
-                        """
-                        INSERT OR IGNORE INTO user_metrics_new (chat_id, user_id, metric, count, updated_at)
-                        SELECT
-                            COALESCE(chat_id, 0),
-                            COALESCE(user_id, 0),
-                            metric,
-                            COALESCE(count, 0),
-                            COALESCE(updated_at, strftime('%s','now'))
-                        FROM user_metrics;
-                        """
-                    )
-                except sqlite3.OperationalError:
-                    pass
-                c.execute("DROP TABLE user_metrics;")
-            c.execute("ALTER TABLE user_metrics_new RENAME TO user_metrics;")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_user_metrics_metric ON user_metrics(metric);")
-            c.commit()
-        elif cols:
-            c.execute("CREATE INDEX IF NOT EXISTS idx_user_metrics_metric ON user_metrics(metric);")
-            c.commit()
-
-
-def init_db():
-    # базовое создание (если первый запуск)
-    with closing(_conn()) as c:
-        c.execute("PRAGMA journal_mode=WAL;")
-        c.execute("PRAGMA synchronous=NORMAL;")
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS achievements (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT NOT NULL,
-            kind TEXT NOT NULL CHECK(kind IN ('single','tiered')),
-            condition_type TEXT NOT NULL CHECK(condition_type IN ('messages','date','keyword','voice','videonote','sticker')),
-            metric TEXT NOT NULL,
-            thresholds TEXT,
-            target_ts INTEGER,
-            active INTEGER NOT NULL DEFAULT 1,
-            extra_json TEXT
-        );
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS user_stats (
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            messages_count INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY(chat_id, user_id)
-        );
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS user_achievements (
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            achievement_id INTEGER NOT NULL,
-            tier INTEGER NOT NULL DEFAULT 1,
-            unlocked_at INTEGER NOT NULL,
-            PRIMARY KEY(chat_id, user_id, achievement_id, tier),
-            FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
-        );
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS achievement_progress (
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            achievement_id INTEGER NOT NULL,
-            progress INTEGER NOT NULL DEFAULT 0,
-            updated_at INTEGER NOT NULL,
-            PRIMARY KEY(chat_id, user_id, achievement_id),
-            FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
-        );
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS user_metrics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            metric TEXT NOT NULL,
-            count INTEGER NOT NULL DEFAULT 0,
-            updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
-            UNIQUE(chat_id, user_id, metric)
-        );
-        """)
+    if need_rebuild:
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_metrics_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+                UNIQUE(chat_id, user_id, metric)
+            );
+            """
+        )
+        if cols:
+            try:
+                c.execute(
+                    """
+                    INSERT OR IGNORE INTO user_metrics_new (chat_id, user_id, metric, count, updated_at)
+                    SELECT
+                        COALESCE(chat_id, 0),
+                        COALESCE(user_id, 0),
+                        metric,
+                        COALESCE(count, 0),
+                        COALESCE(updated_at, strftime('%s','now'))
+                    FROM user_metrics;
+                    """
+                )
+            except sqlite3.OperationalError:
+                pass
+            c.execute("DROP TABLE user_metrics;")
+        c.execute("ALTER TABLE user_metrics_new RENAME TO user_metrics;")
         c.execute("CREATE INDEX IF NOT EXISTS idx_user_metrics_metric ON user_metrics(metric);")
-        c.commit()
-    # миграции для любых старых схем
-    _rebuild_achievements_if_needed()
-    _rebuild_user_stats_if_needed()
-    _rebuild_user_achievements_if_needed()
-    _rebuild_achievement_progress_if_needed()
-    _rebuild_user_metrics_if_needed()
+    elif cols:
+        c.execute("CREATE INDEX IF NOT EXISTS idx_user_metrics_metric ON user_metrics(metric);")
+
+
+# =========
+# Статистика редкости: участники чата и держатели ачивок
+# =========
+# счётчики ведут триггеры, поэтому они верны при любой записи: лог сообщений,
+# _unlock, удаление ачивок, каскад по FK, глобальный сброс
+_RARITY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_members (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY(chat_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chat_member_counts (
+    chat_id INTEGER PRIMARY KEY,
+    members INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS achievement_holders (
+    chat_id INTEGER NOT NULL,
+    achievement_id INTEGER NOT NULL,
+    holders INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(chat_id, achievement_id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS messages_rarity_ai AFTER INSERT ON messages BEGIN
+    INSERT OR IGNORE INTO chat_members(chat_id, user_id) VALUES (new.chat_id, new.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS chat_members_ai AFTER INSERT ON chat_members BEGIN
+    INSERT INTO chat_member_counts(chat_id, members) VALUES (new.chat_id, 1)
+    ON CONFLICT(chat_id) DO UPDATE SET members=members+1;
+END;
+CREATE TRIGGER IF NOT EXISTS chat_members_ad AFTER DELETE ON chat_members BEGIN
+    UPDATE chat_member_counts SET members=MAX(members-1, 0) WHERE chat_id=old.chat_id;
+END;
+-- держатель — пользователь хотя бы с одним уровнем ачивки
+CREATE TRIGGER IF NOT EXISTS user_achievements_rarity_ai AFTER INSERT ON user_achievements
+WHEN (SELECT COUNT(*) FROM user_achievements
+      WHERE chat_id=new.chat_id AND user_id=new.user_id AND achievement_id=new.achievement_id) = 1
+BEGIN
+    INSERT INTO achievement_holders(chat_id, achievement_id, holders) VALUES (new.chat_id, new.achievement_id, 1)
+    ON CONFLICT(chat_id, achievement_id) DO UPDATE SET holders=holders+1;
+END;
+CREATE TRIGGER IF NOT EXISTS user_achievements_rarity_ad AFTER DELETE ON user_achievements
+WHEN NOT EXISTS (SELECT 1 FROM user_achievements
+                 WHERE chat_id=old.chat_id AND user_id=old.user_id AND achievement_id=old.achievement_id)
+BEGIN
+    UPDATE achievement_holders SET holders=MAX(holders-1, 0)
+    WHERE chat_id=old.chat_id AND achievement_id=old.achievement_id;
+END;
+"""
+
+
+def _rebuild_rarity_conn(conn: sqlite3.Connection) -> dict[str, int]:
+    """Пересчитывает статистику редкости с нуля по messages, user_stats и user_achievements."""
+    conn.execute("DELETE FROM chat_members;")
+    conn.execute("DELETE FROM chat_member_counts;")
+    conn.execute("DELETE FROM achievement_holders;")
+    # счётчики участников заполнит триггер chat_members_ai; user_stats помнит и тех,
+    # чьи сообщения уже ушли в архив (utils.retention)
+    members = conn.execute(
+        "INSERT INTO chat_members(chat_id, user_id) "
+        "SELECT chat_id, user_id FROM messages UNION SELECT chat_id, user_id FROM user_stats;"
+    ).rowcount
+    holders = conn.execute(
+        """
+        INSERT INTO achievement_holders(chat_id, achievement_id, holders)
+        SELECT chat_id, achievement_id, COUNT(DISTINCT user_id)
+        FROM user_achievements
+        GROUP BY chat_id, achievement_id;
+        """
+    ).rowcount
+    return {"chat_members": members, "achievement_holders": holders}
+
+
+def _create_rarity_stats(c: sqlite3.Connection) -> None:
+    run_script(c, _RARITY_SCHEMA)
+    stats = _rebuild_rarity_conn(c)
+    print(f"[ACH] Rarity stats backfilled: {stats}")
+
+
+async def rebuild_rarity_stats() -> dict[str, int]:
+    return await storage.write(_rebuild_rarity_conn)
+
+
+# /ach_progress (в чате) и /ach_globalview (по всем чатам): топ по прогрессу ачивки
+# и выданные уровни конкретной ачивки
+_HOT_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_achievement_progress_chat_rank
+    ON achievement_progress (achievement_id, chat_id, progress DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_achievement_progress_rank
+    ON achievement_progress (achievement_id, progress DESC, user_id, chat_id);
+CREATE INDEX IF NOT EXISTS idx_user_achievements_achievement
+    ON user_achievements (achievement_id, chat_id, user_id, tier);
+"""
+
+def _create_schema(c: sqlite3.Connection) -> None:
+    # базовое создание (если первый запуск)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS achievements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT NOT NULL,
+        kind TEXT NOT NULL CHECK(kind IN ('single','tiered')),
+        condition_type TEXT NOT NULL CHECK(condition_type IN ('messages','date','keyword','voice','videonote','sticker')),
+        metric TEXT NOT NULL,
+        thresholds TEXT,
+        target_ts INTEGER,
+        active INTEGER NOT NULL DEFAULT 1,
+        extra_json TEXT
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        messages_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, user_id)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_achievements (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        achievement_id INTEGER NOT NULL,
+        tier INTEGER NOT NULL DEFAULT 1,
+        unlocked_at INTEGER NOT NULL,
+        PRIMARY KEY(chat_id, user_id, achievement_id, tier),
+        FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS achievement_progress (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        achievement_id INTEGER NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY(chat_id, user_id, achievement_id),
+        FOREIGN KEY(achievement_id) REFERENCES achievements(id) ON DELETE CASCADE
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+        UNIQUE(chat_id, user_id, metric)
+    );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_metrics_metric ON user_metrics(metric);")
+
+
+def _create_hot_indexes(c: sqlite3.Connection) -> None:
+    run_script(c, _HOT_INDEXES)
+
+
+# версии упорядочены вместе с migrations/*.sql (см. bot.init_db);
+# _rebuild_* приводят к актуальной схеме базы старых версий бота
+MIGRATIONS: tuple[Migration, ...] = (
+    python_migration("20241001000100_achievements_schema", _create_schema),
+    python_migration("20241001000200_rebuild_achievements", _rebuild_achievements_if_needed),
+    python_migration("20241001000300_rebuild_user_stats", _rebuild_user_stats_if_needed),
+    python_migration("20241001000400_rebuild_user_achievements", _rebuild_user_achievements_if_needed),
+    python_migration("20241001000500_rebuild_achievement_progress", _rebuild_achievement_progress_if_needed),
+    python_migration("20241001000600_rebuild_user_metrics", _rebuild_user_metrics_if_needed),
+    python_migration("20261016135000_rarity_stats", _create_rarity_stats),
+    python_migration("20261016140100_achievement_hot_indexes", _create_hot_indexes),
+)
+
+# =========
+# Реестр правил (скомпилированные активные ачивки)
+# =========
+_rules: RuleRegistry | None = None
+
+async def reload_rules() -> RuleRegistry:
+    """Перечитывает таблицу achievements и атомарно подменяет реестр."""
+    global _rules
+    _rules = await storage.read(load_registry_conn)
+    return _rules
+
+async def _get_rules() -> RuleRegistry:
+    if _rules is None:
+        return await reload_rules()
+    return _rules
 
 # =========
 # Helpers
@@ -723,9 +767,22 @@ def _pretty_box(text: str) -> str:
     line = "━━━━━━━━━━━━━━━━━━━━━━━━"
     return f"<b>{line}</b>\n{text}\n<b>{line}</b>"
 
-def _calc_rarity(chat_id: int, achievement_id: int) -> float:
-    total = _q("SELECT COUNT(DISTINCT user_id) FROM messages WHERE chat_id=?;", (chat_id,))[0][0] or 0
-    have  = _q("SELECT COUNT(DISTINCT user_id) FROM user_achievements WHERE chat_id=? AND achievement_id=?;", (chat_id, achievement_id))[0][0] or 0
+def _calc_rarity_conn(conn: sqlite3.Connection, chat_id: int, achievement_id: int) -> tuple[int, int]:
+    total = conn.execute("SELECT members FROM chat_member_counts WHERE chat_id=?;", (chat_id,)).fetchone()
+    have = conn.execute(
+        "SELECT holders FROM achievement_holders WHERE chat_id=? AND achievement_id=?;",
+        (chat_id, achievement_id),
+    ).fetchone()
+    return (total[0] if total else 0), (have[0] if have else 0)
+
+async def _calc_rarity(chat_id: int, achievement_id: int) -> float:
+    # счётчик участников растёт триггером на вставку в messages, а сообщение, давшее ачивку,
+    # может ещё лежать в буфере логгера; выдача редкая, так что дождаться записи дёшево
+    await message_log.flushed()
+    # готовые счётчики (см. _RARITY_SCHEMA) вместо COUNT(DISTINCT) по всей истории
+    total, have = await storage.read(_calc_rarity_conn, chat_id, achievement_id)
+    # на всякий случай: держателей не может быть больше, чем участников
+    total = max(total, have)
     if total == 0:
         return 0.0
     got_share = have / total
@@ -751,21 +808,31 @@ async def _announce(
     text = f"{text}\n<i>Редкость:</i> <b>{rarity}%</b>"
     await send_achievement_award(m.bot, m.chat.id, text)
 
-def _user_has_tier(chat_id: int, user_id: int, ach_id: int, tier: int) -> bool:
-    row = _q(
-        "SELECT 1 FROM user_achievements WHERE chat_id=? AND user_id=? AND achievement_id=? AND tier=? LIMIT 1;",
-        (chat_id, user_id, ach_id, tier)
-    )
-    return bool(row)
-
-def _user_max_tier(chat_id: int, user_id: int, ach_id: int) -> int:
-    row = _q(
+# (chat_id, user_id, achievement_id) -> максимальный выданный уровень;
+# порядок ключей — от давно не нужных к недавним, лишнее выбрасываем с начала
+_tier_cache: dict[tuple[int, int, int], int] = {}
+
+def _remember_tier(key: tuple[int, int, int], tier: int) -> int:
+    _tier_cache.pop(key, None)
+    _tier_cache[key] = tier
+    if len(_tier_cache) > counters.MAX_CACHED:
+        del _tier_cache[next(iter(_tier_cache))]
+    return tier
+
+async def _user_max_tier(chat_id: int, user_id: int, ach_id: int) -> int:
+    key = (chat_id, user_id, ach_id)
+    cached = _tier_cache.get(key)
+    if cached is not None:
+        return _remember_tier(key, cached)
+    row = await _q(
         "SELECT COALESCE(MAX(tier), 0) FROM user_achievements WHERE chat_id=? AND user_id=? AND achievement_id=?;",
         (chat_id, user_id, ach_id)
     )
-    return int(row[0][0] or 0)
+    loaded = int(row[0][0] or 0)
+    # пока шёл SELECT, _unlock мог записать уровень выше
+    return _remember_tier(key, max(loaded, _tier_cache.get(key, 0)))
 
-def _next_tier_to_award(thresholds: list[int], total: int, current_tier: int) -> int | None:
+def _next_tier_to_award(thresholds: Sequence[int], total: int, current_tier: int) -> int | None:
     """
     Возвращает СЛЕДУЮЩИЙ (ровно +1) уровень, если его порог уже достигнут.
     Если текущий 0 и total >= thresholds[0] -> вернёт 1.
@@ -780,11 +847,19 @@ def _next_tier_to_award(thresholds: list[int], total: int, current_tier: int) ->
         return next_idx
     return None
 
-def _unlock(chat_id: int, user_id: int, ach_id: int, tier: int):
-    _exec(
-        "INSERT INTO user_achievements(chat_id, user_id, achievement_id, tier, unlocked_at) VALUES(?,?,?,?,?)",
+async def _unlock(chat_id: int, user_id: int, ach_id: int, tier: int) -> bool:
+    """Записывает уровень; True — только если строку вставили именно мы.
+    Между проверкой уровня и вставкой есть await, так что параллельное сообщение
+    того же пользователя может успеть раньше — тогда объявлять второй раз нельзя."""
+    key = (chat_id, user_id, ach_id)
+    _remember_tier(key, max(tier, _tier_cache.get(key, 0)))
+    inserted = await storage.execute(
+        "INSERT OR IGNORE INTO user_achievements(chat_id, user_id, achievement_id, tier, unlocked_at) VALUES(?,?,?,?,?)",
         (chat_id, user_id, ach_id, tier, _now_ts())
     )
+    if inserted:
+        ACH_UNLOCKED.inc()
+    return bool(inserted)
 
 
 async def ach_engine_on_metric(
@@ -794,38 +869,37 @@ async def ach_engine_on_metric(
     new_value: int,
     *,
     message: Message | None = None,
+):
+    with ACH_ENGINE_SECONDS.time(metric=metric):
+        await _engine_on_metric(metric, chat_id, user_id, new_value, message=message)
+
+
+async def _engine_on_metric(
+    metric: str,
+    chat_id: int,
+    user_id: int,
+    new_value: int,
+    *,
+    message: Message | None = None,
 ):
     canonical_metric = _canonical_metric(metric)
     if canonical_metric not in SUPPORTED_METRICS:
         return
     if new_value is None or new_value < 0:
         return
-    rows = _q(
-        """
-        SELECT COALESCE(id,rowid) AS id, code, title, description, kind, condition_type, metric, thresholds, extra_json
-        FROM achievements
-        WHERE active=1 AND metric=?;
-        """,
-        (canonical_metric,),
-    )
-    if not rows:
-        return
-    for (aid, code, title, desc, kind, ctype, stored_metric, thresholds_json, extra_json) in rows:
-        thresholds = []
-        if thresholds_json:
-            try:
-                thresholds = sorted({int(v) for v in json.loads(thresholds_json)})
-            except Exception:
-                thresholds = []
+    rules = (await _get_rules()).for_metric(canonical_metric)
+    for rule in rules:
+        thresholds = rule.thresholds
         if not thresholds:
             continue
-        prev_progress = _get_progress_value(chat_id, user_id, aid)
+        aid = rule.id
+        prev_progress = await _get_progress_value(chat_id, user_id, aid)
         delta = int(new_value) - prev_progress
         total = prev_progress
         if delta > 0:
-            total = _increment_progress(chat_id, user_id, aid, delta)
-        curr_tier = _user_max_tier(chat_id, user_id, aid)
-        if kind == "tiered":
+            total = await _increment_progress(chat_id, user_id, aid, delta)
+        curr_tier = await _user_max_tier(chat_id, user_id, aid)
+        if rule.kind == "tiered":
             target_tier = curr_tier
             for idx, threshold in enumerate(thresholds, start=1):
                 if total >= threshold:
@@ -833,31 +907,28 @@ async def ach_engine_on_metric(
                 else:
                     break
             if target_tier > curr_tier:
+                # уровни выдаются строго по порядку, так что всё выше curr_tier ещё не выдано
                 for tier in range(curr_tier + 1, target_tier + 1):
-                    if _user_has_tier(chat_id, user_id, aid, tier):
-                        continue
-                    _unlock(chat_id, user_id, aid, tier)
-                    if message:
-                        rarity = _calc_rarity(chat_id, aid)
+                    if await _unlock(chat_id, user_id, aid, tier) and message:
+                        rarity = await _calc_rarity(chat_id, aid)
                         await _announce(
                             message,
-                            code,
-                            title,
-                            desc,
+                            rule.code,
+                            rule.title,
+                            rule.description,
                             rarity,
                             level=tier,
                         )
         else:
             threshold = thresholds[0]
-            if total >= threshold and not _user_has_tier(chat_id, user_id, aid, 1):
-                _unlock(chat_id, user_id, aid, 1)
-                if message:
+            if total >= threshold and curr_tier < 1:
+                if await _unlock(chat_id, user_id, aid, 1) and message:
                     await _announce(
                         message,
-                        code,
-                        title,
-                        desc,
-                        _calc_rarity(chat_id, aid),
+                        rule.code,
+                        rule.title,
+                        rule.description,
+                        await _calc_rarity(chat_id, aid),
                     )
 
 
@@ -870,115 +941,94 @@ async def on_text_hook(m: Message):
     Инкремент счётчиков и проверка триггеров.
     ВАЖНО: выдаётся только ОДИН следующий уровень за одно сообщение.
     """
+    with metrics.HANDLER_SECONDS.time(handler="ach_on_text_hook"):
+        await _on_text_hook(m)
+
+
+async def _on_text_hook(m: Message):
     if not m.from_user or m.from_user.is_bot:
         return
     chat_id = m.chat.id
     user_id = m.from_user.id
 
-    # 1) счётчик сообщений
-    _exec("INSERT OR IGNORE INTO user_stats(chat_id, user_id) VALUES(?, ?);", (chat_id, user_id))
-    _exec("UPDATE user_stats SET messages_count=messages_count+1 WHERE chat_id=? AND user_id=?;", (chat_id, user_id))
-    total_messages_row = _q(
-        "SELECT messages_count FROM user_stats WHERE chat_id=? AND user_id=? LIMIT 1;",
-        (chat_id, user_id),
-    )
-    total_messages = int(total_messages_row[0][0]) if total_messages_row else 0
+    # 1) счётчик сообщений (в памяти, в базу уходит пачками)
+    total_messages = await counters.user_stats.incr((chat_id, user_id))
     await ach_engine_on_metric("messages", chat_id, user_id, total_messages, message=m)
 
-    # 2) активные ачивки
-    achs = _q("""
-        SELECT COALESCE(id,rowid) AS id, code, title, description, kind, condition_type, metric, thresholds, target_ts, active, extra_json
-        FROM achievements
-        WHERE active=1 AND condition_type IN ('date','keyword');
-    """)
-    if not achs:
-        return
+    # 2) активные ачивки (date/keyword) — из скомпилированного реестра
+    rules = await _get_rules()
 
-    text = (m.text or m.caption or "")
+    # date (разовая)
+    for rule in rules.for_condition("date"):
+        if not rule.target_ts or _now_ts() < rule.target_ts:
+            continue
+        aid = rule.id
+        if await _user_max_tier(chat_id, user_id, aid) == 0 and await _unlock(chat_id, user_id, aid, 1):
+            await _announce(
+                m,
+                rule.code,
+                rule.title,
+                rule.description,
+                await _calc_rarity(chat_id, aid),
+            )
 
-    for (aid, code, title, desc, kind, ctype, metric, thresholds_json, target_ts, active, extra_json) in achs:
-        # thresholds
-        try:
-            thresholds = sorted(set(map(int, json.loads(thresholds_json)))) if thresholds_json else []
-        except Exception:
-            thresholds = []
+    # keyword: один проход автомата по тексту находит все сработавшие ачивки
+    # (текущий меседж должен содержать ключевое слово, чтобы не выдавать «вхолостую»)
+    hits = rules.keywords.counts(m.text or m.caption or "")
+    for aid, occurrences in sorted(hits.items()):
+        rule = rules.by_id[aid]
+        thresholds = rule.thresholds
 
         # --- SINGLE-STEP режим: выдаём ровно один следующий уровень ---
-        curr_tier = _user_max_tier(chat_id, user_id, aid)
-
-        # messages
-        # date (разовая)
-        if ctype == "date" and target_ts:
-            if curr_tier == 0 and _now_ts() >= int(target_ts):
-                _unlock(chat_id, user_id, aid, 1)
-                await _announce(
-                    m,
-                    code,
-                    title,
-                    desc,
-                    _calc_rarity(chat_id, aid),
-                )
-
-        # keyword
-        elif ctype == "keyword":
-            kw = None
-            try:
-                kw = json.loads(extra_json).get("keyword") if extra_json else None
-            except Exception:
-                kw = None
-            if not kw:
-                continue
-
-            # текущий меседж должен содержать ключевое слово (чтобы не выдавать «вхолостую»)
-            contains_now = kw.lower() in (text or "").lower()
-            if not contains_now:
-                continue
-
-            # «прогресс» — число сообщений пользователя с ключевым словом
-            total = _increment_progress(chat_id, user_id, aid, 1)
-
-            next_tier = _next_tier_to_award(thresholds, total, curr_tier) if kind == "tiered" else (1 if thresholds and total >= thresholds[0] and curr_tier == 0 else None)
-            if next_tier:
-                _unlock(chat_id, user_id, aid, next_tier)
-                rarity = _calc_rarity(chat_id, aid)
-                level = next_tier if kind == "tiered" else None
-                await _announce(
-                    m,
-                    code,
-                    title,
-                    desc,
-                    rarity,
-                    level=level,
-                )
+        curr_tier = await _user_max_tier(chat_id, user_id, aid)
+        # «прогресс» — число сообщений (или вхождений, если count_all) с ключевым словом
+        total = await _increment_progress(chat_id, user_id, aid, occurrences if rule.count_all else 1)
+
+        next_tier = _next_tier_to_award(thresholds, total, curr_tier) if rule.kind == "tiered" else (1 if thresholds and total >= thresholds[0] and curr_tier == 0 else None)
+        # повторная выдача тем же уровнем (параллельное сообщение успело раньше) не объявляется
+        if next_tier and await _unlock(chat_id, user_id, aid, next_tier):
+            rarity = await _calc_rarity(chat_id, aid)
+            level = next_tier if rule.kind == "tiered" else None
+            await _announce(
+                m,
+                rule.code,
+                rule.title,
+                rule.description,
+                rarity,
+                level=level,
+            )
 
 
 @router.message(F.content_type == ContentType.VOICE)
 async def on_voice(m: Message):
     if not m.from_user or m.from_user.is_bot:
         return
-    new_val = await inc_user_metric(m.chat.id, m.from_user.id, "voice", 1)
-    await ach_engine_on_metric("voice", m.chat.id, m.from_user.id, new_val, message=m)
+    with metrics.HANDLER_SECONDS.time(handler="on_voice"):
+        new_val = await inc_user_metric(m.chat.id, m.from_user.id, "voice", 1)
+        await ach_engine_on_metric("voice", m.chat.id, m.from_user.id, new_val, message=m)
 
 
 @router.message(F.content_type == ContentType.VIDEO_NOTE)
 async def on_videonote(m: Message):
     if not m.from_user or m.from_user.is_bot:
         return
-    new_val = await inc_user_metric(m.chat.id, m.from_user.id, "videonote", 1)
-    await ach_engine_on_metric("videonote", m.chat.id, m.from_user.id, new_val, message=m)
+    with metrics.HANDLER_SECONDS.time(handler="on_videonote"):
+        new_val = await inc_user_metric(m.chat.id, m.from_user.id, "videonote", 1)
+        await ach_engine_on_metric("videonote", m.chat.id, m.from_user.id, new_val, message=m)
 
 
 @router.message(F.content_type == ContentType.STICKER)
 async def on_sticker(m: Message):
     if not m.from_user or m.from_user.is_bot:
         return
-    new_val = await inc_user_metric(m.chat.id, m.from_user.id, "sticker", 1)
-    await ach_engine_on_metric("sticker", m.chat.id, m.from_user.id, new_val, message=m)
+    with metrics.HANDLER_SECONDS.time(handler="on_sticker"):
+        new_val = await inc_user_metric(m.chat.id, m.from_user.id, "sticker", 1)
+        await ach_engine_on_metric("sticker", m.chat.id, m.from_user.id, new_val, message=m)
 
 # =========
 # Поиск ачивки
 # =========
-def _find_achievement_by_code_or_id(code_or_id: str) -> tuple | None:
+async def _find_achievement_by_code_or_id(code_or_id: str) -> tuple | None:
     sql = """
         SELECT COALESCE(id,rowid) AS id, code, title, description, kind, condition_type, metric, thresholds, target_ts, active, extra_json
         FROM achievements
@@ -986,9 +1036,9 @@ def _find_achievement_by_code_or_id(code_or_id: str) -> tuple | None:
         LIMIT 1;
     """
     if code_or_id.isdigit():
-        rows = _q(sql.format(where="COALESCE(id,rowid)=?"), (int(code_or_id),))
+        rows = await _q(sql.format(where="COALESCE(id,rowid)=?"), (int(code_or_id),))
     else:
-        rows = _q(sql.format(where="LOWER(code)=LOWER(?)"), (code_or_id,))
+        rows = await _q(sql.format(where="LOWER(code)=LOWER(?)"), (code_or_id,))
     return rows[0] if rows else None
 
 # =========
@@ -1075,13 +1125,14 @@ async def cmd_ach_add(m: Message, command: CommandObject):
         return await m.reply(f"Ошибка параметров: {e}")
 
     try:
-        _exec(
+        await _exec(
             """
             INSERT INTO achievements(code,title,description,kind,condition_type,metric,thresholds,target_ts,active,extra_json)
             VALUES(?,?,?,?,?,?,?,?,?,?);
             """,
             (code, title, desc, kind, cond_type, metric_value, thresholds_json, target_ts, 1, extra_json),
         )
+        await reload_rules()
         await m.reply(f"✅ Ачивка добавлена: <b>{title}</b> (code: <code>{code}</code>)")
     except sqlite3.IntegrityError:
         await m.reply("Ачивка с таким code уже существует.")
@@ -1095,10 +1146,11 @@ async def cmd_ach_del(m: Message, command: CommandObject):
     arg = (command.args or "").strip()
     if not arg:
         return await m.reply("Укажите ID или code: /ach_del MSG100")
-    ach = _find_achievement_by_code_or_id(arg)
+    ach = await _find_achievement_by_code_or_id(arg)
     if not ach:
         return await m.reply("Не найдено.")
-    deleted = delete_achievement_globally(ach[1])
+    deleted = await delete_achievement_globally(ach[1])
+    await reload_rules()
     await m.reply(
         "Удалено." if deleted else "Не найдено данных."
         + (f" Очищено записей: {deleted}." if deleted else "")
@@ -1109,7 +1161,8 @@ async def cmd_ach_del(m: Message, command: CommandObject):
 async def cmd_ach_globalreset(m: Message):
     if not m.from_user or not is_admin(m.from_user.id):
         return await m.reply("Недостаточно прав.")
-    stats = global_reset_achievements()
+    stats = await global_reset_achievements()
+    await reload_rules()
     lines = ["<b>Глобальный сброс выполнен.</b>"]
     label_map = {
         "achievements": "achievements",
@@ -1129,11 +1182,23 @@ async def cmd_ach_globalreset(m: Message):
         parse_mode="HTML",
     )
 
+@router.message(Command("ach_rarity_rebuild"))
+async def cmd_ach_rarity_rebuild(m: Message):
+    if not m.from_user or not is_admin(m.from_user.id):
+        return await m.reply("Недостаточно прав.")
+    stats = await rebuild_rarity_stats()
+    await m.reply(
+        "<b>Статистика редкости пересчитана.</b>\n"
+        f"Участников чатов: {stats['chat_members']}\n"
+        f"Пар чат–ачивка: {stats['achievement_holders']}",
+        parse_mode="HTML",
+    )
+
 @router.message(Command("ach_list"))
 async def cmd_ach_list(m: Message):
     if not m.from_user or not is_admin(m.from_user.id):
         return await m.reply("Недостаточно прав.")
-    rows = _q("""
+    rows = await _q("""
         SELECT COALESCE(id,rowid) AS id, code, title, kind, condition_type, metric, thresholds, target_ts, active, extra_json
         FROM achievements
         ORDER BY id;
@@ -1167,30 +1232,40 @@ async def cmd_ach_edit(m: Message, command: CommandObject):
     if len(args) != 3:
         return await m.reply("Формат: /ach_edit code|field|value")
     code_or_id, field, value = [a.strip() for a in args]
-    ach = _find_achievement_by_code_or_id(code_or_id)
+    ach = await _find_achievement_by_code_or_id(code_or_id)
     if not ach:
         return await m.reply("Ачивка не найдена.")
     rid = ach[0]
     try:
         if field == "title":
-            _exec("UPDATE achievements SET title=? WHERE id=?", (value, rid))
+            await _exec("UPDATE achievements SET title=? WHERE id=?", (value, rid))
         elif field == "description":
-            _exec("UPDATE achievements SET description=? WHERE id=?", (value, rid))
+            await _exec("UPDATE achievements SET description=? WHERE id=?", (value, rid))
         elif field == "thresholds":
             thr = json.dumps(_parse_thresholds(value))
-            _exec("UPDATE achievements SET thresholds=? WHERE id=?", (thr, rid))
+            await _exec("UPDATE achievements SET thresholds=? WHERE id=?", (thr, rid))
         elif field == "target_date":
             y, mo, d = map(int, value.split("-"))
             dt = datetime(y, mo, d, 23, 59, 59, tzinfo=timezone.utc)
-            _exec("UPDATE achievements SET target_ts=? WHERE id=?", (int(dt.timestamp()), rid))
+            await _exec("UPDATE achievements SET target_ts=? WHERE id=?", (int(dt.timestamp()), rid))
         elif field == "kind":
             if value not in ("single", "tiered"):
                 return await m.reply("kind: single|tiered")
-            _exec("UPDATE achievements SET kind=? WHERE id=?", (value, rid))
+            await _exec("UPDATE achievements SET kind=? WHERE id=?", (value, rid))
         elif field == "active":
-            _exec("UPDATE achievements SET active=? WHERE id=?", (int(value), rid))
+            await _exec("UPDATE achievements SET active=? WHERE id=?", (int(value), rid))
+        elif field in ("whole_word", "count_all"):
+            if ach[5] != "keyword":
+                return await m.reply("Поле доступно только для keyword-ачивок.")
+            try:
+                extra = json.loads(ach[10]) if ach[10] else {}
+            except Exception:
+                extra = {}
+            extra[field] = bool(int(value))
+            await _exec("UPDATE achievements SET extra_json=? WHERE id=?", (json.dumps(extra), rid))
         else:
             return await m.reply("Неизвестное поле.")
+        await reload_rules()
         await m.reply("Готово.")
     except Exception as e:
         await m.reply(f"Ошибка: {e}")
@@ -1202,7 +1277,7 @@ async def cmd_ach_progress(m: Message, command: CommandObject):
     code = (command.args or "").strip()
     if not code:
         return await m.reply("Укажите code или id ачивки.")
-    ach = _find_achievement_by_code_or_id(code)
+    ach = await _find_achievement_by_code_or_id(code)
     if not ach:
         return await m.reply("Ачивка не найдена.")
     aid, _, title, _, kind, ctype, metric, thr_json, target_ts, active, extra_json = ach
@@ -1212,9 +1287,10 @@ async def cmd_ach_progress(m: Message, command: CommandObject):
         thresholds = []
 
     lines = [f"<b>Прогресс по</b> «{title}» (metric: <code>{metric}</code>):"]
+    await counters.flush()
 
     if metric in {"messages", "voice", "videonote", "sticker"}:
-        rows = _q(
+        rows = await _q(
             """
             SELECT user_id, progress
             FROM achievement_progress
@@ -1226,16 +1302,16 @@ async def cmd_ach_progress(m: Message, command: CommandObject):
         if not rows:
             lines.append("Данных по прогрессу пока нет.")
         else:
-            profiles = _fetch_user_profiles({int(uid) for uid, _ in rows[:50]})
+            profiles = await _fetch_user_profiles({int(uid) for uid, _ in rows[:50]})
             for uid, progress_val in rows[:50]:
                 uid = int(uid)
-                taken = _q(
+                taken = (await _q(
                     """
                     SELECT MAX(tier) FROM user_achievements
                     WHERE chat_id=? AND user_id=? AND achievement_id=?;
                     """,
                     (m.chat.id, uid, aid),
-                )[0][0] or 0
+                ))[0][0] or 0
                 next_thr = None
                 for idx, threshold in enumerate(sorted(thresholds), start=1):
                     if progress_val < threshold:
@@ -1246,14 +1322,14 @@ async def cmd_ach_progress(m: Message, command: CommandObject):
                     if next_thr is None and thresholds
                     else f"{progress_val} / {next_thr or '-'}"
                 )
-                mention = _format_user_mention(uid, profiles)
+                mention = await _format_user_mention(uid, profiles)
                 lines.append(f"• {mention}: {status}")
     elif ctype == "keyword":
         try:
             kw = json.loads(extra_json).get("keyword") if extra_json else None
         except Exception:
             kw = None
-        rows = _q(
+        rows = await _q(
             """
             SELECT user_id, progress
             FROM achievement_progress
@@ -1264,9 +1340,9 @@ async def cmd_ach_progress(m: Message, command: CommandObject):
         )
         lines.append(f"Тип: keyword, слово: <code>{kw}</code>")
         if rows:
-            profiles = _fetch_user_profiles({int(uid) for uid, _ in rows[:50]})
+            profiles = await _fetch_user_profiles({int(uid) for uid, _ in rows[:50]})
             for uid, progress_val in rows[:50]:
-                mention = _format_user_mention(int(uid), profiles)
+                mention = await _format_user_mention(int(uid), profiles)
                 lines.append(f"• {mention}: {progress_val}")
         else:
             lines.append("Данных по прогрессу пока нет.")
@@ -1279,7 +1355,8 @@ async def cmd_ach_progress(m: Message, command: CommandObject):
 async def cmd_ach_globalview(m: Message):
     if not m.from_user or not is_admin(m.from_user.id):
         return await m.reply("Недостаточно прав.")
-    achs = _q(
+    await counters.flush()
+    achs = await _q(
         """
         SELECT COALESCE(id,rowid) AS id, code, title, kind, condition_type, metric
         FROM achievements
@@ -1294,7 +1371,7 @@ async def cmd_ach_globalview(m: Message):
             f"<b>#{aid}</b> — <b>{escape(title)}</b> (<code>{escape(code)}</code>)",
             f"Тип: {kind}/{ctype}, metric: {metric}",
         ]
-        progress_rows = _q(
+        progress_rows = await _q(
             """
             SELECT chat_id, user_id, progress
             FROM achievement_progress
@@ -1304,7 +1381,7 @@ async def cmd_ach_globalview(m: Message):
             """,
             (aid,),
         )
-        awards_rows = _q(
+        awards_rows = await _q(
             """
             SELECT chat_id, user_id, MAX(tier) AS max_tier
             FROM user_achievements
@@ -1320,13 +1397,13 @@ async def cmd_ach_globalview(m: Message):
             block_lines.append("  • записей не найдено")
         else:
             user_ids = {uid for _, uid in keys}
-            profiles = _fetch_user_profiles(user_ids)
+            profiles = await _fetch_user_profiles(user_ids)
             for chat_user in sorted(
                 keys,
                 key=lambda cu: (-progress_map.get(cu, 0), cu[0], cu[1]),
             ):
                 chat_id, user_id = chat_user
-                mention = _format_user_mention(user_id, profiles)
+                mention = await _format_user_mention(user_id, profiles)
                 progress_val = progress_map.get(chat_user, 0)
                 tier_val = awards_map.get(chat_user)
                 tier_text = f", уровни: {tier_val}" if tier_val else ""
@@ -1351,12 +1428,12 @@ async def cmd_ach_reset(m: Message, command: CommandObject):
     if len(args) < 2:
         return await m.reply("Формат: /ach_reset code @username|user_id")
     code = args[0].strip()
-    ach = _find_achievement_by_code_or_id(code)
+    ach = await _find_achievement_by_code_or_id(code)
     if not ach:
         return await m.reply("Ачивка не найдена.")
     u = args[1].strip()
     if u.startswith("@"):
-        row = _q("SELECT user_id FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1;", (u[1:],))
+        row = await _q("SELECT user_id FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1;", (u[1:],))
         if not row:
             return await m.reply("Пользователь не найден в базе.")
         user_id = row[0][0]
@@ -1365,8 +1442,8 @@ async def cmd_ach_reset(m: Message, command: CommandObject):
             user_id = int(u)
         except Exception:
             return await m.reply("Некорректный user.")
-    progress_removed = reset_user_achievement_progress(m.chat.id, user_id, ach[1])
-    awards_removed = delete_user_achievement(m.chat.id, user_id, ach[1])
+    progress_removed = await reset_user_achievement_progress(m.chat.id, user_id, ach[1])
+    awards_removed = await delete_user_achievement(m.chat.id, user_id, ach[1])
     await m.reply(
         "Сброшено. "
         + f"Удалено наград: {awards_removed}. "
@@ -1380,7 +1457,7 @@ async def cmd_ach_reset(m: Message, command: CommandObject):
 async def cmd_my_achievements(m: Message):
     if not m.from_user:
         return
-    rows = _q("""
+    rows = await _q("""
         SELECT a.title, a.description, a.kind, a.condition_type, ua.tier, ua.unlocked_at
         FROM user_achievements AS ua
         JOIN achievements AS a ON a.id = ua.achievement_id
@@ -1402,7 +1479,7 @@ async def cmd_my_achievements(m: Message):
 
 @router.message(Command("ach_top"))
 async def cmd_ach_top(m: Message):
-    rows = _q("""
+    rows = await _q("""
         SELECT user_id, COUNT(*) AS cnt
         FROM user_achievements
         WHERE chat_id=?
@@ -1413,8 +1490,8 @@ async def cmd_ach_top(m: Message):
     if not rows:
         return await m.reply("Пока никто не получил ачивок.")
     lines = ["<b>Топ по ачивкам</b>:"]
-    profiles = _fetch_user_profiles({uid for uid, _ in rows})
+    profiles = await _fetch_user_profiles({uid for uid, _ in rows})
     for i, (uid, cnt) in enumerate(rows, start=1):
-        mention = _format_user_mention(uid, profiles)
+        mention = await _format_user_mention(uid, profiles)
         lines.append(f"{i}. {mention} — {cnt}")
     await m.reply("\n".join(lines), parse_mode="HTML")
@@ -0,0 +1,333 @@
+"""Synthetic-load benchmark for the message pipeline.
+
+Drives ``bot.on_text`` (which runs ``achievements.on_text_hook``), the
+``on_voice`` / ``on_sticker`` / ``on_videonote`` handlers and the admin report
+commands with synthetic messages against a fake ``Bot`` and a throw-away
+SQLite file, then reports throughput, handler latency percentiles, SQL
+statements and connections per message, and database growth.
+
+    python -m benchmarks.message_pipeline --messages 20000 --chats 4 --users 200
+    python -m benchmarks.message_pipeline --json results/$(git rev-parse --short HEAD).json
+
+The workload is seeded, so runs with the same arguments are comparable across
+commits; ``--json`` writes the numbers together with the git revision.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace as NS
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+BOT_ID = 999_000_001
+ADMIN_ID = 999_000_002
+
+WORDS = (
+    "привет как дела сегодня вчера завтра работа дом кофе чай код релиз баг тест "
+    "встреча обед погода музыка фильм книга идея план вопрос ответ спасибо"
+).split()
+
+
+class SqlStats:
+    """Counts connections opened and top-level statements executed on them."""
+
+    def __init__(self) -> None:
+        self.connections = 0
+        self.statements = 0
+        self._lock = threading.Lock()
+
+    def on_sql(self, sql: str) -> None:
+        # строки триггеров приходят как "-- ..." — считаем только сами запросы
+        if not sql.startswith("--"):
+            with self._lock:
+                self.statements += 1
+
+    def install(self) -> None:
+        real_connect = sqlite3.connect
+
+        def counting_connect(*args, **kwargs):
+            conn = real_connect(*args, **kwargs)
+            with self._lock:
+                self.connections += 1
+            conn.set_trace_callback(self.on_sql)
+            return conn
+
+        sqlite3.connect = counting_connect
+
+    def snapshot(self) -> tuple[int, int]:
+        with self._lock:
+            return self.connections, self.statements
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, text)
+
+
+class FakeMessage:
+    _next_id = 0
+
+    def __init__(self, bot, text=None, *, chat_id=0, user_id=0, kind="text"):
+        FakeMessage._next_id += 1
+        self.message_id = FakeMessage._next_id
+        self.bot = bot
+        self.text = text if kind == "text" else None
+        self.caption = None
+        self.content_type = kind
+        self.chat = NS(id=chat_id, type="supergroup", username=None)
+        self.from_user = NS(
+            id=user_id, is_bot=False, username=f"user{user_id}",
+            full_name=f"User {user_id}", first_name="User",
+        )
+        self.reply_to_message = None
+        self.entities = None
+
+    async def reply(self, text, **kwargs):
+        return await self.bot.send_message(self.chat.id, text)
+
+    async def answer(self, text, **kwargs):
+        return await self.bot.send_message(self.chat.id, text)
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--messages", type=int, default=20000, help="всего входящих сообщений")
+    ap.add_argument("--chats", type=int, default=4)
+    ap.add_argument("--users", type=int, default=200, help="участников на чат")
+    ap.add_argument("--achievements", type=int, default=20, help="активных ачивок по метрикам")
+    ap.add_argument("--keywords", type=int, default=10, help="активных keyword-ачивок")
+    ap.add_argument("--keyword-share", type=float, default=0.1, help="доля сообщений с ключевым словом")
+    ap.add_argument("--media-share", type=float, default=0.1, help="доля голосовых/стикеров/кружков")
+    ap.add_argument("--reports-every", type=int, default=2000, help="прогон отчётных команд каждые N сообщений")
+    ap.add_argument("--concurrency", type=int, default=1, help="сколько апдейтов обрабатывается одновременно")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", help="путь к базе (по умолчанию — временный файл)")
+    ap.add_argument("--json", help="куда записать результаты")
+    return ap.parse_args(argv)
+
+
+async def seed_achievements(storage, achievements, args) -> list[str]:
+    metrics = ("messages", "voice", "sticker", "videonote")
+    codes = []
+    for i in range(args.achievements):
+        metric = metrics[i % len(metrics)]
+        base = 5 + i
+        await storage.execute(
+            "INSERT INTO achievements(code, title, description, kind, condition_type, metric, thresholds, active) "
+            "VALUES(?, ?, ?, 'tiered', ?, ?, ?, 1);",
+            (f"bench_{metric}_{i}", f"{metric} #{i}", "bench", metric, metric, json.dumps([base, base * 10, base * 100])),
+        )
+        codes.append(f"bench_{metric}_{i}")
+    for i in range(args.keywords):
+        await storage.execute(
+            "INSERT INTO achievements(code, title, description, kind, condition_type, metric, thresholds, active, extra_json) "
+            "VALUES(?, ?, ?, 'tiered', 'keyword', 'keyword', ?, 1, ?);",
+            (f"bench_kw_{i}", f"keyword #{i}", "bench", json.dumps([1, 10, 100]), json.dumps({"keyword": f"ключ{i}"})),
+        )
+        codes.append(f"bench_kw_{i}")
+    await achievements.reload_rules()
+    return codes
+
+
+def make_text(rng: random.Random, args) -> str:
+    words = rng.choices(WORDS, k=rng.randint(3, 20))
+    if args.keywords and rng.random() < args.keyword_share:
+        words.insert(rng.randrange(len(words) + 1), f"ключ{rng.randrange(args.keywords)}")
+    return " ".join(words)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import bot
+    import achievements
+    from utils import counters, storage
+    from utils.message_log import message_log
+
+    # LLM в бенчмарке не участвует: реплики без упоминаний, вмешательства выключены
+    async def no_llm(*a, **kw):
+        return ""
+
+    bot.ai_reply = no_llm
+    bot.maybe_interject = no_llm
+    bot.identity._set(BOT_ID, "bench_bot")
+
+    sql = SqlStats()
+    sql.install()
+    bot.init_db()
+    storage.start()
+    message_log.start()
+    counters.start()
+    fake_bot = FakeBot()
+    codes = await seed_achievements(storage, achievements, args)
+    await storage.write(lambda conn: None)
+
+    rng = random.Random(args.seed)
+    chats = [-100_000_000_0000 - i for i in range(args.chats)]
+    media = (
+        ("voice", achievements.on_voice),
+        ("sticker", achievements.on_sticker),
+        ("video_note", achievements.on_videonote),
+    )
+    reports = (
+        ("ach_progress", lambda m: achievements.cmd_ach_progress(m, NS(args=rng.choice(codes)))),
+        ("ach_globalview", achievements.cmd_ach_globalview),
+        ("ach_top", achievements.cmd_ach_top),
+        ("my_achievements", achievements.cmd_my_achievements),
+    )
+    latencies: dict[str, list[float]] = {}
+
+    async def timed(kind: str, handler, message) -> None:
+        start = time.perf_counter()
+        await handler(message)
+        latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    def next_update():
+        chat_id = rng.choice(chats)
+        user_id = 1 + rng.randrange(args.users)
+        if rng.random() < args.media_share:
+            kind, handler = rng.choice(media)
+            return kind, handler, FakeMessage(fake_bot, chat_id=chat_id, user_id=user_id, kind=kind)
+        return "text", bot.on_text, FakeMessage(fake_bot, make_text(rng, args), chat_id=chat_id, user_id=user_id)
+
+    size_before = db_size(args.db)
+    conns_before, stmts_before = sql.snapshot()
+    started = time.perf_counter()
+    done = 0
+    report_seconds = 0.0
+    while done < args.messages:
+        batch = [next_update() for _ in range(min(args.concurrency, args.messages - done))]
+        await asyncio.gather(*(timed(kind, handler, m) for kind, handler, m in batch))
+        before, done = done, done + len(batch)
+        if args.reports_every and done // args.reports_every != before // args.reports_every:
+            report_start = time.perf_counter()
+            for name, handler in reports:
+                m = FakeMessage(fake_bot, f"/{name}", chat_id=rng.choice(chats), user_id=ADMIN_ID)
+                await timed(f"/{name}", handler, m)
+            report_seconds += time.perf_counter() - report_start
+    drive_seconds = time.perf_counter() - started
+    await message_log.flushed()
+    await counters.flush()
+    total_seconds = time.perf_counter() - started
+    conns_after, stmts_after = sql.snapshot()
+
+    stored = await storage.fetchone("SELECT COUNT(*) FROM messages;")
+    awards = fake_bot.sent
+    await message_log.close()
+    await counters.close()
+    await storage.close()
+    size_after = db_size(args.db)
+
+    pipeline_seconds = total_seconds - report_seconds
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "params": {k: v for k, v in vars(args).items() if k not in {"db", "json"}},
+        "messages": done,
+        "stored_messages": stored[0] if stored else 0,
+        "bot_messages_sent": awards,
+        "seconds": round(total_seconds, 3),
+        "drive_seconds": round(drive_seconds, 3),
+        "messages_per_sec": round(done / pipeline_seconds, 1) if pipeline_seconds else None,
+        "latency_ms": {
+            kind: {
+                "count": len(vals),
+                "p50": round(percentile(vals, 50) * 1000, 3),
+                "p95": round(percentile(vals, 95) * 1000, 3),
+                "p99": round(percentile(vals, 99) * 1000, 3),
+                "mean": round(statistics.fmean(vals) * 1000, 3),
+            }
+            for kind, vals in sorted(latencies.items())
+        },
+        "sql_statements_per_message": round((stmts_after - stmts_before) / done, 3) if done else None,
+        "connections_per_message": round((conns_after - conns_before) / done, 5) if done else None,
+        "connections_opened": conns_after - conns_before,
+        "db_bytes_before": size_before,
+        "db_bytes_after": size_after,
+        "db_bytes_per_message": round((size_after - size_before) / done, 1) if done else None,
+    }
+
+
+def print_report(res: dict) -> None:
+    print(f"revision {res['revision'] or '?'} | python {res['python']} | sqlite {res['sqlite']}")
+    print(f"params   {res['params']}")
+    print(
+        f"messages {res['messages']} in {res['seconds']}s -> {res['messages_per_sec']} msg/s "
+        f"(stored {res['stored_messages']}, bot sent {res['bot_messages_sent']})"
+    )
+    print(f"{'handler':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for kind, lat in res["latency_ms"].items():
+        print(f"{kind:<18}{lat['count']:>8}{lat['p50']:>10}{lat['p95']:>10}{lat['p99']:>10}{lat['mean']:>10}")
+    print(
+        f"sql/msg  {res['sql_statements_per_message']} | connections opened {res['connections_opened']} "
+        f"({res['connections_per_message']}/msg)"
+    )
+    print(
+        f"db size  {res['db_bytes_before']} -> {res['db_bytes_after']} bytes "
+        f"({res['db_bytes_per_message']} bytes/msg)"
+    )
+
+
+def main(argv: list[str]) -> int:
+    args = parse_args(argv)
+    tmpdir = None
+    if not args.db:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bench-")
+        args.db = os.path.join(tmpdir.name, "bench.sqlite3")
+    # модули читают конфиг при импорте — окружение готовим до него
+    os.environ["DB_PATH"] = args.db
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ["ADMIN_IDS"] = str(ADMIN_ID)
+    sys.path.insert(0, str(ROOT))
+    try:
+        res = asyncio.run(run(args))
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+    print_report(res)
+    if args.json:
+        pathlib.Path(args.json).parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(args.json).write_text(json.dumps(res, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,24 +2,37 @@ import os
 import asyncio
 import random
 import re
-import sqlite3
-from contextlib import closing, suppress
+from contextlib import suppress
 from datetime import datetime, timezone
 import html as _html
 import pathlib
+import sqlite3
+import time
 
-import aiohttp
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import Command, CommandStart, CommandObject
-from aiogram.types import Message, BotCommand, BotCommandScopeAllGroupChats, BotCommandScopeAllPrivateChats
+from aiogram.types import (
+    Message, CallbackQuery, BotCommand, BotCommandScopeAllGroupChats, BotCommandScopeAllPrivateChats,
+    InlineKeyboardButton, InlineKeyboardMarkup,
+)
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 
 # === achievements module (подключаем БЕЗ изменения вашего кода) ===
-from achievements import router as ach_router, init_db as ach_init_db, on_text_hook as ach_on_text_hook
+from achievements import router as ach_router, MIGRATIONS as ach_migrations, is_admin, on_text_hook as ach_on_text_hook
+from utils import chat_context, counters, llm_jobs, metrics, migrations, profiles, prompt_budget, search, sql_trace, storage, summary_chunks
+from utils.identity import identity
+from utils.llm_cache import CachePolicy, cache_key, llm_cache
+from utils.message_log import message_log
+from utils.openrouter import OpenRouterClient
+from utils.retention import retention
+from utils.streaming import StreamingReply
 from utils.cooldowns import (
-    clear_expired_cooldowns,
+    Bucket,
+    Window,
     is_on_cooldown,
+    load_cooldowns,
+    rate_limits,
     set_cooldown,
 )
 
@@ -31,6 +44,18 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENROUTER_SITE_URL = os.getenv("OPENROUTER_SITE_URL", "https://t.me/lordverbus_bot")
 OPENROUTER_APP_NAME = os.getenv("OPENROUTER_APP_NAME", "Lord Verbus")
 MODEL = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o-mini-2024-07-18")
+# потоковые ответы с постепенной правкой сообщения (0 — ждать ответ целиком)
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") != "0"
+# бюджеты промптов в токенах (оценочно); урезаются до окна контекста модели
+PSYCH_PROMPT_TOKENS = int(os.getenv("PSYCH_PROMPT_TOKENS", "3000"))
+SUMMARY_PROMPT_TOKENS = int(os.getenv("SUMMARY_PROMPT_TOKENS", "12000"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "6000"))
+# дочитывать ли в /lord_psych архив, если горячих сообщений не хватило на бюджет
+PSYCH_FROM_ARCHIVE = os.getenv("PSYCH_FROM_ARCHIVE", "1") != "0"
+# при готовом профиле в промпт идёт статистика и лишь небольшая выборка сообщений
+PSYCH_SAMPLE_TOKENS = int(os.getenv("PSYCH_SAMPLE_TOKENS", "1200"))
+# сколько новых сообщений автора нужно, чтобы портрет сгенерировался заново
+PSYCH_REFRESH_AFTER = int(os.getenv("PSYCH_REFRESH_AFTER", "30"))
 DB = os.getenv("DB_PATH", "bot.sqlite3")
 pathlib.Path(os.path.dirname(DB) or ".").mkdir(parents=True, exist_ok=True)
 print(f"[DB] Using SQLite at: {os.path.abspath(DB)}")
@@ -39,6 +64,7 @@ BASE_DIR = pathlib.Path(__file__).resolve().parent
 MIGRATIONS_DIR = BASE_DIR / "migrations"
 
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+openrouter = OpenRouterClient(OPENROUTER_API_KEY, site_url=OPENROUTER_SITE_URL, app_name=OPENROUTER_APP_NAME)
 dp = Dispatcher()
 main_router = Router(name="main")
 
@@ -50,104 +76,67 @@ NOTIFY_USERNAME = "misukhanov"  # используется только для 
 
 COOLDOWN_SCOPE_RANDOM_REPLY = "random_reply"
 COOLDOWN_TTL_RANDOM_REPLY = 3600
-COOLDOWN_CLEANUP_INTERVAL_SEC = 600
+# сколько реплика «к слову» может ждать очереди к модели, прежде чем станет неуместной
+INTERJECT_MAX_WAIT_SEC = float(os.getenv("INTERJECT_MAX_WAIT_SEC", "30"))
+
+# лимиты обращений к модели — все в одном месте; обработчик ссылается на свой scope
+RATE_LIMITS = {
+    # отчёт на весь чат: не чаще 6 раз в час на чат
+    "lord_summary": Window(limit=6, seconds=3600, per="chat"),
+    # портрет: 3 в час на запрашивающего (готовый портрет из кэша не считается)
+    "lord_psych": Window(limit=3, seconds=3600, per="user"),
+    # ответы на упоминания и в ветке: до 5 подряд, потом одно раз в 2 минуты на пользователя
+    "llm_reply": Bucket(capacity=5, refill_sec=120, per="user"),
+    # реплики «к слову»: не больше 20 в сутки на чат
+    "interject": Window(limit=20, seconds=86400, per="chat"),
+}
+rate_limits.declare_all(RATE_LIMITS)
+
+# сколько живут закэшированные ответы LLM; реплики в диалоге не кэшируем вовсе
+SUMMARY_CACHE = CachePolicy(ttl=int(os.getenv("LLM_CACHE_TTL_SUMMARY", "21600")), replay=True)
+PSYCH_CACHE = CachePolicy(ttl=int(os.getenv("LLM_CACHE_TTL_PSYCH", "3600")), replay=True)
 
 # =========================
 # DB
 # =========================
-def _apply_migrations(conn: sqlite3.Connection) -> None:
-    if not MIGRATIONS_DIR.exists():
-        return
-    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
-        try:
-            sql = path.read_text(encoding="utf-8")
-        except OSError as err:
-            print(f"[MIGRATIONS] Failed to read {path}: {err}")
-            continue
-        if sql.strip():
-            conn.executescript(sql)
+def init_db():
+    # схема целиком — версионированные миграции: migrations/*.sql + шаги модуля ачивок;
+    # если все версии уже в schema_migrations, это одна проверка без DDL
+    applied = migrations.migrate(DB, [*migrations.sql_migrations(MIGRATIONS_DIR), *ach_migrations])
+    if applied:
+        print(f"[MIGRATIONS] Applied {len(applied)} migration(s), schema at {applied[-1]}")
 
+async def db_execute(sql: str, params: tuple = ()):
+    await storage.execute(sql, params)
 
-def init_db():
-    with closing(sqlite3.connect(DB)) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA synchronous=NORMAL;")
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            username TEXT,
-            text TEXT,
-            created_at INTEGER NOT NULL,
-            message_id INTEGER
-        );
-        """)
-        conn.execute("""
-        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
-        USING fts5(text, content='messages', content_rowid='id', tokenize='unicode61');
-        """)
-        conn.executescript("""
-        CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
-            INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
-        END;
-        CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
-            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
-        END;
-        CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
-            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
-            INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
-        END;
-        """)
-        # — таблица пользователей для кликабельных имён в саммари
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            display_name TEXT,
-            username TEXT
-        );
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS last_summary (
-            chat_id INTEGER PRIMARY KEY,
-            message_id INTEGER,
-            created_at INTEGER
-        );
-        """)
-        _apply_migrations(conn)
-        conn.commit()
-
-# добавляем тонкую обёртку, чтобы ИНИЦИАЛИЗИРОВАТЬ и схемы ачивок
-def init_db_with_achievements():
-    init_db()          # ваши базовые таблицы
-    ach_init_db()      # таблицы achievements + миграции внутри модуля
-
-def db_execute(sql: str, params: tuple = ()):
-    with closing(sqlite3.connect(DB)) as conn:
-        conn.execute(sql, params)
-        conn.commit()
-
-def db_query(sql: str, params: tuple = ()):
-    with closing(sqlite3.connect(DB)) as conn:
-        cur = conn.execute(sql, params)
-        return cur.fetchall()
-
-def get_user_messages(chat_id: int, user_id: int | None, username: str | None, limit: int = 500):
+async def db_query(sql: str, params: tuple = ()):
+    return await storage.fetch(sql, params)
+
+# потолок строк на случай, если почти все сообщения — пустые или повторы
+USER_MESSAGES_MAX_ROWS = 20000
+
+def psych_line(row) -> str:
+    return re.sub(r"\s+", " ", row[0] or "").strip()
+
+async def collect_user_messages(corpus: prompt_budget.Packer, chat_id: int, user_id: int | None, username: str | None):
     """
-    Возвращает список (text, message_id, created_at) по пользователю.
-    Если есть user_id — ищем по нему. Если нет — пытаемся по username (хуже).
+    Складывает в corpus сообщения пользователя (text, message_id, created_at), от новых к старым,
+    пока хватает бюджета. Если есть user_id — ищем по нему. Если нет — пытаемся по username (хуже).
     """
     if user_id:
-        return db_query(
-            "SELECT text, message_id, created_at FROM messages WHERE chat_id=? AND user_id=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
-            (chat_id, user_id, limit)
-        )
-    if username:
-        return db_query(
-            "SELECT text, message_id, created_at FROM messages WHERE chat_id=? AND username=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
-            (chat_id, username, limit)
-        )
-    return []
+        sql = "SELECT text, message_id, created_at FROM messages WHERE chat_id=? AND user_id=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;"
+        params = (chat_id, user_id, USER_MESSAGES_MAX_ROWS)
+    elif username:
+        sql = "SELECT text, message_id, created_at FROM messages WHERE chat_id=? AND username=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;"
+        params = (chat_id, username, USER_MESSAGES_MAX_ROWS)
+    else:
+        return corpus
+    await prompt_budget.collect(corpus, sql, params, psych_line)
+    if not corpus.full and PSYCH_FROM_ARCHIVE:
+        # всё из архива старше горячего окна, так что порядок «новые → старые» сохраняется
+        archived = await retention.user_rows(chat_id, user_id, username)
+        await asyncio.to_thread(corpus.feed, archived, psych_line)
+    return corpus
 
 
 def now_ts() -> int:
@@ -166,9 +155,8 @@ QUESTION_RE = re.compile("|".join(QUESTION_PATTERNS), re.IGNORECASE)
 def is_question(text: str) -> bool:
     return bool(text and QUESTION_RE.search(text))
 
-def mentions_bot(text: str, bot_username: str | None) -> bool:
-    if not text or not bot_username: return False
-    return f"@{bot_username.lower()}" in text.lower()
+def mentions_bot(text: str) -> bool:
+    return identity.is_mentioned(text)
 
 def is_quiet_hours(local_dt: datetime) -> bool:
     return 0 <= local_dt.hour < 7  # 00:00–07:00
@@ -251,7 +239,7 @@ async def resolve_target_user(m: Message) -> tuple[int | None, str | None, str |
         for ent in m.entities:
             if ent.type == "mention":
                 uname = (m.text or "")[ent.offset+1: ent.offset+ent.length]  # без @
-                row = db_query("SELECT user_id, display_name, username FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1;", (uname,))
+                row = await db_query("SELECT user_id, display_name, username FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1;", (uname,))
                 if row:
                     uid, dname, un = row[0]
                     return uid, dname, un
@@ -262,14 +250,8 @@ async def resolve_target_user(m: Message) -> tuple[int | None, str | None, str |
 # =========================
 # OpenRouter
 # =========================
-async def ai_reply(system_prompt: str, user_prompt: str, temperature: float = 0.5):
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": OPENROUTER_SITE_URL,
-        "X-Title": OPENROUTER_APP_NAME,
-    }
-    body = {
+def _chat_body(system_prompt: str, user_prompt: str, temperature: float) -> dict:
+    return {
         "model": MODEL,
         "temperature": temperature,
         "messages": [
@@ -277,25 +259,80 @@ async def ai_reply(system_prompt: str, user_prompt: str, temperature: float = 0.
             {"role": "user", "content": user_prompt},
         ],
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://openrouter.ai/api/v1/chat/completions", json=body, headers=headers, timeout=120) as r:
-            r.raise_for_status()
-            data = await r.json()
-            return data["choices"][0]["message"]["content"].strip()
 
+async def ai_reply(system_prompt: str, user_prompt: str, temperature: float = 0.5, cache: CachePolicy | None = None):
+    key = None
+    if llm_cache.applies(cache, temperature):
+        key = cache_key(MODEL, temperature, system_prompt, user_prompt)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return cached
+    data = await openrouter.chat(_chat_body(system_prompt, user_prompt, temperature))
+    text = data["choices"][0]["message"]["content"].strip()
+    if key and text:
+        await llm_cache.put(key, MODEL, text, cache.ttl)
+    return text
 
-async def cooldown_cleanup_worker(interval: int = COOLDOWN_CLEANUP_INTERVAL_SEC):
-    try:
-        while True:
-            await asyncio.sleep(interval)
-            try:
-                removed = clear_expired_cooldowns()
-                if removed:
-                    print(f"[COOLDOWN] Cleared {removed} expired cooldowns")
-            except Exception as err:
-                print(f"[COOLDOWN] Failed to clear expired cooldowns: {err}")
-    except asyncio.CancelledError:
-        raise
+async def ai_reply_stream(system_prompt: str, user_prompt: str, temperature: float = 0.5, cache: CachePolicy | None = None):
+    """Как ai_reply, но отдаёт текст кусками по мере генерации (SSE)."""
+    if not LLM_STREAMING:
+        yield await ai_reply(system_prompt, user_prompt, temperature, cache)
+        return
+    key = None
+    if llm_cache.applies(cache, temperature):
+        key = cache_key(MODEL, temperature, system_prompt, user_prompt)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    async for delta in openrouter.stream(_chat_body(system_prompt, user_prompt, temperature)):
+        parts.append(delta)
+        yield delta
+    text = "".join(parts).strip()
+    if key and text:
+        await llm_cache.put(key, MODEL, text, cache.ttl)
+
+def render_reply(text: str) -> str:
+    return sanitize_html_whitelist(strip_outer_quotes(text.strip()))
+
+# заглушка, пока запрос ждёт своей очереди к модели
+THINKING_PLACEHOLDER = "Думаю…"
+
+async def stream_job(streamed: StreamingReply, key: tuple, producer, *, priority: int = llm_jobs.PRIORITY_COMMAND) -> str:
+    """Ставит генерацию в очередь LLM (или присоединяется к такой же) и транслирует её в streamed."""
+    job = llm_jobs.queue.submit(key, producer, priority=priority)
+    ahead = llm_jobs.queue.position(job)
+    if streamed.message is None:
+        streamed.placeholder = f"{THINKING_PLACEHOLDER} (в очереди: {ahead})" if ahead else THINKING_PLACEHOLDER
+    return await streamed.run(job.chunks())
+
+async def stream_llm_reply(m: Message, system_prompt: str, user_prompt: str, temperature: float, render=render_reply) -> Message:
+    """Отвечает на m заглушкой и дописывает её по мере генерации; render(text) -> безопасный HTML."""
+    streamed = StreamingReply(m, render=render)
+    await stream_job(
+        streamed, ("reply", m.chat.id, m.message_id),
+        lambda: ai_reply_stream(system_prompt, user_prompt, temperature), priority=llm_jobs.PRIORITY_REPLY,
+    )
+    return streamed.message
+
+def _fmt_wait(seconds: int) -> str:
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes = (seconds + 59) // 60
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes} мин" if minutes else f"{hours} ч"
+
+async def over_rate_limit(m: Message, scope: str, *, notify: bool = True) -> bool:
+    """Засчитывает обращение по лимиту scope из RATE_LIMITS; True — лимит исчерпан (и, если notify, сообщает об этом)."""
+    decision = rate_limits.hit(scope, m.chat.id, m.from_user.id if m.from_user else None)
+    if decision.allowed:
+        return False
+    if notify:
+        await m.reply(f"Не так часто. Попробуйте через {_fmt_wait(decision.retry_after)}.")
+    return True
 
 # =========================
 # Linkify helpers (для саммари, в психо-аналитике не используем)
@@ -353,11 +390,29 @@ def smart_linkify(text: str) -> str:
 # =========================
 # SUMMARY (жёсткий шаблон)
 # =========================
-def prev_summary_link(chat_id: int) -> str | None:
-    row = db_query("SELECT message_id FROM last_summary WHERE chat_id=? ORDER BY created_at DESC LIMIT 1;", (chat_id,))
+async def prev_summary_link(chat_id: int) -> str | None:
+    row = await db_query("SELECT message_id FROM last_summary WHERE chat_id=? ORDER BY created_at DESC LIMIT 1;", (chat_id,))
     if not row: return None
     return tg_link(chat_id, row[0][0])
 
+SUMMARY_CHUNK_SYSTEM = (
+    "Ты конспектируешь фрагмент группового чата для последующего отчёта. "
+    "Стиль — нейтральный, сжатый, без оценок и эмодзи. Ничего не выдумывай."
+)
+
+def _summary_line(chat_id: int, row, users_map: dict) -> str:
+    _id, uid, u, t, mid = row
+    dname, un = users_map.get(uid, (None, u))
+    link = tg_link(chat_id, mid) if mid else ""
+    return f"{tg_mention(uid, dname, un)}: {t}" + (f"  [link: {link}]" if link else "")
+
+def _summary_dialog(chat_id: int, rows, users_map: dict, budget: int, *, newest_first: bool = False) -> str:
+    """Строки диалога в хронологическом порядке, не больше budget токенов.
+    newest_first — при нехватке бюджета жертвуем самыми старыми строками, а не свежими."""
+    dialog = prompt_budget.Packer(budget)
+    dialog.feed(reversed(rows) if newest_first else rows, lambda r: _summary_line(chat_id, r, users_map), lambda r: r[3])
+    return "\n".join(reversed(dialog.lines) if newest_first else dialog.lines)
+
 @main_router.message(Command("lord_summary"))
 async def cmd_summary(m: Message, command: CommandObject):
     try:
@@ -366,23 +421,33 @@ async def cmd_summary(m: Message, command: CommandObject):
     except Exception:
         n = 300
 
-    rows = db_query(
-        "SELECT user_id, username, text, message_id FROM messages WHERE chat_id=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
+    await message_log.flushed()
+    rows = await db_query(
+        "SELECT id, user_id, username, text, message_id FROM messages WHERE chat_id=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
         (m.chat.id, n)
     )
     if not rows:
         await m.reply("У меня пока нет сообщений для саммари.")
         return
+    rows.reverse()
+
+    # если окно начинается посреди уже законспектированного куска — берём кусок целиком
+    chunk_start = await summary_chunks.chunk_start_covering(m.chat.id, rows[0][0])
+    if chunk_start is not None and chunk_start < rows[0][0]:
+        rows = await db_query(
+            "SELECT id, user_id, username, text, message_id FROM messages WHERE chat_id=? AND text IS NOT NULL AND id>=? ORDER BY id;",
+            (m.chat.id, chunk_start)
+        )
 
-    prev_link = prev_summary_link(m.chat.id)
+    prev_link = await prev_summary_link(m.chat.id)
     prev_line_html = f'<a href="{prev_link}">Предыдущий анализ</a>' if prev_link else "Предыдущий анализ (—)"
 
     # Собираем участников и превращаем в кликабельные имена
-    user_ids = tuple({r[0] for r in rows})
+    user_ids = tuple({r[1] for r in rows})
     users_map = {}
     if user_ids:
         placeholders = ",".join(["?"] * len(user_ids))
-        urows = db_query(
+        urows = await db_query(
             f"SELECT user_id, display_name, username FROM users WHERE user_id IN ({placeholders});",
             user_ids
         )
@@ -395,48 +460,81 @@ async def cmd_summary(m: Message, command: CommandObject):
         participants.append(tg_mention(uid, dname, uname))
     participants_html = ", ".join(participants) if participants else "—"
 
-    enriched = []
-    for uid, u, t, mid in reversed(rows):
-        dname, un = users_map.get(uid, (None, u))
-        who_link = tg_mention(uid, dname, un)
-        link = tg_link(m.chat.id, mid) if mid else ""
-        enriched.append(f"{who_link}: {t}" + (f"  [link: {link}]" if link else ""))
-    dialog_block = "\n".join(enriched)
+    chunk_budget = prompt_budget.budget_for(MODEL, SUMMARY_CHUNK_TOKENS)
+    async def summarize_chunk(chunk_rows) -> str:
+        user = (
+            f"{_summary_dialog(m.chat.id, chunk_rows, users_map, chunk_budget)}\n\n"
+            "Составь конспект этого фрагмента: 2–5 пунктов, по одному на тему. "
+            "В каждом пункте — кто участвовал (используй кликабельные имена из текста, не используй @), "
+            "суть в одном-двух предложениях и ссылка на начало обсуждения в виде [link: URL] из текста. "
+            "Без вступлений и выводов."
+        )
+        return await ai_reply(SUMMARY_CHUNK_SYSTEM, user, temperature=0.2)
 
-    system = (
-        "Ты оформляешь краткий отчёт по групповому чату. "
-        "Стиль — нейтральный, информативный, без сарказма, метафор и личных оценок. "
-        "Пиши ясно, лаконично, как аналитический отчёт. "
-        "Используй HTML для форматирования, не меняй структуру. "
-        "Каждая тема должна иметь осмысленное название (2–5 слов) и ссылку на начало её обсуждения. "
-        "Не вставляй эмодзи в текст, кроме заданных шаблоном."
-    )
-    user = (
-        f"Участники (используй эти кликабельные имена в тексте тем, не используй @): {participants_html}\n\n"
-        f"{dialog_block}\n\n"
-        "Сформируй ответ СТРОГО по этому каркасу (ровно в таком порядке):\n\n"
-        f"{prev_line_html}\n\n"
-        "✂️<b>Краткое содержание</b>:\n"
-        "Два-три коротких предложения, обобщающих разговор. БЕЗ ссылок.\n\n"
-        "😄 <b><a href=\"[link: ТЕМА1_URL]\">[ПРИДУМАННОЕ НАЗВАНИЕ ТЕМЫ]</a></b>\n"
-        "Один абзац (1–3 предложения). Обязательно назови по именам участников, "
-        "и вставь 1–3 ссылки ВНУТРИ текста на 2–5 слов (используй URL из [link: ...]).\n\n"
-        "😄 <b><a href=\"[link: ТЕМА2_URL]\">[ПРИДУМАННОЕ НАЗВАНИЕ ТЕМЫ]</a></b>\n"
-        "Абзац по тем же правилам.\n\n"
-        "😄 <b><a href=\"[link: ТЕМА3_URL]\">[ПРИДУМАННОЕ НАЗВАНИЕ ТЕМЫ]</a></b>\n"
-        "Абзац по тем же правилам. Если явных тем меньше, кратко заверши третью темой-резюме.\n\n"
-        "Заверши одной короткой фразой в нейтральном тоне."
+    # ссылку на прошлый отчёт ставим сами, а не через модель: так промпт не меняется
+    # от запуска к запуску, и повторный /lord_summary в тихом чате берётся из кэша
+    streamed = StreamingReply(
+        m, render=lambda t: sanitize_html_whitelist(smart_linkify(f"{prev_line_html}\n\n{t.strip()}"))
     )
 
+    async def produce():
+        # готовые куски берём из базы, недостающие конспектируем параллельно
+        parts, tail = await summary_chunks.summarize(m.chat.id, rows, summarize_chunk)
+        # бюджет итогового промпта: за вычетом участников и каркаса ответа (~800 токенов)
+        budget = prompt_budget.budget_for(MODEL, SUMMARY_PROMPT_TOKENS) - prompt_budget.estimate_tokens(participants_html) - 800
+        notes = []
+        for part in parts:
+            if isinstance(part, summary_chunks.Chunk):
+                notes.append(part.summary)
+            else:
+                notes.append(_summary_dialog(m.chat.id, part, users_map, chunk_budget))
+        # конспектам — не больше половины, свежие важнее старых
+        kept_notes = prompt_budget.Packer(budget // 2, min_chars=0, dedupe=False).feed(reversed(notes), str)
+        dialog_block = _summary_dialog(m.chat.id, tail, users_map, budget - kept_notes.tokens, newest_first=True)
+        if kept_notes.lines:
+            notes_block = "\n\n".join(reversed(kept_notes.lines))
+            dialog_block = (
+                f"Конспекты более ранних частей беседы (по порядку):\n{notes_block}\n\n"
+                f"Последние сообщения:\n{dialog_block or '—'}"
+            )
+
+        system = (
+            "Ты оформляешь краткий отчёт по групповому чату. "
+            "Стиль — нейтральный, информативный, без сарказма, метафор и личных оценок. "
+            "Пиши ясно, лаконично, как аналитический отчёт. "
+            "Используй HTML для форматирования, не меняй структуру. "
+            "Каждая тема должна иметь осмысленное название (2–5 слов) и ссылку на начало её обсуждения. "
+            "Не вставляй эмодзи в текст, кроме заданных шаблоном."
+        )
+        user = (
+            f"Участники (используй эти кликабельные имена в тексте тем, не используй @): {participants_html}\n\n"
+            f"{dialog_block}\n\n"
+            "Сформируй ответ СТРОГО по этому каркасу (ровно в таком порядке):\n\n"
+            "✂️<b>Краткое содержание</b>:\n"
+            "Два-три коротких предложения, обобщающих разговор. БЕЗ ссылок.\n\n"
+            "😄 <b><a href=\"[link: ТЕМА1_URL]\">[ПРИДУМАННОЕ НАЗВАНИЕ ТЕМЫ]</a></b>\n"
+            "Один абзац (1–3 предложения). Обязательно назови по именам участников, "
+            "и вставь 1–3 ссылки ВНУТРИ текста на 2–5 слов (используй URL из [link: ...]).\n\n"
+            "😄 <b><a href=\"[link: ТЕМА2_URL]\">[ПРИДУМАННОЕ НАЗВАНИЕ ТЕМЫ]</a></b>\n"
+            "Абзац по тем же правилам.\n\n"
+            "😄 <b><a href=\"[link: ТЕМА3_URL]\">[ПРИДУМАННОЕ НАЗВАНИЕ ТЕМЫ]</a></b>\n"
+            "Абзац по тем же правилам. Если явных тем меньше, кратко заверши третью темой-резюме.\n\n"
+            "Заверши одной короткой фразой в нейтральном тоне."
+        )
+        async for chunk in ai_reply_stream(system, user, temperature=0.2, cache=SUMMARY_CACHE):
+            yield chunk
+
+    # одновременные /lord_summary с тем же окном ждут одну генерацию; лимит чата тратит
+    # только запрос, который её запускает (между проверкой и submit нет await)
+    job_key = ("summary", m.chat.id, n)
+    if not llm_jobs.queue.active(job_key) and await over_rate_limit(m, "lord_summary"):
+        return
     try:
-        reply = await ai_reply(system, user, temperature=0.2)
-        reply = smart_linkify(reply)
+        await stream_job(streamed, job_key, produce)
     except Exception as e:
-        reply = f"Суммаризация временно недоступна: {e}"
-
-    safe = sanitize_html_whitelist(reply)
-    sent = await m.reply(safe)
-    db_execute(
+        await streamed.fail(sanitize_html_whitelist(f"Суммаризация временно недоступна: {e}"))
+    sent = streamed.message
+    await db_execute(
         "INSERT INTO last_summary(chat_id, message_id, created_at) VALUES (?, ?, ?)"
         "ON CONFLICT(chat_id) DO UPDATE SET message_id=excluded.message_id, created_at=excluded.created_at;",
         (m.chat.id, sent.message_id, now_ts())
@@ -457,23 +555,38 @@ async def cmd_lord_psych(m: Message, command: CommandObject):
         await m.reply("Кого анализируем? Ответь командой на сообщение пользователя или укажи @username.")
         return
 
-    rows = get_user_messages(m.chat.id, target_id, uname, limit=600)
-    if not rows:
+    await message_log.flushed()
+    # профиль есть только у известного user_id; по одному @username — как раньше, по выборке
+    profile = await profiles.get(m.chat.id, target_id) if target_id else None
+    if profile and profile.messages:
+        cached = await profiles.cached_portrait(m.chat.id, target_id)
+        if cached and profile.messages - cached[0] < PSYCH_REFRESH_AFTER:
+            fresh = profile.messages - cached[0]
+            footer = f"\n\n<i>Портрет от {datetime.fromtimestamp(cached[2]).strftime('%d.%m.%Y')}"
+            footer += f", с тех пор новых сообщений: {fresh}.</i>" if fresh else ".</i>"
+            await m.reply(render_reply(cached[1]) + footer, disable_web_page_preview=True)
+            return
+    if await over_rate_limit(m, "lord_psych"):
+        return
+    sample_tokens = PSYCH_SAMPLE_TOKENS if profile and profile.messages else PSYCH_PROMPT_TOKENS
+    corpus = prompt_budget.Packer(prompt_budget.budget_for(MODEL, sample_tokens))
+    await collect_user_messages(corpus, m.chat.id, target_id, uname)
+    if not corpus.lines:
         hint = "Нет сообщений в базе по этому пользователю."
-        if uname and not target_id:
+        if corpus.scanned:
+            hint = "У этого пользователя нет содержательных сообщений — одни реплики в пару букв и повторы."
+        elif uname and not target_id:
             hint += " Возможно, у этого @username нет сохранённого user_id (старые сообщения)."
         await m.reply(hint)
         return
 
-    texts = [t for (t, mid, ts) in rows]
-    def clean(s): 
-        return re.sub(r"\s+", " ", (s or "")).strip()
-    joined = " \n".join(clean(t) for t in texts[:500])
-    if len(joined) > 8000:
-        joined = joined[:8000]
+    joined = corpus.text(" \n")
 
     dname = display_name or uname or "участник"
     target_html = tg_mention(target_id or 0, dname, uname)
+    stats = ""
+    if profile and profile.messages:
+        stats = f"Статистика по всей переписке участника:\n{profile.describe()}\n\n"
 
     # === Обновлённые промпты: 3 абзаца, без ссылок, без <br> ===
     system = (
@@ -487,6 +600,7 @@ async def cmd_lord_psych(m: Message, command: CommandObject):
 
     user = (
         f"Цель анализа: {target_html}\n\n"
+        f"{stats}"
         "Ниже корпус сообщений (новые → старые). Используй стиль, лексику, ритм и поведенческие маркеры:\n\n"
         f"{joined}\n\n"
         "Сформируй вывод из 3 абзацев:\n"
@@ -496,13 +610,113 @@ async def cmd_lord_psych(m: Message, command: CommandObject):
         "Не вставляй ссылки и HTML, кроме <b>жирного</b> для имени в первом абзаце."
     )
 
+    # ничего не линкуем; оставляем только безопасные теги (допустимы <b>/<i> и т.п.)
+    async def produce():
+        parts = []
+        async for chunk in ai_reply_stream(system, user, temperature=0.55, cache=PSYCH_CACHE):
+            parts.append(chunk)
+            yield chunk
+        portrait = "".join(parts)
+        if profile and profile.messages and portrait.strip():
+            await profiles.save_portrait(m.chat.id, target_id, profile.messages, portrait)
+
+    streamed = StreamingReply(m, render=render_reply)
     try:
-        reply = await ai_reply(system, user, temperature=0.55)
-        reply = strip_outer_quotes(reply)
-        # ничего не линкуем; оставляем только безопасные теги (допустимы <b>/<i> и т.п.)
-        await m.reply(sanitize_html_whitelist(reply))
+        await stream_job(streamed, ("psych", m.chat.id, target_id or uname.lower()), produce)
     except Exception as e:
-        await m.reply(f"Портрет временно недоступен: {e}")
+        await streamed.fail(f"Портрет временно недоступен: {e}")
+
+# =========================
+# Поиск по истории (FTS5)
+# =========================
+SEARCH_HELP = (
+    "Использование: <code>/lord_search слова</code>\n"
+    "• <code>\"точная фраза\"</code>, <code>корм*</code> — по началу слова, <code>-слово</code> — исключить\n"
+    "• <code>from:@username</code> — только сообщения участника\n"
+    "• <code>since:2024-05-01</code>, <code>until:2024-06-30</code> — интервал дат"
+)
+
+def _search_highlight(snippet: str) -> str:
+    text = _html.escape(re.sub(r"\s+", " ", snippet or "").strip())
+    return text.replace(search.HIGHLIGHT_START, "<b>").replace(search.HIGHLIGHT_END, "</b>")
+
+def render_search_page(session: search.Session, hits: list[search.Hit]) -> str:
+    lines = [f"🔎 <b>Поиск:</b> <code>{_html.escape(session.text)}</code> — стр. {session.page + 1}"]
+    offset = session.page * search.PAGE_SIZE
+    for i, hit in enumerate(hits, start=offset + 1):
+        day = datetime.fromtimestamp(hit.created_at, timezone.utc).strftime("%d.%m.%Y")
+        when = f"<a href=\"{tg_link(session.query.chat_id, hit.message_id)}\">{day}</a>" if hit.message_id else day
+        who = _html.escape(hit.display_name or (f"@{hit.username}" if hit.username else "user"))
+        lines.append(f"{i}. {when} <b>{who}</b>: {_search_highlight(hit.snippet)}")
+    return "\n".join(lines)
+
+def search_keyboard(token: str, session: search.Session) -> InlineKeyboardMarkup | None:
+    buttons = []
+    if session.page > 0:
+        buttons.append(InlineKeyboardButton(text="◀ Назад", callback_data=f"srch:{token}:prev"))
+    if session.next_cursor is not None:
+        buttons.append(InlineKeyboardButton(text="Дальше ▶", callback_data=f"srch:{token}:next"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+async def _search_page(session: search.Session) -> tuple[search.Session, list[search.Hit]]:
+    hits, more = await search.search(session.query, after=session.starts[-1])
+    last = search.Cursor(hits[-1].score, hits[-1].id) if hits and more else None
+    return session._replace(next_cursor=last), hits
+
+@main_router.message(Command("lord_search"))
+async def cmd_lord_search(m: Message, command: CommandObject):
+    text = (command.args or "").strip()
+    if not text:
+        await m.reply(SEARCH_HELP)
+        return
+    try:
+        parsed = search.parse(text)
+    except ValueError as err:
+        await m.reply(f"{_html.escape(str(err))}\n\n{SEARCH_HELP}")
+        return
+
+    user_id = await search.resolve_user(parsed.from_username) if parsed.from_username else None
+    query = search.Query(
+        m.chat.id, parsed.match,
+        user_id=user_id, username=parsed.from_username if user_id is None else None,
+        since=parsed.since, until=parsed.until,
+    )
+    await message_log.flushed()
+    session = search.Session(query, text, 0, (None,), None, time.monotonic())
+    try:
+        session, hits = await _search_page(session)
+    except sqlite3.OperationalError as err:
+        await m.reply(f"Не получилось разобрать запрос: <code>{_html.escape(str(err))}</code>")
+        return
+    if not hits:
+        await m.reply("Ничего не нашлось.")
+        return
+    token = search.sessions.put(session)
+    await m.reply(render_search_page(session, hits), reply_markup=search_keyboard(token, session), disable_web_page_preview=True)
+
+@main_router.callback_query(F.data.startswith("srch:"))
+async def cb_lord_search(c: CallbackQuery):
+    _, token, direction = (c.data or "").split(":", 2)
+    session = search.sessions.get(token)
+    if session is None or not isinstance(c.message, Message):
+        await c.answer("Поиск устарел, повторите команду.", show_alert=True)
+        return
+    if direction == "next" and session.next_cursor is not None:
+        session = session._replace(page=session.page + 1, starts=session.starts + (session.next_cursor,))
+    elif direction == "prev" and session.page > 0:
+        session = session._replace(page=session.page - 1, starts=session.starts[:-1])
+    else:
+        await c.answer()
+        return
+    session, hits = await _search_page(session)
+    search.sessions.put(session, token)
+    with suppress(Exception):
+        await c.message.edit_text(
+            render_search_page(session, hits) if hits else "Больше ничего не нашлось.",
+            reply_markup=search_keyboard(token, session),
+            disable_web_page_preview=True,
+        )
+    await c.answer()
 
 # =========================
 # Small talk / interjections
@@ -565,44 +779,48 @@ def bump_reply_counter():
     global REPLY_COUNTER
     REPLY_COUNTER += 1
 
+def _context_exclude() -> tuple[str, ...]:
+    # обращение к боту — не тема разговора, по нему историю не ищем
+    return ("лорд", "лорда", "лорду", "вербус", "вербуса", "lord", "verbus", identity.username or "")
+
 async def reply_to_mention(m: Message):
-    ctx_rows = db_query(
-        "SELECT username, text FROM messages WHERE chat_id=? AND id<=(SELECT MAX(id) FROM messages WHERE message_id=?) ORDER BY id DESC LIMIT 12;",
-        (m.chat.id, m.message_id)
-    )
-    ctx = "\n".join([f"{('@'+u) if u else 'user'}: {t}" for u, t in reversed(ctx_rows)])
+    if await over_rate_limit(m, "llm_reply", notify=False):
+        return
+    await message_log.flushed()
+    ctx = (await chat_context.build(
+        m.chat.id, m.text or "", anchor_message_id=m.message_id, exclude_terms=_context_exclude()
+    )).render()
     epithet = maybe_pick_epithet()
     add = f"\nМожно вставить одно уместное изящное выражение: «{epithet}»." if epithet else ""
     system = persona_prompt_natural()
     user = (
         "Тебя упомянули в групповом чате. Ответь коротко, 1-2 предложения, по существу и с холодной вежливостью. "
         + add +
-        f"\n\nНедавний контекст:\n{ctx}\n\nСообщение:\n«{m.text}»"
+        f"\n\n{ctx}\n\nСообщение:\n«{m.text}»"
     )
     try:
-        reply = await ai_reply(system, user, temperature=0.66)
-        reply = strip_outer_quotes(reply)
-        await m.reply(sanitize_html_whitelist(reply))
+        await stream_llm_reply(m, system, user, 0.66)
     finally:
         bump_reply_counter()
 
 async def reply_to_thread(m: Message):
-    ctx_rows = db_query(
-        "SELECT username, text FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 12;",
-        (m.chat.id,)
-    )
-    ctx_block = "\n".join([f"{('@'+u) if u else 'user'}: {t}" for u, t in reversed(ctx_rows)])
+    if await over_rate_limit(m, "llm_reply", notify=False):
+        return
+    await message_log.flushed()
+    # реплику бота, на которую ответили, тоже используем для поиска по истории
+    replied = (m.reply_to_message.text or "") if m.reply_to_message else ""
+    ctx_block = (await chat_context.build(
+        m.chat.id, f"{m.text or ''} {replied}", exclude_terms=_context_exclude()
+    )).render()
     epithet = maybe_pick_epithet()
     add = f"\nМожно вставить одно уместное изящное выражение: «{epithet}»." if epithet else ""
     system = persona_prompt_natural()
     user = (
         "Ответь на сообщение в ветке: коротко, высокомерно-иронично, но без прямых оскорблений. "
         + add +
-        f"\n\nНедавний контекст:\n{ctx_block}\n\nСообщение:\n«{m.text}»"
+        f"\n\n{ctx_block}\n\nСообщение:\n«{m.text}»"
     )
-    reply = await ai_reply(system, user, temperature=0.66)
-    reply = strip_outer_quotes(reply)
-    await m.reply(sanitize_html_whitelist(reply))
+    await stream_llm_reply(m, system, user, 0.66)
 
 async def maybe_interject(m: Message):
     # вмешиваемся иногда, если явный вопрос и не «тихий час»
@@ -610,27 +828,43 @@ async def maybe_interject(m: Message):
     if is_quiet_hours(local_dt): return
     if not is_question(m.text or ""): return
     if random.random() > 0.33: return
-    if is_on_cooldown(COOLDOWN_SCOPE_RANDOM_REPLY, m.chat.id, None):
+    if await is_on_cooldown(COOLDOWN_SCOPE_RANDOM_REPLY, m.chat.id, None):
         return
-        
-    ctx_rows = db_query(
-        "SELECT username, text FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 8;",
-        (m.chat.id,)
-    )
-    ctx_block = "\n".join([f"{('@'+u) if u else 'user'}: {t}" for u, t in reversed(ctx_rows)])
+    # в чате уже готовится реплика — вторая подряд ни к чему
+    job_key = ("interject", m.chat.id)
+    if llm_jobs.queue.active(job_key):
+        return
+    if await over_rate_limit(m, "interject", notify=False):
+        return
+
+    await message_log.flushed()
+    ctx_block = (await chat_context.build(
+        m.chat.id, m.text or "", recent=5, related=4, budget=chat_context.BUDGET_CHARS * 2 // 3,
+        exclude_terms=_context_exclude(),
+    )).render()
     epithet = maybe_pick_epithet()
-    add = f"\nМожно вставить одно уместное изящное выражение: «{епithet}»." if epithet else ""
+    add = f"\nМожно вставить одно уместное изящное выражение: «{epithet}»." if epithet else ""
     system = persona_prompt_natural()
     user = (
         "Тебя упомянули в групповом чате. Ответь естественно и по делу, кратко; можно добавить одну короткую колкость."
         + add +
-        f"\n\nНедавний контекст:\n{ctx_block}\n\nСообщение:\n«{m.text}»"
+        f"\n\n{ctx_block}\n\nСообщение:\n«{m.text}»"
     )
+    async def produce():
+        yield await ai_reply(system, user, temperature=0.66)
+
     try:
-        reply = await ai_reply(system, user, temperature=0.66)
+        try:
+            job = llm_jobs.queue.submit(
+                job_key, produce, priority=llm_jobs.PRIORITY_INTERJECT, max_wait=INTERJECT_MAX_WAIT_SEC
+            )
+            reply = await job.result()
+        except (llm_jobs.QueueFull, llm_jobs.JobExpired):
+            # модель занята командами — промолчать лучше, чем ответить невпопад
+            return
         reply = strip_outer_quotes(reply)
         await m.reply(sanitize_html_whitelist(reply))
-        set_cooldown(COOLDOWN_SCOPE_RANDOM_REPLY, m.chat.id, None, COOLDOWN_TTL_RANDOM_REPLY)
+        await set_cooldown(COOLDOWN_SCOPE_RANDOM_REPLY, m.chat.id, None, COOLDOWN_TTL_RANDOM_REPLY)
     finally:
         bump_reply_counter()
 
@@ -651,41 +885,35 @@ async def on_text(m: Message):
     if not m.text:
         return
 
-    # логируем текст
+    # логируем текст (буферизованно — пишется пачками в фоне)
     if not m.text.startswith("/"):
-        db_execute(
-            "INSERT INTO messages(chat_id, user_id, username, text, created_at, message_id) VALUES (?, ?, ?, ?, ?, ?);",
-            (m.chat.id, m.from_user.id if m.from_user else 0,
-             m.from_user.username if m.from_user else None,
-             m.text, now_ts(), m.message_id)
-        )
-        
-        # ===== ВОТ ЗДЕСЬ ВЫЗОВ АЧИВОК (КРИТИЧНО!) =====
-        try:
-            await ach_on_text_hook(m)
-        except Exception as e:
-            print(f"[ERROR] Achievements hook failed: {e}")
-        # =============================================
-
-        # — обновляем карточку пользователя
-        if m.from_user:
-            full_name = (m.from_user.full_name or "").strip() or (m.from_user.first_name or "")
-            db_execute(
-                "INSERT INTO users(user_id, display_name, username) VALUES(?, ?, ?) "
-                "ON CONFLICT(user_id) DO UPDATE SET display_name=excluded.display_name, username=excluded.username;",
-                (m.from_user.id, full_name, m.from_user.username)
+        with metrics.HANDLER_SECONDS.time(handler="on_text"):
+            full_name = None
+            if m.from_user:
+                # — заодно обновляем карточку пользователя
+                full_name = (m.from_user.full_name or "").strip() or (m.from_user.first_name or "")
+            message_log.log(
+                m.chat.id, m.from_user.id if m.from_user else 0,
+                m.from_user.username if m.from_user else None,
+                m.text, now_ts(), m.message_id,
+                display_name=full_name,
             )
-
-    me = await bot.get_me()
+        
+            # ===== ВОТ ЗДЕСЬ ВЫЗОВ АЧИВОК (КРИТИЧНО!) =====
+            try:
+                await ach_on_text_hook(m)
+            except Exception as e:
+                print(f"[ERROR] Achievements hook failed: {e}")
+            # =============================================
 
     if m.text.startswith("/"):
         return
 
-    if m.reply_to_message and m.reply_to_message.from_user and m.reply_to_message.from_user.id == me.id:
+    if m.reply_to_message and m.reply_to_message.from_user and m.reply_to_message.from_user.id == identity.id:
         await reply_to_thread(m)
         return
 
-    if mentions_bot(m.text or "", me.username):
+    if mentions_bot(m.text or ""):
         await reply_to_mention(m)
         return
 
@@ -743,10 +971,12 @@ async def set_commands():
     commands_group = [
         BotCommand(command="lord_summary", description="Краткий отчёт по беседе"),
         BotCommand(command="lord_psych",  description="Психологический портрет участника"),
+        BotCommand(command="lord_search", description="Поиск по сообщениям беседы"),
     ]
     commands_private = [
         BotCommand(command="lord_summary", description="Краткий отчёт по беседе"),
         BotCommand(command="lord_psych",  description="Психологический портрет участника"),
+        BotCommand(command="lord_search", description="Поиск по сообщениям беседы"),
         BotCommand(command="start", description="Приветствие"),
     ]
     await bot.set_my_commands(commands_group, scope=BotCommandScopeAllGroupChats())
@@ -760,25 +990,20 @@ async def debug_achievements(m: Message):
         return
     
     try:
-        from achievements import ADMIN_IDS, is_admin, DB
-        import sqlite3
-        from contextlib import closing
+        from achievements import ADMIN_IDS, is_admin
         
         user_id = m.from_user.id
         is_adm = is_admin(user_id)
         
+        await counters.flush()
         # Проверяем таблицы
-        with closing(sqlite3.connect(DB)) as conn:
-            cur = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = [row[0] for row in cur.fetchall()]
-            
-            # Считаем ачивки
-            cur = conn.execute("SELECT COUNT(*) FROM achievements;")
-            ach_count = cur.fetchone()[0]
-            
-            # Считаем статы
-            cur = conn.execute("SELECT COUNT(*) FROM user_stats WHERE user_id=?;", (user_id,))
-            stats_count = cur.fetchone()[0]
+        tables = [row[0] for row in await db_query("SELECT name FROM sqlite_master WHERE type='table';")]
+        
+        # Считаем ачивки
+        ach_count = (await db_query("SELECT COUNT(*) FROM achievements;"))[0][0]
+        
+        # Считаем статы
+        stats_count = (await db_query("SELECT COUNT(*) FROM user_stats WHERE user_id=?;", (user_id,)))[0][0]
         
         report = (
             f"🔍 <b>Диагностика достижений</b>\n\n"
@@ -799,35 +1024,156 @@ async def debug_achievements(m: Message):
         import traceback
         print(traceback.format_exc())
 
+def _fmt_ms(seconds: float | None) -> str:
+    return "—" if seconds is None else f"{seconds * 1000:.1f}"
+
+def render_stats() -> str:
+    lines = ["📊 <b>Метрики процесса</b>"]
+    for name in sorted(metrics.registry.metrics):
+        metric = metrics.registry.metrics[name]
+        if isinstance(metric, metrics.Histogram):
+            for key, state in sorted(metric.states.items()):
+                labels = ",".join(key)
+                p95 = metric.quantile(0.95, **dict(zip(metric.label_names, key)))
+                lines.append(
+                    f"• <code>{name}{'{' + labels + '}' if labels else ''}</code>: "
+                    f"n={state.count}, avg={_fmt_ms(state.sum / state.count)} ms, p95≤{_fmt_ms(p95)} ms"
+                )
+        else:
+            for sample_name, labels, value in metric.samples():
+                lines.append(f"• <code>{sample_name}{_html.escape(labels)}</code>: {value:g}")
+    text = "\n".join(lines)
+    # лимит Telegram — 4096 символов; полный список есть на /metrics
+    return text if len(text) <= 4000 else text[:text.rfind("\n", 0, 4000)] + "\n…"
+
+@main_router.message(Command("lord_stats"))
+async def cmd_lord_stats(m: Message):
+    if not m.from_user or not is_admin(m.from_user.id):
+        await m.reply("Недостаточно прав.")
+        return
+    await m.reply(render_stats(), disable_web_page_preview=True)
+
+def render_sql_top(limit: int, order: str) -> str:
+    if not sql_trace.ENABLED:
+        return "Трассировка SQL выключена. Запустите бота с <code>SQL_TRACE=1</code>."
+    entries = sql_trace.tracer.top(limit, order)
+    if not entries:
+        return "Запросов пока не было."
+    lines = [f"🐢 <b>Топ SQL по {order}</b> (медленные — от {sql_trace.SLOW_MS:g} мс)"]
+    for entry in entries:
+        lines.append(
+            f"• {entry.calls}× total={entry.total * 1000:.0f} мс, avg={entry.avg * 1000:.2f}, "
+            f"max={entry.max * 1000:.1f}, rows={entry.rows}, slow={entry.slow}\n"
+            f"  {_html.escape(entry.top_caller() or '-')}\n"
+            f"  <code>{_html.escape(entry.sql[:300])}</code>"
+        )
+    text = "\n".join(lines)
+    return text if len(text) <= 4000 else text[:text.rfind("\n•", 0, 4000)] + "\n…"
+
+@main_router.message(Command("lord_sql"))
+async def cmd_lord_sql(m: Message, command: CommandObject):
+    """/lord_sql [N] [total|max|calls|rows] — самые дорогие запросы процесса"""
+    if not m.from_user or not is_admin(m.from_user.id):
+        await m.reply("Недостаточно прав.")
+        return
+    limit, order = 10, "total"
+    for arg in (command.args or "").split():
+        if arg.isdigit():
+            limit = max(1, min(int(arg), 30))
+        elif arg in sql_trace.ORDERS:
+            order = arg
+        elif arg == "reset":
+            sql_trace.tracer.reset()
+            await m.reply("Статистика SQL сброшена.")
+            return
+    await m.reply(render_sql_top(limit, order), disable_web_page_preview=True)
+
+def _retention_limit(value: int) -> str:
+    return str(value) if value > 0 else "без ограничения"
+
+@main_router.message(Command("lord_retention"))
+async def cmd_lord_retention(m: Message, command: CommandObject):
+    """/lord_retention [days N] [rows N] | default — горячее окно сообщений этого чата"""
+    if not m.from_user or not is_admin(m.from_user.id):
+        await m.reply("Недостаточно прав.")
+        return
+    args = (command.args or "").lower().split()
+    if args == ["default"]:
+        await retention.set_policy(m.chat.id, None, None)
+    elif args:
+        current = await retention.policy(m.chat.id)
+        values = {"days": current.keep_days, "rows": current.keep_rows}
+        if len(args) % 2 or any(k not in values or not v.isdigit() for k, v in zip(args[::2], args[1::2])):
+            await m.reply("Формат: <code>/lord_retention days 90 rows 50000</code> (0 — без ограничения) или <code>/lord_retention default</code>")
+            return
+        values.update((k, int(v)) for k, v in zip(args[::2], args[1::2]))
+        await retention.set_policy(m.chat.id, values["days"], values["rows"])
+    policy = await retention.policy(m.chat.id)
+    archived_to, archived_rows = await retention.archived(m.chat.id)
+    await m.reply(
+        "🗄 <b>Хранение сообщений</b>\n"
+        f"Дней в базе: {_retention_limit(policy.keep_days)}\n"
+        f"Сообщений в базе: {_retention_limit(policy.keep_rows)}\n"
+        f"В архиве: {archived_rows} (до id {archived_to})"
+    )
+
 # =========================
 # Main
 # =========================
 async def main():
     # Инициализация БД с поддержкой ачивок
     print("[INIT] Initializing database...")
-    init_db_with_achievements()
+    init_db()
+    storage.start()
+    message_log.start()
+    counters.start()
+    retention.start()
     print("[INIT] Database ready!")
 
-    expired = clear_expired_cooldowns()
-    if expired:
-        print(f"[INIT] Cleared {expired} expired cooldowns")
+    # кулдауны живут в памяти; таблица читается один раз, чтобы пережить перезапуск
+    active = await load_cooldowns()
+    if active:
+        print(f"[INIT] Restored {active} active cooldowns")
+    limited = await rate_limits.load()
+    if limited:
+        print(f"[INIT] Restored {limited} rate-limit counters")
+    rate_limits.start()
 
     # Регистрируем роутер ачивок
     print("[INIT] Registering achievements router...")
     dp.include_router(ach_router)
     print("[INIT] Registering main router...")
     dp.include_router(main_router)
+    if sql_trace.ENABLED:
+        dp.message.middleware(sql_trace.handler_middleware)
+        dp.callback_query.middleware(sql_trace.handler_middleware)
+        print(f"[SQLTRACE] Tracing SQL, slow log ({sql_trace.SLOW_MS:g} ms+): {sql_trace.SLOW_LOG}")
     print("[INIT] Routers ready!")
 
     await set_commands()
+    openrouter.start()
+    llm_jobs.queue.start()
+    await identity.refresh(bot)
+    identity.start(bot)
+    await metrics.registry.start()
+    print(f"[INIT] Running as @{identity.username} ({identity.id})")
     print("[START] Bot is polling...")
-    cleanup_task = asyncio.create_task(cooldown_cleanup_worker())
     try:
         await dp.start_polling(bot)
     finally:
-        cleanup_task.cancel()
-        with suppress(asyncio.CancelledError):
-            await cleanup_task
+        await metrics.registry.close()
+        await retention.close()
+        await rate_limits.close()
+        await identity.close()
+        await llm_jobs.queue.close()
+        await openrouter.close()
+        print(f"[LLMCACHE] hits={llm_cache.hits} misses={llm_cache.misses}")
+        await message_log.close()
+        await counters.close()
+        await storage.close()
+        if sql_trace.ENABLED:
+            sql_trace.tracer.dump()
+            sql_trace.tracer.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
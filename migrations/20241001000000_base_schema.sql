@@ -0,0 +1,36 @@
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    text TEXT,
+    created_at INTEGER NOT NULL,
+    message_id INTEGER
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+USING fts5(text, content='messages', content_rowid='id', tokenize='unicode61');
+
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+END;
+
+-- таблица пользователей для кликабельных имён в саммари
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    display_name TEXT,
+    username TEXT
+);
+
+CREATE TABLE IF NOT EXISTS last_summary (
+    chat_id INTEGER PRIMARY KEY,
+    message_id INTEGER,
+    created_at INTEGER
+);
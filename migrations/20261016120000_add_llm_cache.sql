@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER NOT NULL,
+    last_used_at INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used_at
+    ON llm_cache (last_used_at);
+
+CREATE INDEX IF NOT EXISTS idx_llm_cache_expires_at
+    ON llm_cache (expires_at);
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS summary_chunks (
+    chat_id INTEGER NOT NULL,
+    start_id INTEGER NOT NULL,
+    end_id INTEGER NOT NULL,
+    msg_count INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, start_id)
+);
@@ -0,0 +1,18 @@
+-- лента чата: WHERE chat_id=? ORDER BY id DESC (id входит в индекс как rowid)
+CREATE INDEX IF NOT EXISTS idx_messages_chat
+    ON messages (chat_id);
+
+-- reply_to_mention: MAX(id) по (chat_id, message_id)
+CREATE INDEX IF NOT EXISTS idx_messages_chat_message_id
+    ON messages (chat_id, message_id);
+
+-- get_user_messages: по user_id или, для старых записей, по username
+CREATE INDEX IF NOT EXISTS idx_messages_chat_user
+    ON messages (chat_id, user_id);
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat_username
+    ON messages (chat_id, username);
+
+-- resolve_target_user, /ach_reset: LOWER(username)=LOWER(?)
+CREATE INDEX IF NOT EXISTS idx_users_username_lower
+    ON users (LOWER(username));
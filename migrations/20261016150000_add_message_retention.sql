@@ -0,0 +1,14 @@
+-- NULL — значение по умолчанию из RETENTION_DAYS / RETENTION_ROWS, 0 — без ограничения
+CREATE TABLE IF NOT EXISTS chat_retention (
+    chat_id INTEGER PRIMARY KEY,
+    keep_days INTEGER,
+    keep_rows INTEGER
+);
+
+-- сколько сообщений чата ушло в архивные файлы и до какого messages.id
+CREATE TABLE IF NOT EXISTS message_archive (
+    chat_id INTEGER PRIMARY KEY,
+    archived_to INTEGER NOT NULL,
+    archived_rows INTEGER NOT NULL DEFAULT 0,
+    updated_at INTEGER NOT NULL
+);
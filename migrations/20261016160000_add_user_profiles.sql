@@ -0,0 +1,28 @@
+-- профиль автора, обновляется при записи каждой пачки сообщений (utils/profiles.py)
+-- hours — JSON-массив из 24 счетчиков, vocab/phrases — JSON-объекты «слово → частота»
+CREATE TABLE IF NOT EXISTS user_profiles (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    chars INTEGER NOT NULL DEFAULT 0,
+    words INTEGER NOT NULL DEFAULT 0,
+    questions INTEGER NOT NULL DEFAULT 0,
+    exclaims INTEGER NOT NULL DEFAULT 0,
+    emoji INTEGER NOT NULL DEFAULT 0,
+    links INTEGER NOT NULL DEFAULT 0,
+    hours TEXT NOT NULL,
+    vocab TEXT NOT NULL,
+    phrases TEXT NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+
+-- последний портрет /lord_psych и число сообщений профиля на момент генерации
+CREATE TABLE IF NOT EXISTS psych_portraits (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    messages_at INTEGER NOT NULL,
+    portrait TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
@@ -0,0 +1,13 @@
+-- состояние лимитов utils/cooldowns.RateLimits, сбрасывается периодически для переживания перезапуска
+-- state — JSON: метки времени скользящего окна или [уровень, время] ведра токенов
+CREATE TABLE IF NOT EXISTS rate_limit_state (
+    scope TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    user_key INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    expires_at INTEGER NOT NULL,
+    PRIMARY KEY (scope, chat_id, user_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limit_state_expires_at
+    ON rate_limit_state (expires_at);
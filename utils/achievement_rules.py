@@ -0,0 +1,115 @@
+"""Compiled, in-memory view of the ``achievements`` table.
+
+Rows are parsed once into :class:`Rule` objects and indexed by metric and by
+condition type, so the per-message hot path does dictionary lookups instead of
+``SELECT`` + ``json.loads`` for every event.
+"""
+import json
+import sqlite3
+from dataclasses import dataclass, field
+from typing import Optional
+
+from utils.keyword_matcher import KeywordMatcher, Pattern
+
+SELECT_ACTIVE_SQL = """
+    SELECT COALESCE(id,rowid) AS id, code, title, description, kind, condition_type, metric,
+           thresholds, target_ts, extra_json
+    FROM achievements
+    WHERE active=1
+    ORDER BY id;
+"""
+
+
+@dataclass(frozen=True)
+class Rule:
+    id: int
+    code: str
+    title: str
+    description: str
+    kind: str
+    condition_type: str
+    metric: str
+    thresholds: tuple[int, ...] = ()
+    target_ts: Optional[int] = None
+    keyword: Optional[str] = None
+    # keyword: только целое слово / считать каждое вхождение, а не одно на сообщение
+    whole_word: bool = False
+    count_all: bool = False
+
+
+@dataclass(frozen=True)
+class RuleRegistry:
+    rules: tuple[Rule, ...] = ()
+    by_metric: dict[str, tuple[Rule, ...]] = field(default_factory=dict)
+    by_condition: dict[str, tuple[Rule, ...]] = field(default_factory=dict)
+    by_id: dict[int, Rule] = field(default_factory=dict)
+    # автомат по всем активным keyword-правилам, ключи — id ачивок
+    keywords: KeywordMatcher = field(default_factory=lambda: KeywordMatcher(()))
+
+    def for_metric(self, metric: str) -> tuple[Rule, ...]:
+        return self.by_metric.get(metric, ())
+
+    def for_condition(self, condition_type: str) -> tuple[Rule, ...]:
+        return self.by_condition.get(condition_type, ())
+
+
+def _parse_thresholds(raw: Optional[str]) -> tuple[int, ...]:
+    if not raw:
+        return ()
+    try:
+        return tuple(sorted({int(v) for v in json.loads(raw)}))
+    except Exception:
+        return ()
+
+
+def _parse_extra(raw: Optional[str]) -> dict:
+    if not raw:
+        return {}
+    try:
+        extra = json.loads(raw)
+    except Exception:
+        return {}
+    return extra if isinstance(extra, dict) else {}
+
+
+def compile_rule(row: tuple) -> Rule:
+    aid, code, title, desc, kind, ctype, metric, thresholds_json, target_ts, extra_json = row
+    extra = _parse_extra(extra_json) if ctype == "keyword" else {}
+    return Rule(
+        id=int(aid),
+        code=code,
+        title=title,
+        description=desc,
+        kind=kind,
+        condition_type=ctype,
+        metric=metric,
+        thresholds=_parse_thresholds(thresholds_json),
+        target_ts=int(target_ts) if target_ts else None,
+        keyword=extra.get("keyword") or None,
+        whole_word=bool(extra.get("whole_word")),
+        count_all=bool(extra.get("count_all")),
+    )
+
+
+def compile_registry(rows: list[tuple]) -> RuleRegistry:
+    rules = tuple(compile_rule(row) for row in rows)
+    by_metric: dict[str, list[Rule]] = {}
+    by_condition: dict[str, list[Rule]] = {}
+    for rule in rules:
+        by_metric.setdefault(rule.metric, []).append(rule)
+        by_condition.setdefault(rule.condition_type, []).append(rule)
+    return RuleRegistry(
+        rules=rules,
+        by_metric={k: tuple(v) for k, v in by_metric.items()},
+        by_condition={k: tuple(v) for k, v in by_condition.items()},
+        by_id={rule.id: rule for rule in rules},
+        keywords=KeywordMatcher(
+            Pattern(rule.id, rule.keyword, rule.whole_word)
+            for rule in by_condition.get("keyword", ())
+            if rule.keyword
+        ),
+    )
+
+
+def load_registry_conn(conn: sqlite3.Connection) -> RuleRegistry:
+    return compile_registry(conn.execute(SELECT_ACTIVE_SQL).fetchall())
@@ -0,0 +1,190 @@
+"""Prompt context for mention, thread and interjection replies.
+
+Instead of the last dozen messages whatever they are about, the context is a
+few recent messages plus the older messages most relevant to the triggering
+text.  Relevance comes from ``messages_fts``: the message's content words are
+searched as rough stems (``корма`` → ``корм*``) and ranked by ``bm25``.
+Lines are de-duplicated and cut to a character budget, so the prompt does not
+grow.  Both queries run in one job on the storage read pool.
+"""
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+from utils import storage
+
+RECENT = int(os.getenv("CONTEXT_RECENT", "6"))
+RELATED = int(os.getenv("CONTEXT_RELATED", "6"))
+BUDGET_CHARS = int(os.getenv("CONTEXT_BUDGET_CHARS", "2400"))
+MAX_LINE_CHARS = int(os.getenv("CONTEXT_MAX_LINE_CHARS", "300"))
+# сколько ближайших сообщений гарантированно попадают в контекст, даже в ущерб найденным
+MIN_RECENT = 3
+MAX_TERMS = 8
+
+_WORD_RE = re.compile(r"\w{3,}")
+_SPACE_RE = re.compile(r"\s+")
+
+STOPWORDS = frozenset(
+    """
+    это эта этот эти тот там тут так как что чтобы кто где когда зачем почему какой какая какие
+    или если уже еще ещё вот вон все всё всех для при про без над под после перед через между
+    только тоже также потом очень может можно нужно надо было были будет есть нет даже либо
+    меня тебя себя него нее неё них нас вас мне тебе ему ей им нам вам мой моя мои твой твоя
+    она они оно его ее её их наш ваш свой сам сама сами чем тем том тех этом этой этих
+    the and for are but not you your with this that have was what when where who why how
+    """.split()
+)
+
+
+class Line(NamedTuple):
+    id: int
+    username: Optional[str]
+    text: str
+    created_at: int
+
+
+class Context(NamedTuple):
+    recent: list[Line]
+    related: list[Line]
+
+    def render(self) -> str:
+        blocks = []
+        if self.related:
+            lines = "\n".join(f"[{_day(line.created_at)}] {_line(line)}" for line in self.related)
+            blocks.append(f"Из прошлых обсуждений (по теме сообщения):\n{lines}")
+        if self.recent:
+            blocks.append("Недавний контекст:\n" + "\n".join(_line(line) for line in self.recent))
+        return "\n\n".join(blocks)
+
+
+def _day(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%d.%m.%Y")
+
+
+def _clip(text: str, limit: int = MAX_LINE_CHARS) -> str:
+    text = _SPACE_RE.sub(" ", text or "").strip()
+    return text if len(text) <= limit else text[: limit - 1].rstrip() + "…"
+
+
+def _line(line: Line) -> str:
+    return f"{('@' + line.username) if line.username else 'user'}: {line.text}"
+
+
+def terms(text: str, exclude: tuple[str, ...] = ()) -> list[str]:
+    """Content words of ``text`` as FTS5 prefix terms, longest first."""
+    skip = {word.lower() for word in exclude}
+    words = {w.lower() for w in _WORD_RE.findall(text or "") if not w.isdigit()}
+    words = sorted((w for w in words if w not in STOPWORDS and w not in skip), key=len, reverse=True)
+    # грубый стемминг: отрезаем окончание, чтобы «корма» находило «корм» и «кормить»
+    stems = []
+    for word in words:
+        stem = word[: max(3, len(word) - 2)] if len(word) > 3 else word
+        if stem not in stems:
+            stems.append(stem)
+    return [f'"{stem}"*' for stem in stems[:MAX_TERMS]]
+
+
+def _context_conn(
+    conn: sqlite3.Connection,
+    chat_id: int,
+    query_text: str,
+    anchor_message_id: Optional[int],
+    exclude_terms: tuple[str, ...],
+    recent: int,
+    related: int,
+) -> tuple[list[tuple], list[tuple]]:
+    if anchor_message_id is not None:
+        recent_rows = conn.execute(
+            "SELECT id, username, text, created_at FROM messages WHERE chat_id=? AND text IS NOT NULL AND id<=("
+            "SELECT MAX(id) FROM messages WHERE chat_id=? AND message_id=?) ORDER BY id DESC LIMIT ?;",
+            (chat_id, chat_id, anchor_message_id, recent),
+        ).fetchall()
+    else:
+        recent_rows = []
+    if not recent_rows:
+        recent_rows = conn.execute(
+            "SELECT id, username, text, created_at FROM messages WHERE chat_id=? AND text IS NOT NULL "
+            "ORDER BY id DESC LIMIT ?;",
+            (chat_id, recent),
+        ).fetchall()
+
+    match = " OR ".join(terms(query_text, exclude_terms))
+    if not match or related <= 0:
+        return recent_rows, []
+    # только то, что старше недавнего окна; берём с запасом под дедупликацию
+    before_id = min((row[0] for row in recent_rows), default=None)
+    related_rows = conn.execute(
+        "SELECT m.id, m.username, m.text, m.created_at FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH ? AND m.chat_id=? AND m.id<? ORDER BY bm25(messages_fts) LIMIT ?;",
+        (match, chat_id, before_id if before_id is not None else 2**63 - 1, related * 3),
+    ).fetchall()
+    return recent_rows, related_rows
+
+
+def fit(
+    recent_rows: list[tuple],
+    related_rows: list[tuple],
+    *,
+    related: int = RELATED,
+    budget: int = BUDGET_CHARS,
+) -> Context:
+    """De-duplicate and cut rows to ``budget`` characters.
+
+    ``recent_rows`` come newest first, ``related_rows`` best match first.  The
+    newest ``MIN_RECENT`` messages always go in, then the best matches, then
+    the rest of the recent window while the budget lasts.
+    """
+    seen: set[str] = set()
+    used = 0
+
+    def take(row: tuple) -> Optional[Line]:
+        nonlocal used
+        text = _clip(row[2])
+        key = text.lower()
+        if len(key) < 2 or key.startswith("/") or key in seen:
+            return None
+        cost = len(text) + len(row[1] or "user") + 3
+        if used + cost > budget:
+            return None
+        seen.add(key)
+        used += cost
+        return Line(row[0], row[1], text, row[3])
+
+    picked_recent = [line for line in map(take, recent_rows[:MIN_RECENT]) if line]
+    picked_related: list[Line] = []
+    for row in related_rows:
+        if len(picked_related) >= related:
+            break
+        line = take(row)
+        if line:
+            picked_related.append(line)
+    picked_recent += [line for line in map(take, recent_rows[MIN_RECENT:]) if line]
+
+    picked_recent.sort(key=lambda line: line.id)
+    picked_related.sort(key=lambda line: line.id)
+    return Context(picked_recent, picked_related)
+
+
+async def build(
+    chat_id: int,
+    query_text: str,
+    *,
+    anchor_message_id: Optional[int] = None,
+    exclude_terms: tuple[str, ...] = (),
+    recent: int = RECENT,
+    related: int = RELATED,
+    budget: int = BUDGET_CHARS,
+) -> Context:
+    """Recent messages (up to ``anchor_message_id`` if given) plus older ones relevant to ``query_text``."""
+    try:
+        recent_rows, related_rows = await storage.read(
+            _context_conn, chat_id, query_text, anchor_message_id, exclude_terms, recent, related
+        )
+    except sqlite3.OperationalError as err:
+        # поврежденный или недостроенный FTS-индекс не должен лишать бота ответа
+        print(f"[CONTEXT] Retrieval failed, using recent messages only: {err}")
+        recent_rows = await storage.read(_context_conn, chat_id, "", anchor_message_id, (), recent, 0)
+        related_rows = []
+    return fit(recent_rows, related_rows, related=related, budget=budget)
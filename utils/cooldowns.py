@@ -1,14 +1,44 @@
+"""Cooldowns and rate limits, kept in memory.
+
+Cooldowns: active entries live in a dict keyed by ``(scope, chat_id,
+user_key)``, so a check is one lookup and never touches SQLite.  A heap
+ordered by expiry drops entries lazily as they run out.  ``bot_cooldowns``
+only exists so that cooldowns survive a restart: every set is written
+through, and :func:`load_cooldowns` reads the table once at startup and
+removes rows that expired while the bot was down.
+
+Rate limits: each scope declares one policy in :data:`rate_limits`.  A
+:class:`Window` allows ``limit`` hits per sliding ``seconds``; a
+:class:`Bucket` allows bursts of ``capacity`` and refills one hit every
+``refill_sec``.  ``per`` chooses whether the counter is per user or per chat.
+:meth:`RateLimits.hit` is amortised O(1): a window keeps at most ``limit``
+timestamps and drops old ones from the left, and a bucket is two numbers.
+Changed state is flushed to ``rate_limit_state`` every
+``RATE_LIMIT_FLUSH_SEC`` and read back at startup.
+"""
+import asyncio
+import heapq
+import json
 import os
 import sqlite3
-from contextlib import closing
+import time
+from collections import deque
 from datetime import datetime, timezone
-from typing import Optional
+from typing import NamedTuple, Optional, Union
+
+from utils import metrics, storage
+
+RATE_LIMIT_FLUSH_SEC = float(os.getenv("RATE_LIMIT_FLUSH_SEC", "60"))
 
-DB = os.getenv("DB_PATH", "bot.sqlite3")
+COOLDOWN_CHECKS = metrics.counter("cooldown_checks_total", "Cooldown lookups by scope and result.", ("scope", "result"))
+RATE_LIMIT_HITS = metrics.counter("rate_limit_hits_total", "Rate-limited actions by scope and result.", ("scope", "result"))
 
+UPSERT_SQL = (
+    "INSERT INTO bot_cooldowns(scope, chat_id, user_id, user_key, expires_at) VALUES(?, ?, ?, ?, ?) "
+    "ON CONFLICT(scope, chat_id, user_key) DO UPDATE SET expires_at=excluded.expires_at;"
+)
 
-def _conn() -> sqlite3.Connection:
-    return sqlite3.connect(DB)
+Key = tuple[str, int, int]
 
 
 def _now_ts() -> int:
@@ -19,37 +49,263 @@ def _user_key(user_id: Optional[int]) -> int:
     return int(user_id) if user_id is not None else 0
 
 
-def set_cooldown(scope: str, chat_id: int, user_id: Optional[int], ttl_sec: int) -> None:
-    expires_at = _now_ts() + max(0, int(ttl_sec))
-    with closing(_conn()) as conn:
-        conn.execute(
-            """
-            INSERT INTO bot_cooldowns(scope, chat_id, user_id, user_key, expires_at)
-            VALUES(?, ?, ?, ?, ?)
-            ON CONFLICT(scope, chat_id, user_key) DO UPDATE SET expires_at=excluded.expires_at
-            """,
-            (scope, chat_id, user_id, _user_key(user_id), expires_at),
+class CooldownStore:
+    def __init__(self) -> None:
+        self._expires: dict[Key, int] = {}
+        # (expires_at, key); устаревшие записи (после продления) пропускаются при выталкивании
+        self._heap: list[tuple[int, Key]] = []
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+    def _expire(self, now: int) -> int:
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._heap)
+            if self._expires.get(key) == expires_at:
+                del self._expires[key]
+                removed += 1
+        return removed
+
+    def _put(self, key: Key, expires_at: int) -> None:
+        self._expires[key] = expires_at
+        heapq.heappush(self._heap, (expires_at, key))
+
+    def remaining(self, scope: str, chat_id: int, user_id: Optional[int], now: Optional[int] = None) -> int:
+        """Seconds left on the cooldown, 0 if none is active."""
+        now = _now_ts() if now is None else now
+        self._expire(now)
+        expires_at = self._expires.get((scope, chat_id, _user_key(user_id)))
+        return expires_at - now if expires_at is not None and expires_at > now else 0
+
+    def active(self, scope: str, chat_id: int, user_id: Optional[int]) -> bool:
+        return self.remaining(scope, chat_id, user_id) > 0
+
+    async def set(self, scope: str, chat_id: int, user_id: Optional[int], ttl_sec: int) -> None:
+        expires_at = _now_ts() + max(0, int(ttl_sec))
+        user_key = _user_key(user_id)
+        self._put((scope, chat_id, user_key), expires_at)
+        await storage.execute(UPSERT_SQL, (scope, chat_id, user_id, user_key, expires_at))
+
+    async def load(self) -> int:
+        """Replace the in-memory state with the live rows of ``bot_cooldowns``; return their count."""
+        now = _now_ts()
+        await storage.execute("DELETE FROM bot_cooldowns WHERE expires_at <= ?;", (now,))
+        rows = await storage.fetch(
+            "SELECT scope, chat_id, user_key, expires_at FROM bot_cooldowns WHERE expires_at > ?;", (now,)
         )
-        conn.commit()
-
-
-def is_on_cooldown(scope: str, chat_id: int, user_id: Optional[int]) -> bool:
-    now = _now_ts()
-    with closing(_conn()) as conn:
-        cur = conn.execute(
-            """
-            SELECT 1 FROM bot_cooldowns
-            WHERE scope=? AND chat_id=? AND user_key=? AND expires_at > ?
-            LIMIT 1;
-            """,
-            (scope, chat_id, _user_key(user_id), now),
+        self._expires.clear()
+        self._heap.clear()
+        for scope, chat_id, user_key, expires_at in rows:
+            self._put((scope, chat_id, user_key), expires_at)
+        return len(rows)
+
+
+cooldowns = CooldownStore()
+
+metrics.gauge("cooldowns_active", "Cooldowns held in memory.", fn=lambda: len(cooldowns))
+
+
+async def set_cooldown(scope: str, chat_id: int, user_id: Optional[int], ttl_sec: int) -> None:
+    await cooldowns.set(scope, chat_id, user_id, ttl_sec)
+
+
+async def is_on_cooldown(scope: str, chat_id: int, user_id: Optional[int]) -> bool:
+    active = cooldowns.active(scope, chat_id, user_id)
+    COOLDOWN_CHECKS.inc(scope=scope, result="active" if active else "clear")
+    return active
+
+
+async def load_cooldowns() -> int:
+    return await cooldowns.load()
+
+
+# ---- лимиты частоты
+class Window(NamedTuple):
+    limit: int
+    seconds: int
+    per: str = "user"
+
+
+class Bucket(NamedTuple):
+    capacity: float
+    refill_sec: float
+    per: str = "user"
+
+
+Policy = Union[Window, Bucket]
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    # через сколько секунд попытка пройдёт
+    retry_after: int = 0
+
+
+class _WindowState:
+    __slots__ = ("hits",)
+
+    def __init__(self, limit: int, hits=()):
+        self.hits: deque = deque(hits, maxlen=limit)
+
+    def hit(self, policy: Window, now: float) -> Decision:
+        cutoff = now - policy.seconds
+        while self.hits and self.hits[0] <= cutoff:
+            self.hits.popleft()
+        if len(self.hits) >= policy.limit:
+            return Decision(False, max(1, int(self.hits[0] - cutoff + 0.999)))
+        self.hits.append(now)
+        return Decision(True)
+
+    def expires_at(self, policy: Window) -> float:
+        return self.hits[-1] + policy.seconds if self.hits else 0
+
+    def dump(self) -> list:
+        return [round(ts, 3) for ts in self.hits]
+
+
+class _BucketState:
+    __slots__ = ("level", "updated")
+
+    def __init__(self, level: float, updated: float):
+        self.level = level
+        self.updated = updated
+
+    def hit(self, policy: Bucket, now: float) -> Decision:
+        self.level = min(policy.capacity, self.level + (now - self.updated) / policy.refill_sec)
+        self.updated = now
+        if self.level < 1:
+            return Decision(False, max(1, int((1 - self.level) * policy.refill_sec + 0.999)))
+        self.level -= 1
+        return Decision(True)
+
+    def expires_at(self, policy: Bucket) -> float:
+        # к этому моменту ведро снова полное — состояние можно забыть
+        return self.updated + (policy.capacity - self.level) * policy.refill_sec
+
+    def dump(self) -> list:
+        return [round(self.level, 4), round(self.updated, 3)]
+
+
+def _new_state(policy: Policy, now: float):
+    if isinstance(policy, Window):
+        return _WindowState(policy.limit)
+    return _BucketState(policy.capacity, now)
+
+
+def _restore_state(policy: Policy, raw: list):
+    if isinstance(policy, Window):
+        return _WindowState(policy.limit, sorted(raw))
+    level, updated = raw
+    return _BucketState(min(level, policy.capacity), updated)
+
+
+def _flush_conn(conn: sqlite3.Connection, rows: list[tuple], stale: list[tuple], now: int) -> None:
+    conn.executemany(
+        "INSERT INTO rate_limit_state(scope, chat_id, user_key, state, expires_at) VALUES(?, ?, ?, ?, ?) "
+        "ON CONFLICT(scope, chat_id, user_key) DO UPDATE SET state=excluded.state, expires_at=excluded.expires_at;",
+        rows,
+    )
+    conn.executemany("DELETE FROM rate_limit_state WHERE scope=? AND chat_id=? AND user_key=?;", stale)
+    conn.execute("DELETE FROM rate_limit_state WHERE expires_at <= ?;", (now,))
+
+
+class RateLimits:
+    def __init__(self) -> None:
+        self.policies: dict[str, Policy] = {}
+        self._states: dict[Key, object] = {}
+        self._dirty: set[Key] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def declare(self, scope: str, policy: Policy) -> None:
+        if policy.per not in ("user", "chat"):
+            raise ValueError(f"per must be 'user' or 'chat', got {policy.per!r}")
+        self.policies[scope] = policy
+
+    def declare_all(self, policies: dict[str, Policy]) -> None:
+        for scope, policy in policies.items():
+            self.declare(scope, policy)
+
+    def _key(self, scope: str, policy: Policy, chat_id: int, user_id: Optional[int]) -> Key:
+        return (scope, chat_id, _user_key(user_id) if policy.per == "user" else 0)
+
+    def hit(self, scope: str, chat_id: int, user_id: Optional[int], now: Optional[float] = None) -> Decision:
+        """Count one action under ``scope`` if the policy allows it; otherwise say when to retry."""
+        policy = self.policies[scope]
+        now = time.time() if now is None else now
+        key = self._key(scope, policy, chat_id, user_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _new_state(policy, now)
+        decision = state.hit(policy, now)
+        if decision.allowed:
+            self._dirty.add(key)
+        RATE_LIMIT_HITS.inc(scope=scope, result="allowed" if decision.allowed else "limited")
+        return decision
+
+    # ---- сохранение
+    async def load(self) -> int:
+        """Restore state saved by the previous run; rows of undeclared scopes are ignored."""
+        now = time.time()
+        rows = await storage.fetch(
+            "SELECT scope, chat_id, user_key, state FROM rate_limit_state WHERE expires_at > ?;", (int(now),)
         )
-        return cur.fetchone() is not None
+        self._states.clear()
+        for scope, chat_id, user_key, raw in rows:
+            policy = self.policies.get(scope)
+            if policy is None:
+                continue
+            try:
+                self._states[(scope, chat_id, user_key)] = _restore_state(policy, json.loads(raw))
+            except (TypeError, ValueError):
+                continue
+        return len(self._states)
+
+    async def flush(self) -> int:
+        now = time.time()
+        rows, stale = [], []
+        for key in list(self._dirty):
+            state = self._states.get(key)
+            policy = self.policies.get(key[0])
+            if state is not None and policy is not None:
+                rows.append((*key, json.dumps(state.dump()), int(state.expires_at(policy)) + 1))
+        # состояния, которые уже ничего не ограничивают, выбрасываем и из памяти
+        for key, state in list(self._states.items()):
+            policy = self.policies.get(key[0])
+            if policy is None or state.expires_at(policy) <= now:
+                del self._states[key]
+                stale.append(key)
+        self._dirty.clear()
+        if rows or stale:
+            await storage.write(_flush_conn, rows, stale, int(now))
+        return len(rows)
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as err:
+                print(f"[RATELIMIT] Flush failed: {err}")
+
+    def start(self, interval: float = RATE_LIMIT_FLUSH_SEC) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
 
+rate_limits = RateLimits()
 
-def clear_expired_cooldowns() -> int:
-    now = _now_ts()
-    with closing(_conn()) as conn:
-        cur = conn.execute("DELETE FROM bot_cooldowns WHERE expires_at <= ?;", (now,))
-        conn.commit()
-        return cur.rowcount
+metrics.gauge("rate_limit_keys", "Rate-limit counters held in memory.", fn=lambda: len(rate_limits))
@@ -0,0 +1,192 @@
+"""Write-back cache for per-user counters.
+
+Counters (``user_stats.messages_count``, ``user_metrics.count`` and
+``achievement_progress.progress``) are read from SQLite once, then served and
+incremented in memory.  Accumulated deltas are flushed periodically with one
+``executemany`` upsert per table, all in a single transaction.
+"""
+import asyncio
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Optional
+
+from utils import metrics, storage
+
+FLUSH_INTERVAL_SEC = float(os.getenv("COUNTERS_FLUSH_SEC", "2"))
+# сколько «чистых» значений держим в памяти, прежде чем начать их выбрасывать
+MAX_CACHED = int(os.getenv("COUNTERS_MAX_CACHED", "100000"))
+
+Key = tuple
+
+
+def _now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+class CounterTable:
+    def __init__(
+        self,
+        table: str,
+        key_cols: tuple[str, ...],
+        value_col: str,
+        *,
+        updated_col: Optional[str] = None,
+    ):
+        self.table = table
+        self.key_cols = key_cols
+        self.value_col = value_col
+        self.updated_col = updated_col
+        self._values: dict[Key, int] = {}
+        self._pending: dict[Key, int] = {}
+
+        where = " AND ".join(f"{col}=?" for col in key_cols)
+        self._select_sql = f"SELECT {value_col} FROM {table} WHERE {where} LIMIT 1;"
+        cols = [*key_cols, value_col]
+        update = f"{value_col}={value_col}+excluded.{value_col}"
+        if updated_col:
+            cols.append(updated_col)
+            update += f", {updated_col}=excluded.{updated_col}"
+        self._upsert_sql = (
+            f"INSERT INTO {table}({', '.join(cols)}) VALUES({', '.join('?' for _ in cols)}) "
+            f"ON CONFLICT({', '.join(key_cols)}) DO UPDATE SET {update};"
+        )
+
+    @property
+    def dirty(self) -> int:
+        return len(self._pending)
+
+    async def get(self, key: Key) -> int:
+        value = self._values.get(key)
+        if value is not None:
+            return value
+        row = await storage.fetchone(self._select_sql, key)
+        loaded = int(row[0]) if row and row[0] is not None else 0
+        # пока шёл SELECT, значение мог загрузить кто-то ещё — оно свежее
+        return self._values.setdefault(key, loaded)
+
+    async def incr(self, key: Key, delta: int = 1) -> int:
+        if delta <= 0:
+            return await self.get(key)
+        start()
+        value = await self.get(key) + delta
+        self._values[key] = value
+        self._pending[key] = self._pending.get(key, 0) + delta
+        return value
+
+    def forget(self, match: Callable[[Key], bool]) -> None:
+        """Drop cached values and unflushed deltas for keys matching ``match``."""
+        for key in [k for k in self._values if match(k)]:
+            self._values.pop(key, None)
+            self._pending.pop(key, None)
+
+    def clear(self) -> None:
+        self._values.clear()
+        self._pending.clear()
+
+    def take_pending(self) -> dict[Key, int]:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore_pending(self, pending: dict[Key, int]) -> None:
+        for key, delta in pending.items():
+            if key in self._values:
+                self._pending[key] = self._pending.get(key, 0) + delta
+
+    def trim(self) -> None:
+        overflow = len(self._values) - MAX_CACHED
+        if overflow <= 0:
+            return
+        for key in [k for k in self._values if k not in self._pending][:overflow]:
+            del self._values[key]
+
+    def rows(self, pending: dict[Key, int], now: int) -> list[tuple]:
+        if self.updated_col:
+            return [(*key, delta, now) for key, delta in pending.items()]
+        return [(*key, delta) for key, delta in pending.items()]
+
+    def flush_conn(self, conn: sqlite3.Connection, rows: list[tuple]) -> None:
+        conn.execute("SAVEPOINT counters;")
+        try:
+            conn.executemany(self._upsert_sql, rows)
+        except sqlite3.IntegrityError:
+            # например, ачивку удалили, а дельта по ней ещё висела в памяти:
+            # откатываем пачку и пишем построчно, пропуская битые строки
+            conn.execute("ROLLBACK TO counters;")
+            for row in rows:
+                try:
+                    conn.execute(self._upsert_sql, row)
+                except sqlite3.IntegrityError as err:
+                    print(f"[COUNTERS] Dropped {self.table} delta {row}: {err}")
+        conn.execute("RELEASE counters;")
+
+
+user_stats = CounterTable("user_stats", ("chat_id", "user_id"), "messages_count")
+user_metrics = CounterTable(
+    "user_metrics", ("chat_id", "user_id", "metric"), "count", updated_col="updated_at"
+)
+achievement_progress = CounterTable(
+    "achievement_progress", ("chat_id", "user_id", "achievement_id"), "progress", updated_col="updated_at"
+)
+TABLES: tuple[CounterTable, ...] = (user_stats, user_metrics, achievement_progress)
+
+metrics.gauge("counters_dirty", "Counter rows changed in memory and not yet flushed.", fn=lambda: sum(t.dirty for t in TABLES))
+
+
+def _flush_conn(conn: sqlite3.Connection, batches: Iterable[tuple[CounterTable, list[tuple]]]) -> None:
+    for table, rows in batches:
+        table.flush_conn(conn, rows)
+
+
+_lock: Optional[asyncio.Lock] = None
+_task: Optional[asyncio.Task] = None
+
+
+async def flush() -> None:
+    """Persist all accumulated deltas in one transaction."""
+    global _lock
+    _lock = _lock or asyncio.Lock()
+    async with _lock:
+        taken = [(table, table.take_pending()) for table in TABLES]
+        taken = [(table, pending) for table, pending in taken if pending]
+        if not taken:
+            return
+        now = _now_ts()
+        try:
+            await storage.write(_flush_conn, [(table, table.rows(pending, now)) for table, pending in taken])
+        except Exception:
+            for table, pending in taken:
+                table.restore_pending(pending)
+            raise
+        for table in TABLES:
+            table.trim()
+
+
+async def _run(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush()
+        except Exception as err:
+            print(f"[COUNTERS] Flush failed, will retry: {err}")
+
+
+def start(interval: float = FLUSH_INTERVAL_SEC) -> None:
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_run(interval), name="counters-flusher")
+
+
+async def close() -> None:
+    global _task
+    task, _task = _task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    try:
+        await flush()
+    except Exception as err:
+        print(f"[COUNTERS] Final flush failed: {err}")
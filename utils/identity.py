@@ -0,0 +1,64 @@
+"""Cached identity of the running bot.
+
+``bot.get_me()`` is resolved once at startup and then refreshed in the
+background, so message handlers never wait on a Telegram round trip just to
+learn the bot's own id/username.
+"""
+import asyncio
+import os
+import re
+from typing import Optional
+
+from aiogram import Bot
+
+REFRESH_INTERVAL_SEC = int(os.getenv("BOT_IDENTITY_REFRESH_SEC", "3600"))
+
+
+class BotIdentity:
+    def __init__(self) -> None:
+        self.id: Optional[int] = None
+        self.username: Optional[str] = None
+        self._mention_re: Optional[re.Pattern[str]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _set(self, bot_id: int, username: Optional[str]) -> None:
+        self.id = bot_id
+        if username != self.username or self._mention_re is None:
+            self.username = username
+            self._mention_re = (
+                re.compile(rf"(?<![\w@])@{re.escape(username)}(?!\w)", re.IGNORECASE)
+                if username else None
+            )
+
+    async def refresh(self, bot: Bot) -> None:
+        me = await bot.get_me()
+        self._set(me.id, me.username)
+
+    def is_mentioned(self, text: str) -> bool:
+        return bool(text and self._mention_re and self._mention_re.search(text))
+
+    def start(self, bot: Bot, interval: int = REFRESH_INTERVAL_SEC) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(
+                self._run(bot, interval), name="bot-identity-refresh"
+            )
+
+    async def _run(self, bot: Bot, interval: int) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh(bot)
+            except Exception as err:
+                print(f"[IDENTITY] Refresh failed, keeping @{self.username}: {err}")
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+identity = BotIdentity()
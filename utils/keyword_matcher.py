@@ -0,0 +1,101 @@
+"""Aho–Corasick multi-pattern matcher for keyword achievements.
+
+All active keywords are compiled into one automaton, so a message is scanned
+once no matter how many keyword achievements exist.  Text and patterns are
+normalised the same way: Unicode casefolding plus ``ё`` → ``е``.
+"""
+from collections import deque
+from typing import Hashable, Iterable, NamedTuple
+
+
+def normalize(text: str) -> str:
+    return text.casefold().replace("ё", "е")
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+class Pattern(NamedTuple):
+    key: Hashable
+    text: str
+    whole_word: bool = False
+
+
+class KeywordMatcher:
+    def __init__(self, patterns: Iterable[Pattern]):
+        self._patterns: list[Pattern] = []
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # для каждого состояния — индексы паттернов, которые в нём заканчиваются
+        self._out: list[list[int]] = [[]]
+        for pattern in patterns:
+            needle = normalize(pattern.text)
+            if needle:
+                self._add(Pattern(pattern.key, needle, pattern.whole_word))
+        self._build()
+
+    def __bool__(self) -> bool:
+        return bool(self._patterns)
+
+    def _add(self, pattern: Pattern) -> None:
+        state = 0
+        for ch in pattern.text:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(len(self._patterns))
+        self._patterns.append(pattern)
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def counts(self, text: str) -> dict[Hashable, int]:
+        """Return ``{key: occurrences}`` for every pattern found in ``text``.
+
+        Occurrences of the same pattern are counted without overlaps; patterns
+        with ``whole_word`` only match between non-word characters.
+        """
+        if not self._patterns or not text:
+            return {}
+        haystack = normalize(text)
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self._patterns
+        found: dict[Hashable, int] = {}
+        last_end: dict[int, int] = {}
+        state = 0
+        n = len(haystack)
+        for pos, ch in enumerate(haystack):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if not out[state]:
+                continue
+            end = pos + 1
+            for idx in out[state]:
+                pattern = patterns[idx]
+                start = end - len(pattern.text)
+                if start < last_end.get(idx, 0):
+                    continue
+                if pattern.whole_word and (
+                    (start > 0 and _is_word_char(haystack[start - 1]))
+                    or (end < n and _is_word_char(haystack[end]))
+                ):
+                    continue
+                last_end[idx] = end
+                found[pattern.key] = found.get(pattern.key, 0) + 1
+        return found
@@ -0,0 +1,96 @@
+"""Disk-backed cache of LLM completions.
+
+Entries live in the ``llm_cache`` table, keyed by a hash of model, temperature
+and both prompts.  Each call site passes a :class:`CachePolicy` that says how
+long its answers stay valid and whether replaying a sampled (temperature > 0)
+answer is acceptable.  The table is bounded by ``LLM_CACHE_MAX_ENTRIES``; the
+least recently used rows are evicted first.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+from utils import metrics, storage
+
+MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+# LLM_CACHE=0 — полностью отключить кэш (например, при отладке промптов)
+ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+
+LOOKUPS = metrics.counter("llm_cache_lookups_total", "LLM cache lookups by result.", ("result",))
+
+SELECT_SQL = "SELECT response FROM llm_cache WHERE key=? AND expires_at>? LIMIT 1;"
+TOUCH_SQL = "UPDATE llm_cache SET last_used_at=?, hits=hits+1 WHERE key=?;"
+UPSERT_SQL = (
+    "INSERT INTO llm_cache(key, model, response, created_at, expires_at, last_used_at) "
+    "VALUES(?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET response=excluded.response, created_at=excluded.created_at, "
+    "expires_at=excluded.expires_at, last_used_at=excluded.last_used_at;"
+)
+
+
+def _now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+class CachePolicy(NamedTuple):
+    ttl: int
+    # можно ли повторно отдавать ответ, полученный с temperature > 0
+    replay: bool = False
+
+
+def cache_key(model: str, temperature: float, system_prompt: str, user_prompt: str) -> str:
+    raw = json.dumps([model, round(float(temperature), 3), system_prompt, user_prompt], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _put_conn(conn: sqlite3.Connection, row: tuple, now: int, max_entries: int) -> None:
+    conn.execute(UPSERT_SQL, row)
+    conn.execute("DELETE FROM llm_cache WHERE expires_at<=?;", (now,))
+    (total,) = conn.execute("SELECT COUNT(*) FROM llm_cache;").fetchone()
+    overflow = total - max_entries
+    if overflow > 0:
+        conn.execute(
+            "DELETE FROM llm_cache WHERE key IN "
+            "(SELECT key FROM llm_cache ORDER BY last_used_at, rowid LIMIT ?);",
+            (overflow,),
+        )
+
+
+class LLMCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES, enabled: bool = ENABLED):
+        self.max_entries = max(1, max_entries)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def applies(self, policy: Optional[CachePolicy], temperature: float) -> bool:
+        if not self.enabled or policy is None or policy.ttl <= 0:
+            return False
+        return temperature == 0 or policy.replay
+
+    async def get(self, key: str) -> Optional[str]:
+        now = _now_ts()
+        row = await storage.fetchone(SELECT_SQL, (key, now))
+        if row is None:
+            self.misses += 1
+            LOOKUPS.inc(result="miss")
+            return None
+        self.hits += 1
+        LOOKUPS.inc(result="hit")
+        await storage.execute(TOUCH_SQL, (now, key))
+        return row[0]
+
+    async def put(self, key: str, model: str, response: str, ttl: int) -> None:
+        now = _now_ts()
+        row = (key, model, response, now, now + int(ttl), now)
+        await storage.write(_put_conn, row, now, self.max_entries)
+
+    async def stats(self) -> dict[str, int]:
+        row = await storage.fetchone("SELECT COUNT(*) FROM llm_cache WHERE expires_at>?;", (_now_ts(),))
+        return {"hits": self.hits, "misses": self.misses, "entries": row[0] if row else 0}
+
+
+llm_cache = LLMCache()
@@ -0,0 +1,222 @@
+"""Background queue for LLM-backed replies.
+
+Handlers no longer call the model themselves: they :meth:`JobQueue.submit`
+a producer (an async generator of text chunks) under a key such as
+``("summary", chat_id, 300)`` and stream :meth:`Job.chunks` into their own
+reply.  While a job with the same key is queued or running, a new request
+joins it, so five simultaneous ``/lord_summary`` commands cost one generation.
+
+``LLM_WORKERS`` workers take jobs by priority (commands first, random
+interjections last) and then in arrival order.  At most ``LLM_QUEUE_MAX``
+jobs wait; past that :meth:`JobQueue.submit` raises :class:`QueueFull`.  A job
+with ``max_wait`` that waited longer is dropped, because a late interjection
+is worse than none.
+"""
+import asyncio
+import itertools
+import os
+import time
+from typing import AsyncIterator, Callable, Hashable, Optional
+
+from utils import metrics
+
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "2"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "50"))
+
+# меньше — раньше
+PRIORITY_COMMAND = 0
+PRIORITY_REPLY = 1
+PRIORITY_INTERJECT = 2
+
+JOBS = metrics.counter(
+    "llm_jobs_total", "LLM jobs by kind and outcome (done, failed, joined, rejected, expired).", ("kind", "result")
+)
+WAIT_SECONDS = metrics.histogram("llm_job_wait_seconds", "Time LLM jobs spend queued.", ("kind",))
+RUN_SECONDS = metrics.histogram("llm_job_run_seconds", "Time LLM jobs spend generating.", ("kind",))
+
+Producer = Callable[[], AsyncIterator[str]]
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobExpired(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, key: Hashable, priority: int, seq: int, producer: Producer, max_wait: Optional[float]):
+        self.key = key
+        self.kind = str(key[0]) if isinstance(key, tuple) and key else str(key)
+        self.priority = priority
+        self.seq = seq
+        self.producer = producer
+        self.max_wait = max_wait
+        self.created = time.monotonic()
+        self.parts: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.waiters = 1
+        self._changed = asyncio.Event()
+
+    def __lt__(self, other: "Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def _notify(self) -> None:
+        # ожидающие держат ссылку на старое событие — будим их и заводим новое
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _push(self, chunk: str) -> None:
+        self.parts.append(chunk)
+        self._notify()
+
+    def _finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def chunks(self) -> AsyncIterator[str]:
+        """Everything generated so far, then new chunks as they arrive; re-raises the job's error."""
+        sent = 0
+        while True:
+            while sent < len(self.parts):
+                yield self.parts[sent]
+                sent += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+    async def result(self) -> str:
+        async for _ in self.chunks():
+            pass
+        return self.text
+
+
+class JobQueue:
+    def __init__(self, workers: int = LLM_WORKERS, max_pending: int = LLM_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self._pending: list[Job] = []
+        self._inflight: dict[Hashable, Job] = {}
+        self._running = 0
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def active(self, key: Hashable) -> Optional[Job]:
+        """The job queued or running under ``key``, if any."""
+        return self._inflight.get(key)
+
+    def position(self, job: Job) -> int:
+        """How many queued jobs run before ``job``; 0 once it is running or done."""
+        if job not in self._pending:
+            return 0
+        return sum(1 for other in self._pending if other < job)
+
+    def submit(
+        self,
+        key: Hashable,
+        producer: Producer,
+        *,
+        priority: int = PRIORITY_COMMAND,
+        max_wait: Optional[float] = None,
+    ) -> Job:
+        """Queue ``producer`` under ``key``, or join the job already queued or running under it."""
+        job = self._inflight.get(key)
+        if job is not None:
+            job.waiters += 1
+            # нетерпеливый фоновый запрос не должен тормозить присоединившуюся команду
+            if priority < job.priority and job in self._pending:
+                job.priority = priority
+            if max_wait is None:
+                job.max_wait = None
+            JOBS.inc(kind=job.kind, result="joined")
+            return job
+        job = Job(key, priority, next(self._seq), producer, max_wait)
+        if self._wake is None:
+            raise RuntimeError("JobQueue.start() was not called")
+        if len(self._pending) >= self.max_pending:
+            JOBS.inc(kind=job.kind, result="rejected")
+            raise QueueFull("Слишком много запросов к модели, попробуйте через минуту.")
+        self._inflight[key] = job
+        self._pending.append(job)
+        self._wake.set()
+        return job
+
+    async def _run_job(self, job: Job) -> None:
+        waited = time.monotonic() - job.created
+        WAIT_SECONDS.observe(waited, kind=job.kind)
+        if job.max_wait is not None and waited > job.max_wait:
+            JOBS.inc(kind=job.kind, result="expired")
+            job._finish(JobExpired(f"waited {waited:.1f}s"))
+            return
+        started = time.monotonic()
+        try:
+            async for chunk in job.producer():
+                job._push(chunk)
+        except asyncio.CancelledError:
+            job._finish(JobExpired("bot is shutting down"))
+            raise
+        except Exception as err:
+            JOBS.inc(kind=job.kind, result="failed")
+            job._finish(err)
+        else:
+            JOBS.inc(kind=job.kind, result="done")
+            job._finish()
+        finally:
+            RUN_SECONDS.observe(time.monotonic() - started, kind=job.kind)
+
+    async def _worker(self) -> None:
+        while True:
+            while not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+            # очередь короткая (LLM_QUEUE_MAX), а приоритет может подняться после постановки — берём минимум
+            job = min(self._pending)
+            self._pending.remove(job)
+            self._running += 1
+            try:
+                await self._run_job(job)
+            finally:
+                self._running -= 1
+                if self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"llm-worker-{i}") for i in range(self.workers)]
+
+    async def close(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in self._pending:
+            job._finish(JobExpired("bot is shutting down"))
+        self._pending.clear()
+        self._inflight.clear()
+        self._wake = None
+
+
+queue = JobQueue()
+
+metrics.gauge("llm_queue_depth", "LLM jobs waiting for a worker.", fn=lambda: queue.depth)
+metrics.gauge("llm_jobs_running", "LLM jobs being generated right now.", fn=lambda: queue.running)
@@ -0,0 +1,134 @@
+"""Write-behind logger for chat messages.
+
+``on_text`` only appends the row to an in-memory buffer; a background task
+flushes the buffer in one transaction every ``MESSAGE_LOG_FLUSH_MS``
+milliseconds or as soon as ``MESSAGE_LOG_BATCH`` rows are pending.  Readers
+that must see just-logged messages (summary, psych, mention replies) call
+:meth:`MessageLogger.flushed` first.  The same transaction folds the rows
+into the per-user profiles of :mod:`utils.profiles`.
+"""
+import asyncio
+import os
+from typing import Optional
+
+from utils import metrics, profiles, storage
+
+FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_LOG_FLUSH_MS", "250"))
+FLUSH_BATCH = int(os.getenv("MESSAGE_LOG_BATCH", "200"))
+# сколько строк держим в памяти, если база временно недоступна
+MAX_PENDING = int(os.getenv("MESSAGE_LOG_MAX_PENDING", "20000"))
+
+INSERT_MESSAGE_SQL = (
+    "INSERT INTO messages(chat_id, user_id, username, text, created_at, message_id) "
+    "VALUES (?, ?, ?, ?, ?, ?);"
+)
+UPSERT_USER_SQL = (
+    "INSERT INTO users(user_id, display_name, username) VALUES(?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET display_name=excluded.display_name, username=excluded.username;"
+)
+
+MessageRow = tuple[int, int, Optional[str], str, int, Optional[int]]
+UserRow = tuple[int, str, Optional[str]]
+
+
+def _flush_conn(conn, messages: list[MessageRow], users: list[UserRow]) -> None:
+    if messages:
+        conn.executemany(INSERT_MESSAGE_SQL, messages)
+        profiles.update_conn(conn, messages)
+    if users:
+        conn.executemany(UPSERT_USER_SQL, users)
+
+
+class MessageLogger:
+    def __init__(self, interval_ms: int = FLUSH_INTERVAL_MS, batch: int = FLUSH_BATCH):
+        self.interval = max(1, interval_ms) / 1000
+        self.batch = max(1, batch)
+        self._messages: list[MessageRow] = []
+        # карточки пользователей склеиваем по user_id — пишется последняя версия
+        self._users: dict[int, UserRow] = {}
+        self._lock: Optional[asyncio.Lock] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._messages)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._lock = self._lock or asyncio.Lock()
+            self._wake = self._wake or asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="message-log-flusher")
+
+    def log(
+        self,
+        chat_id: int,
+        user_id: int,
+        username: Optional[str],
+        text: str,
+        created_at: int,
+        message_id: Optional[int],
+        *,
+        display_name: Optional[str] = None,
+    ) -> None:
+        """Queue a message (and optionally the author's user card) for writing."""
+        self.start()
+        self._messages.append((chat_id, user_id, username, text, created_at, message_id))
+        if display_name is not None:
+            self._users[user_id] = (user_id, display_name, username)
+        if len(self._messages) >= self.batch:
+            self._wake.set()
+
+    async def flushed(self) -> None:
+        """Return once every message logged before the call is committed."""
+        if self._lock is None:
+            return
+        async with self._lock:
+            messages, self._messages = self._messages, []
+            users, self._users = list(self._users.values()), {}
+            if not messages and not users:
+                return
+            try:
+                await storage.write(_flush_conn, messages, users)
+            except Exception:
+                self._requeue(messages, users)
+                raise
+
+    def _requeue(self, messages: list[MessageRow], users: list[UserRow]) -> None:
+        self._messages[:0] = messages
+        for row in users:
+            self._users.setdefault(row[0], row)
+        overflow = len(self._messages) - MAX_PENDING
+        if overflow > 0:
+            del self._messages[:overflow]
+            print(f"[MSGLOG] Dropped {overflow} buffered messages: buffer is full")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flushed()
+            except Exception as err:
+                print(f"[MSGLOG] Flush failed, will retry: {err}")
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self.flushed()
+        except Exception as err:
+            print(f"[MSGLOG] Final flush failed, {self.pending} messages lost: {err}")
+
+
+message_log = MessageLogger()
+
+metrics.gauge("message_log_pending", "Logged messages not yet written to SQLite.", fn=lambda: message_log.pending)
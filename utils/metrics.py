@@ -0,0 +1,245 @@
+"""In-process metrics: counters, gauges and histograms.
+
+Metrics are registered once at import time in the module that owns them and
+updated on the hot path with a dict lookup and an addition.  The registry is
+rendered in Prometheus text format on ``http://127.0.0.1:METRICS_PORT/metrics``
+(``METRICS_PORT=0`` disables the listener) and summarised by ``/lord_stats``.
+"""
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from aiohttp import web
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# секунды: от быстрых обработчиков до долгих генераций LLM
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+
+    def _key(self, labels: dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_fmt(value)}" for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        for key, value in sorted(self.values.items()):
+            yield self.name, _labels_text(self.label_names, key), value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        *,
+        fn: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, help_text, labels)
+        self.values: dict[LabelValues, float] = {}
+        # значение, которое дешевле вычислить при чтении, чем поддерживать
+        self.fn = fn
+
+    def set(self, value: float, **labels: object) -> None:
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: object) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        if self.fn is not None:
+            try:
+                yield self.name, "", float(self.fn())
+            except Exception:
+                return
+            return
+        for key, value in sorted(self.values.items()):
+            yield self.name, _labels_text(self.label_names, key), value
+
+
+class _HistogramState:
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self, size: int):
+        self.buckets = [0] * size
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        *,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labels)
+        self.bounds = tuple(sorted(buckets))
+        self.states: dict[LabelValues, _HistogramState] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _HistogramState(len(self.bounds))
+        idx = bisect.bisect_left(self.bounds, value)
+        if idx < len(self.bounds):
+            state.buckets[idx] += 1
+        state.count += 1
+        state.sum += value
+
+    @contextmanager
+    def time(self, **labels: object) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels: object) -> Optional[float]:
+        """Upper bound of the bucket holding the ``q``-quantile (``None`` if empty or past the last bucket)."""
+        state = self.states.get(self._key(labels))
+        if state is None or not state.count:
+            return None
+        rank = q * state.count
+        seen = 0
+        for bound, n in zip(self.bounds, state.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        for key, state in sorted(self.states.items()):
+            cumulative = 0
+            for bound, n in zip(self.bounds, state.buckets):
+                cumulative += n
+                yield f"{self.name}_bucket", _labels_text(self.label_names, key, f'le="{_fmt(bound)}"'), cumulative
+            yield f"{self.name}_bucket", _labels_text(self.label_names, key, 'le="+Inf"'), state.count
+            yield f"{self.name}_sum", _labels_text(self.label_names, key), state.sum
+            yield f"{self.name}_count", _labels_text(self.label_names, key), state.count
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, _Metric] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            # повторный импорт модуля не должен ронять регистрацию
+            if type(existing) is not type(metric):
+                raise ValueError(f"Metric {metric.name} already registered as {existing.kind}")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: tuple[str, ...] = (), *, fn=None) -> Gauge:
+        return self._register(Gauge(name, help_text, labels, fn=fn))
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...] = (), *, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets=buckets))
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for name in sorted(self.metrics):
+            lines += self.metrics[name].render()
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+        if self._runner is not None or not port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as err:
+            await runner.cleanup()
+            print(f"[METRICS] Cannot listen on {host}:{port}: {err}")
+            return
+        self._runner = runner
+        print(f"[METRICS] Serving http://{host}:{port}/metrics")
+
+    async def close(self) -> None:
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+# общие для нескольких модулей
+HANDLER_SECONDS = histogram("bot_handler_seconds", "Time spent in message handlers.", ("handler",))
@@ -0,0 +1,131 @@
+"""Versioned schema migrations with a ledger.
+
+Every schema change is a :class:`Migration`: either a ``migrations/*.sql``
+file or a Python step registered by a module.  Applied versions are recorded
+in ``schema_migrations`` together with a checksum of their source.  At boot
+:func:`migrate` reads the ledger once; when every known version is already
+there it returns without touching the schema.  Pending migrations run in
+version order, each in its own transaction together with its ledger row.
+"""
+import hashlib
+import inspect
+import pathlib
+import sqlite3
+from datetime import datetime, timezone
+from typing import Callable, Iterable, NamedTuple
+
+from utils import storage
+
+LEDGER_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    applied_at INTEGER NOT NULL
+);
+"""
+
+
+class Migration(NamedTuple):
+    version: str
+    name: str
+    checksum: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+def _now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def _checksum(data: str) -> str:
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _split_id(migration_id: str) -> tuple[str, str]:
+    version, _, name = migration_id.partition("_")
+    return version, name or migration_id
+
+
+def run_script(conn: sqlite3.Connection, sql: str) -> None:
+    """Execute a multi-statement script inside the current transaction.
+
+    Unlike ``executescript`` this does not ``COMMIT`` first, so the script
+    stays atomic with the rest of the migration.
+    """
+    buf = ""
+    for line in sql.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            conn.execute(buf)
+            buf = ""
+    if buf.strip():
+        conn.execute(buf)
+
+
+def sql_migration(path: pathlib.Path) -> Migration:
+    sql = path.read_text(encoding="utf-8")
+    version, name = _split_id(path.stem)
+    return Migration(version, name, _checksum(sql), lambda conn: run_script(conn, sql))
+
+
+def sql_migrations(directory: pathlib.Path) -> list[Migration]:
+    if not directory.exists():
+        return []
+    return [sql_migration(path) for path in sorted(directory.glob("*.sql"))]
+
+
+def python_migration(migration_id: str, fn: Callable[[sqlite3.Connection], None]) -> Migration:
+    """Wrap ``fn(conn)`` as migration ``<version>_<name>``; its source is the checksum."""
+    version, name = _split_id(migration_id)
+    return Migration(version, name, _checksum(inspect.getsource(fn)), fn)
+
+
+def _apply(conn: sqlite3.Connection, migration: Migration) -> None:
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        migration.apply(conn)
+        conn.execute(
+            "INSERT INTO schema_migrations(version, name, checksum, applied_at) VALUES(?, ?, ?, ?);",
+            (migration.version, migration.name, migration.checksum, _now_ts()),
+        )
+        conn.execute("COMMIT;")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        raise
+
+
+def migrate(path: str, migrations: Iterable[Migration]) -> list[str]:
+    """Apply pending ``migrations`` to the database at ``path``; return applied versions."""
+    known = sorted(migrations, key=lambda mig: mig.version)
+    seen: set[str] = set()
+    for mig in known:
+        if mig.version in seen:
+            raise ValueError(f"Duplicate migration version {mig.version}")
+        seen.add(mig.version)
+
+    conn = storage.connect(path, isolation_level=None)
+    try:
+        conn.execute(LEDGER_SQL)
+        applied = dict(conn.execute("SELECT version, checksum FROM schema_migrations;").fetchall())
+        for mig in known:
+            if mig.version in applied and applied[mig.version] != mig.checksum:
+                print(f"[MIGRATIONS] {mig.version}_{mig.name} changed after it was applied; not re-running")
+        pending = [mig for mig in known if mig.version not in applied]
+        if not pending:
+            return []
+
+        # пересоздание таблиц (DROP + RENAME) не должно каскадно чистить дочерние
+        # таблицы; целостность проверяем после всех шагов
+        conn.execute("PRAGMA foreign_keys=OFF;")
+        done = []
+        for mig in pending:
+            print(f"[MIGRATIONS] Applying {mig.version}_{mig.name}")
+            _apply(conn, mig)
+            done.append(mig.version)
+        violations = conn.execute("PRAGMA foreign_key_check;").fetchall()
+        if violations:
+            print(f"[MIGRATIONS] {len(violations)} foreign key violations after migrating")
+        return done
+    finally:
+        conn.close()
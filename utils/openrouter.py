@@ -0,0 +1,364 @@
+"""Application-lifetime HTTP client for OpenRouter.
+
+One ``aiohttp.ClientSession`` with a keep-alive connection pool and DNS cache
+is opened in ``main()`` and reused by every LLM call, so requests skip the
+TCP+TLS handshake to openrouter.ai.
+
+All calls of the process share one :class:`Limiter`: token buckets for
+requests and tokens per minute (``OPENROUTER_RPM`` / ``OPENROUTER_TPM``).  A
+call that would exceed them waits for its turn instead of failing.  A 429
+pauses every caller for ``Retry-After`` and halves the refill rate, which
+then recovers step by step on successful calls.  Completions have no side
+effects, so 429, 5xx and connection errors are retried with jittered
+exponential backoff until ``OPENROUTER_RETRY_DEADLINE_SEC`` runs out.  A
+stream is retried only if it failed before its first token.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Optional
+
+import aiohttp
+
+from utils import metrics
+from utils.prompt_budget import estimate_tokens
+
+API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+CONNECT_TIMEOUT_SEC = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "10"))
+# пауза между байтами ответа; длинная генерация сама по себе не обрывается
+READ_TIMEOUT_SEC = float(os.getenv("OPENROUTER_READ_TIMEOUT", "90"))
+TOTAL_TIMEOUT_SEC = float(os.getenv("OPENROUTER_TOTAL_TIMEOUT", "180"))
+POOL_LIMIT = int(os.getenv("OPENROUTER_POOL_LIMIT", "32"))
+POOL_LIMIT_PER_HOST = int(os.getenv("OPENROUTER_POOL_LIMIT_PER_HOST", "8"))
+DNS_CACHE_TTL_SEC = int(os.getenv("OPENROUTER_DNS_TTL", "300"))
+KEEPALIVE_SEC = float(os.getenv("OPENROUTER_KEEPALIVE", "60"))
+
+# лимиты аккаунта OpenRouter; 0 — без ограничения
+REQUESTS_PER_MIN = float(os.getenv("OPENROUTER_RPM", "60"))
+TOKENS_PER_MIN = float(os.getenv("OPENROUTER_TPM", "0"))
+# на ответ модели до того, как станет известен настоящий usage
+COMPLETION_TOKENS_ESTIMATE = int(os.getenv("OPENROUTER_COMPLETION_ESTIMATE", "600"))
+RETRY_DEADLINE_SEC = float(os.getenv("OPENROUTER_RETRY_DEADLINE_SEC", "60"))
+MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "4"))
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_MAX_SEC = 20.0
+# после 429 темп падает вдвое, но не ниже этой доли, и растёт на шаг с каждым успехом
+MIN_RATE_SCALE = 0.25
+RATE_RECOVERY_STEP = 0.05
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+LLM_SECONDS = metrics.histogram("llm_request_seconds", "OpenRouter request duration.", ("mode", "outcome"))
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram("llm_first_token_seconds", "Time to the first streamed token.")
+RETRIES = metrics.counter("openrouter_retries_total", "OpenRouter calls retried, by reason.", ("reason",))
+THROTTLE_SECONDS = metrics.histogram("openrouter_throttle_seconds", "Time calls waited for the rate limiter.")
+
+
+class OpenRouterError(RuntimeError):
+    """Error reported by OpenRouter inside an otherwise successful response."""
+
+
+class RateLimited(OpenRouterError):
+    """The call could not get a rate-limit slot before its deadline."""
+
+
+class HTTPStatusError(OpenRouterError):
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"OpenRouter ответил HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a ``Retry-After`` header: delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE_SEC, cap: float = BACKOFF_MAX_SEC) -> float:
+    # «full jitter»: равномерно от 0 до экспоненты, чтобы повторы разных чатов не совпадали
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = burst or per_minute
+        self.level = self.capacity
+        self.scale = 1.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate * self.scale)
+        self.updated = now
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.level
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take ``amount`` (the balance may go negative); seconds until it is actually covered."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / (self.rate * self.scale)
+
+    def refund(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class Limiter:
+    """Process-wide request and token budget for OpenRouter."""
+
+    def __init__(self, requests_per_min: float = REQUESTS_PER_MIN, tokens_per_min: float = TOKENS_PER_MIN):
+        self.requests = TokenBucket(requests_per_min) if requests_per_min > 0 else None
+        self.tokens = TokenBucket(tokens_per_min) if tokens_per_min > 0 else None
+        self.paused_until = 0.0
+
+    @property
+    def scale(self) -> float:
+        return self.requests.scale if self.requests else 1.0
+
+    def _buckets(self):
+        return [b for b in (self.requests, self.tokens) if b is not None]
+
+    async def acquire(self, tokens: int, deadline: float) -> None:
+        """Wait for one request and ``tokens`` tokens; ``RateLimited`` if that would pass ``deadline``."""
+        now = time.monotonic()
+        wait = max(0.0, self.paused_until - now)
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1, now))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens, now))
+        if now + wait > deadline:
+            if self.requests:
+                self.requests.refund(1, now)
+            if self.tokens:
+                self.tokens.refund(tokens, now)
+            raise RateLimited("Лимит запросов к модели исчерпан, попробуйте через минуту.")
+        if wait > 0:
+            THROTTLE_SECONDS.observe(wait)
+            await asyncio.sleep(wait)
+        # пока ждали, кто-то мог получить 429 — пауза общая для всех
+        while (pause := self.paused_until - time.monotonic()) > 0:
+            if time.monotonic() + pause > deadline:
+                raise RateLimited("Лимит запросов к модели исчерпан, попробуйте через минуту.")
+            await asyncio.sleep(pause)
+
+    def settle(self, reserved: int, used: Optional[int]) -> None:
+        """Correct the token bucket once the real ``usage`` of a call is known."""
+        if self.tokens and used is not None:
+            self.tokens.refund(reserved - used, time.monotonic())
+
+    def throttled(self, retry_after: Optional[float], attempt: int) -> float:
+        """Register a 429: pause everyone and slow the refill; return the pause in seconds."""
+        pause = retry_after if retry_after is not None else backoff_delay(attempt)
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        for bucket in self._buckets():
+            bucket.scale = max(MIN_RATE_SCALE, bucket.scale / 2)
+        return pause
+
+    def succeeded(self) -> None:
+        for bucket in self._buckets():
+            bucket.scale = min(1.0, bucket.scale + RATE_RECOVERY_STEP)
+
+    def snapshot(self) -> dict[str, float]:
+        now = time.monotonic()
+        return {
+            "requests": self.requests.available(now) if self.requests else float("inf"),
+            "tokens": self.tokens.available(now) if self.tokens else float("inf"),
+            "scale": self.scale,
+            "paused_sec": max(0.0, self.paused_until - now),
+        }
+
+
+rate_limiter = Limiter()
+
+metrics.gauge("openrouter_budget_requests", "Requests the limiter can start right now.", fn=lambda: rate_limiter.snapshot()["requests"])
+metrics.gauge("openrouter_budget_tokens", "Tokens left in the per-minute budget.", fn=lambda: rate_limiter.snapshot()["tokens"])
+metrics.gauge("openrouter_rate_scale", "Refill rate relative to the configured limits after 429s.", fn=lambda: rate_limiter.scale)
+metrics.gauge("openrouter_paused_seconds", "Seconds left of a Retry-After pause.", fn=lambda: rate_limiter.snapshot()["paused_sec"])
+
+
+def _cost(body: dict[str, Any]) -> int:
+    prompt = sum(estimate_tokens(m.get("content") or "") for m in body.get("messages", ()))
+    return prompt + int(body.get("max_tokens") or COMPLETION_TOKENS_ESTIMATE)
+
+
+def _used_tokens(payload: dict[str, Any]) -> Optional[int]:
+    usage = payload.get("usage") or {}
+    total = usage.get("total_tokens")
+    return int(total) if total is not None else None
+
+
+class OpenRouterClient:
+    def __init__(self, api_key: str, *, site_url: str, app_name: str, limiter: Optional[Limiter] = None):
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": site_url,
+            "X-Title": app_name,
+        }
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.limiter = limiter or rate_limiter
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self.start()
+        return self._session
+
+    def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL_SEC,
+            keepalive_timeout=KEEPALIVE_SEC,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(
+                total=TOTAL_TIMEOUT_SEC,
+                sock_connect=CONNECT_TIMEOUT_SEC,
+                sock_read=READ_TIMEOUT_SEC,
+            ),
+        )
+
+    def _retry_delay(self, err: Exception, attempt: int, deadline: float) -> Optional[float]:
+        """Pause before the next attempt, or ``None`` if ``err`` is final."""
+        if isinstance(err, HTTPStatusError):
+            if err.status not in RETRY_STATUSES:
+                return None
+            reason = str(err.status)
+        elif isinstance(err, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            reason = "network"
+        else:
+            return None
+        if attempt >= MAX_RETRIES:
+            return None
+        if isinstance(err, HTTPStatusError) and err.status == 429:
+            # лимитер задержит и этот, и все остальные вызовы
+            self.limiter.throttled(err.retry_after, attempt)
+            delay = 0.0
+        else:
+            delay = backoff_delay(attempt)
+        if time.monotonic() + delay > deadline:
+            return None
+        RETRIES.inc(reason=reason)
+        return delay
+
+    def _check(self, r: aiohttp.ClientResponse) -> None:
+        if r.status >= 400:
+            raise HTTPStatusError(r.status, parse_retry_after(r.headers.get("Retry-After")))
+
+    async def chat(self, body: dict[str, Any]) -> dict[str, Any]:
+        deadline = time.monotonic() + RETRY_DEADLINE_SEC
+        cost = _cost(body)
+        attempt = 0
+        while True:
+            await self.limiter.acquire(cost, deadline)
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                async with self.session.post(API_URL, json=body) as r:
+                    self._check(r)
+                    data = await r.json()
+                outcome = "ok"
+            except Exception as err:
+                # неудачная попытка токенов не потратила
+                self.limiter.settle(cost, 0)
+                delay = self._retry_delay(err, attempt, deadline)
+                if delay is None:
+                    raise
+            finally:
+                LLM_SECONDS.observe(time.perf_counter() - started, mode="chat", outcome=outcome)
+            if outcome == "ok":
+                self.limiter.succeeded()
+                self.limiter.settle(cost, _used_tokens(data))
+                return data
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, body: dict[str, Any]) -> AsyncIterator[str]:
+        """Yield content deltas of a ``stream: true`` completion (server-sent events)."""
+        deadline = time.monotonic() + RETRY_DEADLINE_SEC
+        cost = _cost(body)
+        attempt = 0
+        while True:
+            await self.limiter.acquire(cost, deadline)
+            started = time.perf_counter()
+            outcome = "error"
+            state = {"yielded": False, "used": None}
+            try:
+                async for delta in self._stream(body, started, state):
+                    yield delta
+                outcome = "ok"
+            except Exception as err:
+                if not state["yielded"]:
+                    self.limiter.settle(cost, 0)
+                # после первого токена повтор продублировал бы уже показанный текст
+                delay = None if state["yielded"] else self._retry_delay(err, attempt, deadline)
+                if delay is None:
+                    raise
+            finally:
+                LLM_SECONDS.observe(time.perf_counter() - started, mode="stream", outcome=outcome)
+            if outcome == "ok":
+                self.limiter.succeeded()
+                self.limiter.settle(cost, state["used"])
+                return
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _stream(self, body: dict[str, Any], started: float, state: dict) -> AsyncIterator[str]:
+        first = True
+        async with self.session.post(API_URL, json={**body, "stream": True}) as r:
+            self._check(r)
+            async for raw in r.content:
+                line = raw.decode("utf-8").strip()
+                # пустые строки разделяют события, ":..." — keep-alive комментарии
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                payload = json.loads(data)
+                if payload.get("error"):
+                    raise OpenRouterError(payload["error"].get("message") or str(payload["error"]))
+                if payload.get("usage"):
+                    state["used"] = _used_tokens(payload)
+                choices = payload.get("choices") or []
+                if not choices:
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    if first:
+                        first = False
+                        state["yielded"] = True
+                        LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                    yield delta
+
+    async def close(self) -> None:
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
@@ -0,0 +1,218 @@
+"""Incremental per-user stylometric profiles.
+
+A profile per ``(chat_id, user_id)`` lives in ``user_profiles``.  It is
+built from recent history the first time :func:`get` asks for it, and from
+then on updated in the same writer transaction that logs the message (see
+:mod:`utils.message_log`).  It holds message, word, question, exclamation,
+emoji and link counts, a 24-hour activity histogram, and bounded frequency
+sketches of words and two-word phrases.  ``/lord_psych`` sends the rendered
+profile plus a small sample of messages instead of the whole history.
+
+The sketches are Misra–Gries summaries: when one grows past its capacity,
+every count drops by the (capacity+1)-th largest and non-positive entries go.
+Frequent items survive and rare ones are forgotten, so a profile row stays
+small however much the user writes.
+"""
+import json
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from utils import storage
+from utils.chat_context import STOPWORDS
+
+VOCAB_SIZE = int(os.getenv("PROFILE_VOCAB_SIZE", "200"))
+PHRASES_SIZE = int(os.getenv("PROFILE_PHRASES_SIZE", "100"))
+# сколько последних сообщений берём, если профиля ещё нет (старые чаты)
+BACKFILL_ROWS = int(os.getenv("PROFILE_BACKFILL_ROWS", "5000"))
+
+_WORD_RE = re.compile(r"[^\W\d_]{2,}")
+_EMOJI_RE = re.compile("[\U0001F000-\U0001FAFF☀-➿⬀-⯿]")
+_LINK_RE = re.compile(r"(?:https?://|t\.me/)\S*", re.IGNORECASE)
+
+COLUMNS = (
+    "messages", "chars", "words", "questions", "exclaims", "emoji", "links", "hours", "vocab", "phrases", "updated_at"
+)
+
+
+def _now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def _trim(sketch: dict[str, int], size: int) -> dict[str, int]:
+    if len(sketch) <= size:
+        return sketch
+    counts = sorted(sketch.values(), reverse=True)
+    cut = counts[size]
+    return {item: count - cut for item, count in sketch.items() if count > cut}
+
+
+def _top(sketch: dict[str, int], n: int, min_count: int = 1) -> list[str]:
+    items = sorted(sketch.items(), key=lambda kv: (-kv[1], kv[0]))
+    return [item for item, count in items[:n] if count >= min_count]
+
+
+def _share(part: int, total: int) -> str:
+    return f"{round(100 * part / total)}%" if total else "—"
+
+
+class Profile:
+    def __init__(self) -> None:
+        self.messages = 0
+        self.chars = 0
+        self.words = 0
+        self.questions = 0
+        self.exclaims = 0
+        self.emoji = 0
+        self.links = 0
+        # по локальному времени сервера, как и «тихие часы»
+        self.hours = [0] * 24
+        self.vocab: dict[str, int] = {}
+        self.phrases: dict[str, int] = {}
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "Profile":
+        profile = cls()
+        (profile.messages, profile.chars, profile.words, profile.questions, profile.exclaims,
+         profile.emoji, profile.links) = row[:7]
+        profile.hours = json.loads(row[7])
+        profile.vocab = json.loads(row[8])
+        profile.phrases = json.loads(row[9])
+        return profile
+
+    def to_row(self, now: int) -> tuple:
+        return (
+            self.messages, self.chars, self.words, self.questions, self.exclaims, self.emoji, self.links,
+            json.dumps(self.hours), json.dumps(self.vocab, ensure_ascii=False),
+            json.dumps(self.phrases, ensure_ascii=False), now,
+        )
+
+    def observe(self, text: str, ts: int) -> None:
+        # адреса ссылок не часть лексики
+        words = [w.lower() for w in _WORD_RE.findall(_LINK_RE.sub(" ", text))]
+        self.messages += 1
+        self.chars += len(text)
+        self.words += len(words)
+        self.questions += "?" in text
+        self.exclaims += "!" in text
+        self.emoji += len(_EMOJI_RE.findall(text))
+        self.links += bool(_LINK_RE.search(text))
+        self.hours[datetime.fromtimestamp(ts).hour] += 1
+        for word in words:
+            if len(word) >= 3 and word not in STOPWORDS:
+                self.vocab[word] = self.vocab.get(word, 0) + 1
+        for first, second in zip(words, words[1:]):
+            if first not in STOPWORDS or second not in STOPWORDS:
+                phrase = f"{first} {second}"
+                self.phrases[phrase] = self.phrases.get(phrase, 0) + 1
+
+    def compact(self) -> None:
+        self.vocab = _trim(self.vocab, VOCAB_SIZE)
+        self.phrases = _trim(self.phrases, PHRASES_SIZE)
+
+    def describe(self) -> str:
+        """Compact stats for the psych prompt."""
+        n = self.messages
+        if not n:
+            return "Статистики пока нет."
+        busiest = sorted(range(24), key=lambda h: -self.hours[h])[:3]
+        hours = ", ".join(f"{h:02d}–{(h + 1) % 24:02d} ч" for h in busiest if self.hours[h])
+        lines = [
+            f"Сообщений: {n}; средняя длина: {self.chars // n} символов, {self.words / n:.1f} слова",
+            f"Вопросы: {_share(self.questions, n)}, восклицания: {_share(self.exclaims, n)}, "
+            f"эмодзи: {self.emoji / n:.2f} на сообщение, ссылки: {_share(self.links, n)}",
+            f"Чаще всего пишет: {hours or '—'}",
+            f"Частые слова: {', '.join(_top(self.vocab, 20)) or '—'}",
+            f"Любимые обороты: {', '.join(_top(self.phrases, 10, min_count=2)) or '—'}",
+        ]
+        return "\n".join(lines)
+
+
+# ---- SQLite (в потоке писателя)
+def _load_conn(conn: sqlite3.Connection, chat_id: int, user_id: int) -> Optional[Profile]:
+    row = conn.execute(
+        f"SELECT {', '.join(COLUMNS[:-1])} FROM user_profiles WHERE chat_id=? AND user_id=?;", (chat_id, user_id)
+    ).fetchone()
+    return Profile.from_row(row) if row else None
+
+
+def _save_conn(conn: sqlite3.Connection, chat_id: int, user_id: int, profile: Profile, now: int) -> None:
+    placeholders = ", ".join("?" * (len(COLUMNS) + 2))
+    updates = ", ".join(f"{col}=excluded.{col}" for col in COLUMNS)
+    conn.execute(
+        f"INSERT INTO user_profiles(chat_id, user_id, {', '.join(COLUMNS)}) VALUES({placeholders}) "
+        f"ON CONFLICT(chat_id, user_id) DO UPDATE SET {updates};",
+        (chat_id, user_id, *profile.to_row(now)),
+    )
+
+
+def update_conn(conn: sqlite3.Connection, messages: Iterable[tuple]) -> None:
+    """Fold logged ``(chat_id, user_id, username, text, created_at, message_id)`` rows into existing profiles.
+
+    Users without a profile are skipped: their rows are already in ``messages``
+    and :func:`get` picks them up when it builds the profile.
+    """
+    by_user: dict[tuple[int, int], list[tuple[str, int]]] = {}
+    for chat_id, user_id, _username, text, created_at, _message_id in messages:
+        if user_id and text:
+            by_user.setdefault((chat_id, user_id), []).append((text, created_at))
+    now = _now_ts()
+    for (chat_id, user_id), items in by_user.items():
+        profile = _load_conn(conn, chat_id, user_id)
+        if profile is None:
+            # историю не читаем на пути записи: это задержало бы все остальные записи
+            continue
+        for text, created_at in items:
+            profile.observe(text, created_at)
+        profile.compact()
+        _save_conn(conn, chat_id, user_id, profile, now)
+
+
+def _backfill_conn(conn: sqlite3.Connection, chat_id: int, user_id: int) -> Profile:
+    # выполняется в потоке писателя, так что ни одна строка не попадёт и сюда, и в update_conn
+    rows = conn.execute(
+        "SELECT text, created_at FROM messages WHERE chat_id=? AND user_id=? AND text IS NOT NULL "
+        "ORDER BY id DESC LIMIT ?;",
+        (chat_id, user_id, BACKFILL_ROWS),
+    ).fetchall()
+    profile = Profile()
+    for text, created_at in reversed(rows):
+        # пустые тексты update_conn тоже пропускает
+        if text:
+            profile.observe(text, created_at)
+    profile.compact()
+    return profile
+
+
+def _ensure_conn(conn: sqlite3.Connection, chat_id: int, user_id: int) -> Profile:
+    profile = _load_conn(conn, chat_id, user_id)
+    if profile is None:
+        profile = _backfill_conn(conn, chat_id, user_id)
+        if profile.messages:
+            _save_conn(conn, chat_id, user_id, profile, _now_ts())
+    return profile
+
+
+async def get(chat_id: int, user_id: int) -> Profile:
+    """The user's profile, built from recent history on first use."""
+    return await storage.write(_ensure_conn, chat_id, user_id)
+
+
+# ---- кэш портретов
+async def cached_portrait(chat_id: int, user_id: int) -> Optional[tuple[int, str, int]]:
+    """``(messages_at, portrait, created_at)`` of the last generated portrait, if any."""
+    return await storage.fetchone(
+        "SELECT messages_at, portrait, created_at FROM psych_portraits WHERE chat_id=? AND user_id=?;",
+        (chat_id, user_id),
+    )
+
+
+async def save_portrait(chat_id: int, user_id: int, messages_at: int, portrait: str) -> None:
+    await storage.execute(
+        "INSERT INTO psych_portraits(chat_id, user_id, messages_at, portrait, created_at) VALUES(?, ?, ?, ?, ?) "
+        "ON CONFLICT(chat_id, user_id) DO UPDATE SET messages_at=excluded.messages_at, "
+        "portrait=excluded.portrait, created_at=excluded.created_at;",
+        (chat_id, user_id, messages_at, portrait, _now_ts()),
+    )
@@ -0,0 +1,143 @@
+"""Token-budgeted packing of chat lines into LLM prompts.
+
+:class:`Packer` takes rendered lines one at a time, estimates their tokens,
+drops trivially short and near-duplicate messages and stops at the first
+line that would overflow the budget, so nothing is cut mid-message.  It
+consumes any iterator, so :func:`collect` can run it over a live SQLite
+cursor on the read pool and stop stepping the cursor once the budget is
+full.  Rows past the budget are never fetched.
+
+Token counts are an estimate from the UTF-8 length; no tokenizer is needed.
+Per-model budgets are capped by the model's context window minus a reserve
+for the system prompt and the answer.
+"""
+import os
+import re
+import sqlite3
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+from utils import storage
+
+# символов на токен: латиница ~4, кириллица и прочее — около 3 (с запасом)
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 3.0
+# сообщения короче (после нормализации) не несут смысла: «да», «ок», «)))»
+MIN_CHARS = int(os.getenv("PROMPT_MIN_CHARS", "4"))
+# ответ модели и обвязка промпта
+RESERVE_TOKENS = int(os.getenv("PROMPT_RESERVE_TOKENS", "2000"))
+
+DEFAULT_CONTEXT_TOKENS = 16000
+# префикс имени модели → окно контекста; LLM_CONTEXT_TOKENS перекрывает
+MODEL_CONTEXT_TOKENS = {
+    "openai/gpt-4o": 128000,
+    "openai/gpt-4.1": 1000000,
+    "openai/gpt-3.5-turbo": 16000,
+    "anthropic/claude": 200000,
+    "google/gemini": 1000000,
+    "meta-llama/llama-3": 8000,
+    "mistralai/": 32000,
+}
+
+_NON_WORD_RE = re.compile(r"[\W_]+")
+_REPEAT_RE = re.compile(r"(.+?)\1+")
+
+
+def estimate_tokens(text: str) -> int:
+    chars = len(text)
+    # кириллица — два байта в UTF-8, так что разница длин ≈ число не-ASCII символов
+    other = min(len(text.encode("utf-8")) - chars, chars)
+    return int((chars - other) / ASCII_CHARS_PER_TOKEN + other / OTHER_CHARS_PER_TOKEN) + 1
+
+
+def context_tokens(model: str) -> int:
+    override = os.getenv("LLM_CONTEXT_TOKENS")
+    if override:
+        return int(override)
+    for prefix, size in MODEL_CONTEXT_TOKENS.items():
+        if model.startswith(prefix):
+            return size
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def budget_for(model: str, wanted: int, *, reserve: int = RESERVE_TOKENS) -> int:
+    """``wanted`` tokens, or less if the model's window cannot hold them plus ``reserve``."""
+    return max(0, min(wanted, context_tokens(model) - reserve))
+
+
+def fingerprint(text: str) -> str:
+    """Letters and digits only, lowercased, repeated runs squeezed: «Ахахаха!!» and «ахаха» match."""
+    letters = _NON_WORD_RE.sub("", (text or "").lower())[:160]
+    return _REPEAT_RE.sub(r"\1", letters)
+
+
+class Packer:
+    def __init__(self, budget: int, *, min_chars: int = MIN_CHARS, dedupe: bool = True):
+        self.budget = budget
+        self.min_chars = min_chars
+        self.dedupe = dedupe
+        self.lines: list[str] = []
+        self.tokens = 0
+        self.scanned = 0
+        self.dropped = 0
+        self.full = False
+        self._seen: set[str] = set()
+
+    def add(self, line: str, text: Optional[str] = None) -> bool:
+        """Take ``line`` if it fits; ``False`` once the budget is exhausted.
+
+        ``text`` is the message body used for the short/duplicate checks
+        (defaults to ``line``).
+        """
+        if self.full:
+            return False
+        self.scanned += 1
+        key = fingerprint(line if text is None else text)
+        if len(key) < self.min_chars or (self.dedupe and key in self._seen):
+            self.dropped += 1
+            return True
+        cost = estimate_tokens(line)
+        if self.tokens + cost > self.budget:
+            self.full = True
+            return False
+        self._seen.add(key)
+        self.tokens += cost
+        self.lines.append(line)
+        return True
+
+    def feed(
+        self,
+        rows: Iterable[Any],
+        render: Callable[[Any], str],
+        text_of: Optional[Callable[[Any], str]] = None,
+    ) -> "Packer":
+        """Add ``render(row)`` for each row until the budget is full; the rest is never read."""
+        for row in rows:
+            if not self.add(render(row), text_of(row) if text_of else None):
+                break
+        return self
+
+    def text(self, sep: str = "\n") -> str:
+        return sep.join(self.lines)
+
+
+def _collect_conn(
+    conn: sqlite3.Connection,
+    packer: Packer,
+    sql: str,
+    params: Sequence[Any],
+    render: Callable[[Any], str],
+    text_of: Optional[Callable[[Any], str]],
+) -> Packer:
+    # курсор читается построчно: SQLite не шагает дальше последней взятой строки
+    return packer.feed(conn.execute(sql, tuple(params)), render, text_of)
+
+
+async def collect(
+    packer: Packer,
+    sql: str,
+    params: Sequence[Any],
+    render: Callable[[Any], str],
+    text_of: Optional[Callable[[Any], str]] = None,
+) -> Packer:
+    """Stream the rows of ``sql`` into ``packer`` on the storage read pool."""
+    return await storage.read(_collect_conn, packer, sql, params, render, text_of)
@@ -0,0 +1,197 @@
+"""Query-plan regression check for the bot's hot SQL.
+
+``HOT_QUERIES`` lists the statements that run per message or per command.
+:func:`check` runs ``EXPLAIN QUERY PLAN`` on each of them and reports every
+one that falls back to a full table scan.  Run it against a live database:
+
+    python -m utils.query_plans [path/to/bot.sqlite3]
+
+The exit code is 1 if any query scans, so the check can gate a deploy.
+"""
+import sqlite3
+import sys
+from typing import NamedTuple
+
+from utils import storage
+
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+
+
+# держать в синхроне с текстами запросов в bot.py / achievements.py / utils
+HOT_QUERIES: tuple[HotQuery, ...] = (
+    HotQuery(
+        "summary.window",
+        "SELECT id, user_id, username, text, message_id FROM messages "
+        "WHERE chat_id=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
+    ),
+    HotQuery(
+        "summary.from_chunk",
+        "SELECT id, user_id, username, text, message_id FROM messages "
+        "WHERE chat_id=? AND text IS NOT NULL AND id>=? ORDER BY id;",
+    ),
+    HotQuery(
+        "summary.chunk_covering",
+        "SELECT start_id FROM summary_chunks WHERE chat_id=? AND start_id<=? AND end_id>=? "
+        "ORDER BY start_id DESC LIMIT 1;",
+    ),
+    HotQuery(
+        "context.recent_anchored",
+        "SELECT id, username, text, created_at FROM messages WHERE chat_id=? AND text IS NOT NULL AND id<=("
+        "SELECT MAX(id) FROM messages WHERE chat_id=? AND message_id=?) ORDER BY id DESC LIMIT ?;",
+    ),
+    HotQuery(
+        "context.recent",
+        "SELECT id, username, text, created_at FROM messages WHERE chat_id=? AND text IS NOT NULL "
+        "ORDER BY id DESC LIMIT ?;",
+    ),
+    HotQuery(
+        "context.related",
+        "SELECT m.id, m.username, m.text, m.created_at FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH ? AND m.chat_id=? AND m.id<? ORDER BY bm25(messages_fts) LIMIT ?;",
+    ),
+    HotQuery(
+        "psych.by_user_id",
+        "SELECT text, message_id, created_at FROM messages "
+        "WHERE chat_id=? AND user_id=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
+    ),
+    HotQuery(
+        "psych.by_username",
+        "SELECT text, message_id, created_at FROM messages "
+        "WHERE chat_id=? AND username=? AND text IS NOT NULL ORDER BY id DESC LIMIT ?;",
+    ),
+    HotQuery(
+        "users.by_username",
+        "SELECT user_id, display_name, username FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1;",
+    ),
+    HotQuery("summary.prev_link", "SELECT message_id FROM last_summary WHERE chat_id=? ORDER BY created_at DESC LIMIT 1;"),
+    HotQuery(
+        "ach.progress_rank",
+        "SELECT user_id, progress FROM achievement_progress "
+        "WHERE achievement_id=? AND chat_id=? ORDER BY progress DESC, user_id ASC;",
+    ),
+    HotQuery(
+        "ach.globalview_progress",
+        "SELECT chat_id, user_id, progress FROM achievement_progress "
+        "WHERE achievement_id=? ORDER BY progress DESC, user_id ASC LIMIT 50;",
+    ),
+    HotQuery(
+        "ach.globalview_awards",
+        "SELECT chat_id, user_id, MAX(tier) AS max_tier FROM user_achievements "
+        "WHERE achievement_id=? GROUP BY chat_id, user_id;",
+    ),
+    HotQuery(
+        "ach.max_tier",
+        "SELECT COALESCE(MAX(tier), 0) FROM user_achievements WHERE chat_id=? AND user_id=? AND achievement_id=?;",
+    ),
+    HotQuery(
+        "ach.rarity_members",
+        "SELECT members FROM chat_member_counts WHERE chat_id=?;",
+    ),
+    HotQuery(
+        "ach.rarity_holders",
+        "SELECT holders FROM achievement_holders WHERE chat_id=? AND achievement_id=?;",
+    ),
+    HotQuery(
+        "ach.top",
+        "SELECT user_id, COUNT(*) AS cnt FROM user_achievements WHERE chat_id=? "
+        "GROUP BY user_id ORDER BY cnt DESC, user_id ASC LIMIT 20;",
+    ),
+    HotQuery(
+        "counters.user_stats",
+        "SELECT messages_count FROM user_stats WHERE chat_id=? AND user_id=? LIMIT 1;",
+    ),
+    HotQuery(
+        "counters.user_metrics",
+        "SELECT count FROM user_metrics WHERE chat_id=? AND user_id=? AND metric=? LIMIT 1;",
+    ),
+    HotQuery(
+        "counters.achievement_progress",
+        "SELECT progress FROM achievement_progress WHERE chat_id=? AND user_id=? AND achievement_id=? LIMIT 1;",
+    ),
+    HotQuery(
+        "cooldowns.load",
+        "SELECT scope, chat_id, user_key, expires_at FROM bot_cooldowns WHERE expires_at > ?;",
+    ),
+    HotQuery("cooldowns.expire", "DELETE FROM bot_cooldowns WHERE expires_at <= ?;"),
+    HotQuery(
+        "rate_limits.load",
+        "SELECT scope, chat_id, user_key, state FROM rate_limit_state WHERE expires_at > ?;",
+    ),
+    HotQuery("rate_limits.expire", "DELETE FROM rate_limit_state WHERE expires_at <= ?;"),
+    HotQuery(
+        "profiles.load",
+        "SELECT messages, chars, words, questions, exclaims, emoji, links, hours, vocab, phrases "
+        "FROM user_profiles WHERE chat_id=? AND user_id=?;",
+    ),
+    HotQuery(
+        "profiles.backfill",
+        "SELECT text, created_at FROM messages WHERE chat_id=? AND user_id=? AND text IS NOT NULL "
+        "ORDER BY id DESC LIMIT ?;",
+    ),
+    HotQuery(
+        "profiles.portrait",
+        "SELECT messages_at, portrait, created_at FROM psych_portraits WHERE chat_id=? AND user_id=?;",
+    ),
+    HotQuery(
+        "retention.batch",
+        "SELECT id, chat_id, user_id, username, text, created_at, message_id FROM messages "
+        "WHERE chat_id=? ORDER BY id LIMIT ?;",
+    ),
+    HotQuery("retention.rows_cutoff", "SELECT id FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 1 OFFSET ?;"),
+    HotQuery(
+        "search.page",
+        "SELECT m.id, m.message_id, m.user_id, m.username, u.display_name, m.created_at, "
+        "snippet(messages_fts, 0, ?, ?, '…', 14), bm25(messages_fts) AS score "
+        "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "LEFT JOIN users u ON u.user_id = m.user_id "
+        "WHERE messages_fts MATCH ? AND m.chat_id=? AND m.created_at>=? "
+        "AND (score>? OR (score=? AND m.id<?)) ORDER BY score, m.id DESC LIMIT ?;",
+    ),
+    HotQuery("llm_cache.get", "SELECT response FROM llm_cache WHERE key=? AND expires_at>? LIMIT 1;"),
+)
+
+
+def _full_scans(plan: list[tuple]) -> list[str]:
+    # строки плана вида "SCAN messages"; поиск по индексу выглядит как "SEARCH ..."
+    return [
+        detail for *_, detail in plan
+        if detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail and "CONSTANT ROW" not in detail
+    ]
+
+
+def explain(conn: sqlite3.Connection, sql: str) -> list[tuple]:
+    params = (None,) * sql.count("?")
+    return conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+
+
+def check(conn: sqlite3.Connection, queries: tuple[HotQuery, ...] = HOT_QUERIES) -> dict[str, list[str]]:
+    """Return ``{query name: offending plan lines}`` for queries that scan a whole table."""
+    problems: dict[str, list[str]] = {}
+    for query in queries:
+        try:
+            scans = _full_scans(explain(conn, query.sql))
+        except sqlite3.Error as err:
+            scans = [f"error: {err}"]
+        if scans:
+            problems[query.name] = scans
+    return problems
+
+
+def main(argv: list[str]) -> int:
+    path = argv[1] if len(argv) > 1 else storage.DB
+    conn = storage.connect(path, readonly=True)
+    try:
+        problems = check(conn)
+    finally:
+        conn.close()
+    for name, lines in problems.items():
+        print(f"[PLAN] {name}: {'; '.join(lines)}")
+    print(f"[PLAN] {len(HOT_QUERIES) - len(problems)}/{len(HOT_QUERIES)} hot queries use an index")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
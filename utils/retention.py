@@ -0,0 +1,286 @@
+"""Retention for ``messages``: old rows move to compressed monthly archives.
+
+Every chat keeps a hot window in SQLite: the last ``RETENTION_DAYS`` days and
+at most ``RETENTION_ROWS`` rows (0 disables a limit).  Per-chat overrides
+live in ``chat_retention``.  A background task moves older rows, oldest first
+and ``RETENTION_BATCH`` at a time, to
+``ARCHIVE_DIR/<chat_id>/<YYYY-MM>.jsonl.gz`` and deletes them from
+``messages``; the ``messages_ad`` trigger removes them from the FTS index.
+
+Archives are append-only: each batch is a new gzip member, and ``gzip``
+reads the members back as one stream.  A batch is fsynced before its rows
+are deleted.  ``message_archive.archived_to`` moves forward in the same
+transaction as the delete, and readers ignore archived ids above it, so a
+crash between the two steps never yields a row twice.
+"""
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import pathlib
+import sqlite3
+from datetime import datetime, timezone
+from typing import Iterator, NamedTuple, Optional
+
+from utils import metrics, storage
+
+ARCHIVE_DIR = pathlib.Path(os.getenv("ARCHIVE_DIR", "archive"))
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+RETENTION_ROWS = int(os.getenv("RETENTION_ROWS", "0"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "2000"))
+RETENTION_INTERVAL_SEC = float(os.getenv("RETENTION_INTERVAL_SEC", "3600"))
+
+COLUMNS = ("id", "chat_id", "user_id", "username", "text", "created_at", "message_id")
+
+ARCHIVED_ROWS = metrics.counter("retention_archived_rows_total", "Messages moved from SQLite to archive files.")
+
+BATCH_SQL = f"SELECT {', '.join(COLUMNS)} FROM messages WHERE chat_id=? ORDER BY id LIMIT ?;"
+ROWS_CUTOFF_SQL = "SELECT id FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 1 OFFSET ?;"
+
+
+class Policy(NamedTuple):
+    keep_days: int
+    keep_rows: int
+
+    @property
+    def enabled(self) -> bool:
+        return self.keep_days > 0 or self.keep_rows > 0
+
+
+DEFAULT_POLICY = Policy(RETENTION_DAYS, RETENTION_ROWS)
+
+
+def _now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def _month(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m")
+
+
+def _resolve(keep_days: Optional[int], keep_rows: Optional[int]) -> Policy:
+    # NULL в chat_retention — «как по умолчанию»
+    return Policy(
+        DEFAULT_POLICY.keep_days if keep_days is None else keep_days,
+        DEFAULT_POLICY.keep_rows if keep_rows is None else keep_rows,
+    )
+
+
+# ---- SQLite (функции *_conn выполняются в потоках storage)
+def _policies_conn(conn: sqlite3.Connection) -> dict[int, Policy]:
+    overrides = {
+        chat_id: _resolve(days, rows)
+        for chat_id, days, rows in conn.execute("SELECT chat_id, keep_days, keep_rows FROM chat_retention;")
+    }
+    policies = {}
+    if DEFAULT_POLICY.enabled:
+        # список чатов ведут триггеры редкости (achievements) — без прохода по индексу messages
+        for (chat_id,) in conn.execute("SELECT chat_id FROM chat_member_counts;"):
+            policies[chat_id] = DEFAULT_POLICY
+    policies.update(overrides)
+    return {chat_id: policy for chat_id, policy in policies.items() if policy.enabled}
+
+
+def _batch_conn(conn: sqlite3.Connection, chat_id: int, policy: Policy, now: int, limit: int) -> list[tuple]:
+    """Oldest rows of the chat that fall outside the hot window, at most ``limit``."""
+    max_id = None
+    if policy.keep_rows > 0:
+        row = conn.execute(ROWS_CUTOFF_SQL, (chat_id, policy.keep_rows)).fetchone()
+        max_id = row[0] if row else 0
+    min_ts = now - policy.keep_days * 86400 if policy.keep_days > 0 else None
+
+    batch = []
+    # id и created_at растут вместе, поэтому архивная часть — всегда префикс по id
+    for row in conn.execute(BATCH_SQL, (chat_id, limit)):
+        if not ((max_id is not None and row[0] <= max_id) or (min_ts is not None and row[5] < min_ts)):
+            break
+        batch.append(row)
+    return batch
+
+
+def _commit_batch_conn(conn: sqlite3.Connection, chat_id: int, first_id: int, last_id: int, count: int, now: int) -> int:
+    deleted = conn.execute(
+        "DELETE FROM messages WHERE chat_id=? AND id BETWEEN ? AND ?;", (chat_id, first_id, last_id)
+    ).rowcount
+    # кэш саммари по этим сообщениям больше не пригодится
+    conn.execute("DELETE FROM summary_chunks WHERE chat_id=? AND start_id<=?;", (chat_id, last_id))
+    conn.execute(
+        "INSERT INTO message_archive(chat_id, archived_to, archived_rows, updated_at) VALUES(?, ?, ?, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET archived_to=MAX(archived_to, excluded.archived_to), "
+        "archived_rows=archived_rows+excluded.archived_rows, updated_at=excluded.updated_at;",
+        (chat_id, last_id, count, now),
+    )
+    return deleted
+
+
+# ---- файлы архива
+def chat_dir(chat_id: int, root: pathlib.Path = ARCHIVE_DIR) -> pathlib.Path:
+    return root / str(chat_id)
+
+
+def _append(chat_id: int, rows: list[tuple], root: pathlib.Path) -> None:
+    by_month: dict[str, list[tuple]] = {}
+    for row in rows:
+        by_month.setdefault(_month(row[5]), []).append(row)
+    directory = chat_dir(chat_id, root)
+    directory.mkdir(parents=True, exist_ok=True)
+    for month, month_rows in by_month.items():
+        payload = "".join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in month_rows)
+        with open(directory / f"{month}.jsonl.gz", "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+                gz.write(payload.encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def iter_archive(chat_id: int, archived_to: int, root: pathlib.Path = ARCHIVE_DIR) -> Iterator[dict]:
+    """Archived rows of a chat, newest month first; within a month in id order.
+
+    Only ids up to ``archived_to`` (the ledger) count: anything above was
+    written by a batch whose delete never committed and still lives in SQLite.
+    """
+    directory = chat_dir(chat_id, root)
+    if not directory.exists():
+        return
+    seen: set[int] = set()
+    for path in sorted(directory.glob("*.jsonl.gz"), reverse=True):
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if row["id"] > archived_to or row["id"] in seen:
+                    continue
+                seen.add(row["id"])
+                yield row
+
+
+def iter_user_rows(
+    chat_id: int,
+    archived_to: int,
+    user_id: Optional[int],
+    username: Optional[str],
+    root: pathlib.Path = ARCHIVE_DIR,
+) -> Iterator[tuple]:
+    """Archived ``(text, message_id, created_at)`` of a user, newest first, read lazily month by month."""
+    def matches(row: dict) -> bool:
+        if user_id:
+            return row["user_id"] == user_id
+        return username is not None and row["username"] == username
+
+    # месяцы идут от новых к старым, а внутри файла строки — по возрастанию id
+    month: Optional[str] = None
+    bucket: list[tuple] = []
+    for row in iter_archive(chat_id, archived_to, root):
+        row_month = _month(row["created_at"])
+        if row_month != month:
+            yield from reversed(bucket)
+            month, bucket = row_month, []
+        if row.get("text") is not None and matches(row):
+            bucket.append((row["text"], row["message_id"], row["created_at"]))
+    yield from reversed(bucket)
+
+
+class Retention:
+    def __init__(self, root: pathlib.Path = ARCHIVE_DIR, batch: int = RETENTION_BATCH):
+        self.root = root
+        self.batch = max(1, batch)
+        self._task: Optional[asyncio.Task] = None
+
+    # ---- политика
+    async def policy(self, chat_id: int) -> Policy:
+        row = await storage.fetchone("SELECT keep_days, keep_rows FROM chat_retention WHERE chat_id=?;", (chat_id,))
+        return _resolve(*row) if row else DEFAULT_POLICY
+
+    async def set_policy(self, chat_id: int, keep_days: Optional[int], keep_rows: Optional[int]) -> None:
+        if keep_days is None and keep_rows is None:
+            await storage.execute("DELETE FROM chat_retention WHERE chat_id=?;", (chat_id,))
+            return
+        await storage.execute(
+            "INSERT INTO chat_retention(chat_id, keep_days, keep_rows) VALUES(?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET keep_days=excluded.keep_days, keep_rows=excluded.keep_rows;",
+            (chat_id, keep_days, keep_rows),
+        )
+
+    async def archived(self, chat_id: int) -> tuple[int, int]:
+        """``(archived_to, archived_rows)`` for the chat, zeros if nothing was archived."""
+        row = await storage.fetchone(
+            "SELECT archived_to, archived_rows FROM message_archive WHERE chat_id=?;", (chat_id,)
+        )
+        return (row[0], row[1]) if row else (0, 0)
+
+    # ---- перенос в архив
+    async def archive_chat(self, chat_id: int, policy: Policy) -> int:
+        moved = 0
+        while True:
+            now = _now_ts()
+            rows = await storage.read(_batch_conn, chat_id, policy, now, self.batch)
+            if not rows:
+                return moved
+            await asyncio.to_thread(_append, chat_id, rows, self.root)
+            await storage.write(_commit_batch_conn, chat_id, rows[0][0], rows[-1][0], len(rows), now)
+            ARCHIVED_ROWS.inc(len(rows))
+            moved += len(rows)
+            if len(rows) < self.batch:
+                return moved
+
+    async def run_once(self) -> dict[int, int]:
+        """Archive every chat that has rows outside its hot window; return moved rows per chat."""
+        moved = {}
+        for chat_id, policy in (await storage.read(_policies_conn)).items():
+            count = await self.archive_chat(chat_id, policy)
+            if count:
+                moved[chat_id] = count
+        return moved
+
+    # ---- чтение архива
+    async def user_rows(self, chat_id: int, user_id: Optional[int], username: Optional[str]) -> Iterator[tuple]:
+        """Lazy iterator over a user's archived messages; consume it off the event loop."""
+        if not (user_id or username):
+            return iter(())
+        archived_to, _ = await self.archived(chat_id)
+        if not archived_to:
+            return iter(())
+        return iter_user_rows(chat_id, archived_to, user_id, username, self.root)
+
+    async def user_messages(
+        self,
+        chat_id: int,
+        user_id: Optional[int],
+        username: Optional[str],
+        limit: int,
+    ) -> list[tuple]:
+        """Archived ``(text, message_id, created_at)`` of a user, newest first."""
+        if limit <= 0:
+            return []
+        rows = await self.user_rows(chat_id, user_id, username)
+        return await asyncio.to_thread(lambda: list(itertools.islice(rows, limit)))
+
+    # ---- фоновая задача
+    async def _run(self, interval: float) -> None:
+        while True:
+            try:
+                moved = await self.run_once()
+                if moved:
+                    print(f"[RETENTION] Archived {sum(moved.values())} messages from {len(moved)} chat(s)")
+            except Exception as err:
+                print(f"[RETENTION] Archiving failed: {err}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = RETENTION_INTERVAL_SEC) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def close(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+retention = Retention()
@@ -0,0 +1,199 @@
+"""Full-text search over ``messages_fts`` for ``/lord_search``.
+
+A query is free text plus optional filters::
+
+    кот "рыжий кот" корм* -собака from:@nikki since:2024-05-01 until:2024-06-30
+
+Words are matched as FTS5 tokens; a trailing ``*`` makes a prefix match,
+``"..."`` is a phrase and ``-word`` excludes a token.  Hits are ranked by
+``bm25`` and paged with a keyset cursor ``(score, id)``, so page N costs the
+same as page 1.  Queries run on the storage read pool.
+
+Telegram callback data is limited to 64 bytes, so the query and cursor of
+each results message live in :data:`sessions` under a short token.
+"""
+import os
+import re
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from utils import storage
+
+PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "8"))
+SESSION_TTL_SEC = int(os.getenv("SEARCH_SESSION_TTL_SEC", "3600"))
+MAX_SESSIONS = int(os.getenv("SEARCH_MAX_SESSIONS", "500"))
+
+# границы подсветки в snippet(); в HTML их превращает вызывающий код
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+SNIPPET_TOKENS = 14
+
+_TOKEN_RE = re.compile(r'(-?)"([^"]*)"|(\S+)')
+_WORD_RE = re.compile(r"\w+")
+
+
+class Query(NamedTuple):
+    chat_id: int
+    match: str
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    since: Optional[int] = None
+    until: Optional[int] = None
+
+
+class Hit(NamedTuple):
+    id: int
+    message_id: Optional[int]
+    user_id: int
+    username: Optional[str]
+    display_name: Optional[str]
+    created_at: int
+    snippet: str
+    score: float
+
+
+class Cursor(NamedTuple):
+    score: float
+    id: int
+
+
+class Parsed(NamedTuple):
+    match: str
+    from_username: Optional[str]
+    since: Optional[int]
+    until: Optional[int]
+
+
+def _day_ts(value: str) -> int:
+    try:
+        day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise ValueError(f"Дата должна быть в формате ГГГГ-ММ-ДД: {value}") from None
+    return int(day.timestamp())
+
+
+def _term(text: str, prefix: bool = False) -> Optional[str]:
+    words = _WORD_RE.findall(text)
+    if not words:
+        return None
+    # кавычки FTS5 экранирует удвоением, но \w их и так не пропускает
+    term = '"' + " ".join(words) + '"'
+    return term + "*" if prefix else term
+
+
+def parse(text: str) -> Parsed:
+    """Turn user input into an FTS5 expression plus filters; ``ValueError`` explains bad input."""
+    include: list[str] = []
+    exclude: list[str] = []
+    from_username = None
+    since = until = None
+    for negate, phrase, word in _TOKEN_RE.findall(text or ""):
+        if word:
+            key, sep, value = word.partition(":")
+            key = key.lower()
+            if sep and value and key == "from":
+                from_username = value.lstrip("@")
+                continue
+            if sep and value and key == "since":
+                since = _day_ts(value)
+                continue
+            if sep and value and key == "until":
+                # включительно: до начала следующего дня
+                until = _day_ts(value) + int(timedelta(days=1).total_seconds())
+                continue
+            negate = "-" if word.startswith("-") and len(word) > 1 else ""
+            term = _term(word.lstrip("-") if negate else word, prefix=word.endswith("*"))
+        else:
+            term = _term(phrase)
+        if term is None:
+            continue
+        (exclude if negate else include).append(term)
+    if not include:
+        raise ValueError("Нужно хотя бы одно слово для поиска.")
+    match = " ".join(include) + "".join(f" NOT {term}" for term in exclude)
+    return Parsed(match, from_username, since, until)
+
+
+def _search_conn(conn: sqlite3.Connection, query: Query, after: Optional[Cursor], limit: int) -> list[Hit]:
+    where = ["messages_fts MATCH ?", "m.chat_id=?"]
+    params: list = [query.match, query.chat_id]
+    if query.user_id is not None:
+        where.append("m.user_id=?")
+        params.append(query.user_id)
+    elif query.username:
+        where.append("LOWER(m.username)=LOWER(?)")
+        params.append(query.username)
+    if query.since is not None:
+        where.append("m.created_at>=?")
+        params.append(query.since)
+    if query.until is not None:
+        where.append("m.created_at<?")
+        params.append(query.until)
+    if after is not None:
+        # bm25 меньше — совпадение лучше; при равенстве новые сообщения раньше
+        where.append("(score>? OR (score=? AND m.id<?))")
+        params += [after.score, after.score, after.id]
+    sql = (
+        "SELECT m.id, m.message_id, m.user_id, m.username, u.display_name, m.created_at, "
+        f"snippet(messages_fts, 0, ?, ?, '…', {SNIPPET_TOKENS}), bm25(messages_fts) AS score "
+        "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "LEFT JOIN users u ON u.user_id = m.user_id "
+        f"WHERE {' AND '.join(where)} ORDER BY score, m.id DESC LIMIT ?;"
+    )
+    rows = conn.execute(sql, (HIGHLIGHT_START, HIGHLIGHT_END, *params, limit)).fetchall()
+    return [Hit(*row) for row in rows]
+
+
+async def search(query: Query, after: Optional[Cursor] = None, limit: int = PAGE_SIZE) -> tuple[list[Hit], bool]:
+    """One page of hits after ``after`` and whether another page follows."""
+    hits = await storage.read(_search_conn, query, after, limit + 1)
+    return hits[:limit], len(hits) > limit
+
+
+async def resolve_user(username: str) -> Optional[int]:
+    row = await storage.fetchone("SELECT user_id FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1;", (username,))
+    return row[0] if row else None
+
+
+class Session(NamedTuple):
+    query: Query
+    text: str
+    page: int
+    # курсоры начала каждой страницы, чтобы листать и назад
+    starts: tuple[Optional[Cursor], ...]
+    next_cursor: Optional[Cursor]
+    created: float
+
+
+class Sessions:
+    """Pagination state of recent results messages, LRU-bounded and expiring."""
+
+    def __init__(self, ttl: float = SESSION_TTL_SEC, capacity: int = MAX_SESSIONS):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._items: "OrderedDict[str, Session]" = OrderedDict()
+
+    def put(self, session: Session, token: Optional[str] = None) -> str:
+        token = token or secrets.token_hex(4)
+        self._items[token] = session
+        self._items.move_to_end(token)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+        return token
+
+    def get(self, token: str) -> Optional[Session]:
+        session = self._items.get(token)
+        if session is None:
+            return None
+        if time.monotonic() - session.created > self.ttl:
+            del self._items[token]
+            return None
+        self._items.move_to_end(token)
+        return session
+
+
+sessions = Sessions()
@@ -0,0 +1,369 @@
+"""Opt-in SQL tracing and slow-query log.
+
+With ``SQL_TRACE=1`` every connection opened through :func:`utils.storage.connect`
+is a :class:`TracedConnection`.  Each statement is timed from ``execute`` until
+its cursor is exhausted or dropped, and aggregated under its normalised text
+(literals replaced with ``?``): calls, total and max time, rows.  Statements
+slower than ``SQL_SLOW_MS`` are appended to ``SQL_SLOW_LOG`` as JSON lines
+together with the handler and the function that issued them.
+
+Statements that bypass ``execute`` (``executescript``) are seen through
+``set_trace_callback`` and only counted.  ``/lord_sql`` shows the top
+offenders of the running process; the slow log can be summarised offline:
+
+    python -m utils.sql_trace [sql_slow.log] [--top N]
+"""
+import argparse
+import contextvars
+import functools
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+from utils import metrics
+
+ENABLED = os.getenv("SQL_TRACE", "0").lower() in ("1", "true", "yes", "on")
+SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))
+SLOW_LOG = os.getenv("SQL_SLOW_LOG", "sql_slow.log")
+
+ORDERS = ("total", "max", "calls", "rows")
+
+SLOW_QUERIES = metrics.counter("sqlite_slow_queries_total", "Statements slower than SQL_SLOW_MS (tracing mode only).")
+
+# имя aiogram-обработчика, в котором выполняется текущая задача
+HANDLER: contextvars.ContextVar[str] = contextvars.ContextVar("sql_trace_handler", default="")
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+# файлы, которые не считаются «местом вызова» запроса
+_TRACE_FILE = os.path.join("utils", "sql_trace.py")
+_GATEWAY_FILES = (_TRACE_FILE, os.path.join("utils", "storage.py"))
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize(sql: str) -> str:
+    """Collapse a statement to its shape: literals become ``?``, ``IN`` lists one ``(?, …)``."""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _LIST_RE.sub("(?, …)", sql)
+    return _SPACE_RE.sub(" ", sql).strip().rstrip(";").rstrip()
+
+
+class Origin(NamedTuple):
+    handler: str
+    site: str
+
+
+def _site(frame, skip: tuple[str, ...] = _GATEWAY_FILES) -> str:
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.endswith(skip) and "sqlite3" not in filename:
+            return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}"
+        frame = frame.f_back
+    return ""
+
+
+def origin() -> Optional[Origin]:
+    """Handler and call site of the current DB request; ``None`` when tracing is off.
+
+    Captured on the event loop before the job is handed to a storage thread,
+    where neither the context variable nor the awaiting frames are visible.
+    """
+    if not ENABLED:
+        return None
+    return Origin(HANDLER.get(), _site(sys._getframe(1)))
+
+
+class StatementStats:
+    __slots__ = ("sql", "calls", "total", "max", "rows", "slow", "callers")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.callers: dict[str, int] = {}
+
+    @property
+    def avg(self) -> float:
+        return self.total / self.calls if self.calls else 0.0
+
+    def top_caller(self) -> str:
+        return max(self.callers, key=self.callers.__getitem__) if self.callers else ""
+
+
+class Tracer:
+    def __init__(self, slow_ms: float = SLOW_MS, log_path: str = SLOW_LOG):
+        self.slow_seconds = slow_ms / 1000
+        self.log_path = log_path
+        self.stats: dict[str, StatementStats] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._log = None
+
+    # ---- привязка к потокам хранилища
+    def call(self, source: Optional[Origin], fn: Callable[..., Any], *args: Any) -> Any:
+        """Run ``fn(*args)`` with ``source`` as the origin of the statements it issues."""
+        if source is None:
+            return fn(*args)
+        prev = getattr(self._local, "origin", None)
+        self._local.origin = source
+        try:
+            return fn(*args)
+        finally:
+            self._local.origin = prev
+
+    def _current_origin(self) -> Origin:
+        source = getattr(self._local, "origin", None)
+        if source is not None:
+            return source
+        # служебные запросы хранилища и прямые соединения (миграции, утилиты):
+        # вызывающий виден в стеке этого же потока
+        return Origin(HANDLER.get(), _site(sys._getframe(1), _TRACE_FILE))
+
+    # ---- учёт
+    @property
+    def depth(self) -> int:
+        return getattr(self._local, "depth", 0)
+
+    def enter(self) -> None:
+        self._local.depth = self.depth + 1
+
+    def leave(self) -> None:
+        self._local.depth = self.depth - 1
+
+    def record(self, sql: str, elapsed: float, rows: int, *, timed: bool = True) -> None:
+        key = normalize(sql)
+        source = self._current_origin()
+        caller = "/".join(part for part in source if part) or "-"
+        with self._lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = StatementStats(key)
+            entry.calls += 1
+            entry.total += elapsed
+            entry.rows += rows
+            if elapsed > entry.max:
+                entry.max = elapsed
+            entry.callers[caller] = entry.callers.get(caller, 0) + 1
+            if timed and elapsed >= self.slow_seconds:
+                entry.slow += 1
+                self._write_slow(sql, key, elapsed, rows, source)
+
+    def on_trace(self, sql: str) -> None:
+        # внутри execute() statement уже учитывается курсором; здесь — executescript и т.п.
+        if self.depth == 0 and sql.strip():
+            self.record(sql, 0.0, 0, timed=False)
+
+    def _write_slow(self, sql: str, key: str, elapsed: float, rows: int, source: Origin) -> None:
+        SLOW_QUERIES.inc()
+        event = {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "ms": round(elapsed * 1000, 2),
+            "rows": rows,
+            "handler": source.handler,
+            "site": source.site,
+            "sql": key,
+            "raw": sql if len(sql) <= 2000 else sql[:2000] + "…",
+        }
+        try:
+            if self._log is None:
+                self._log = open(self.log_path, "a", encoding="utf-8", buffering=1)
+            self._log.write(json.dumps(event, ensure_ascii=False) + "\n")
+        except OSError as err:
+            print(f"[SQLTRACE] Cannot write slow log {self.log_path}: {err}")
+
+    # ---- отчёты
+    def top(self, n: int = 10, order: str = "total") -> list[StatementStats]:
+        if order not in ORDERS:
+            raise ValueError(f"order must be one of {ORDERS}")
+        with self._lock:
+            entries = list(self.stats.values())
+        entries.sort(key=lambda entry: getattr(entry, order), reverse=True)
+        return entries[:n]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stats.clear()
+
+    def dump(self, n: int = 10, order: str = "total") -> None:
+        for line in format_table(self.top(n, order)):
+            print(f"[SQLTRACE] {line}")
+
+    def close(self) -> None:
+        with self._lock:
+            log, self._log = self._log, None
+        if log is not None:
+            log.close()
+
+
+tracer = Tracer()
+
+
+class TracedCursor(sqlite3.Cursor):
+    _sql: Optional[str] = None
+    _elapsed = 0.0
+    _rows = 0
+
+    def _finish(self) -> None:
+        sql, self._sql = self._sql, None
+        if sql is not None:
+            tracer.record(sql, self._elapsed, self._rows)
+
+    def _timed(self, method: Callable[..., Any], *args: Any) -> Any:
+        tracer.enter()
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+            tracer.leave()
+
+    def execute(self, sql: str, parameters: Any = ()) -> "TracedCursor":
+        self._finish()
+        self._sql, self._elapsed = sql, 0.0
+        self._timed(super().execute, sql, parameters)
+        self._rows = max(self.rowcount, 0)
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any]) -> "TracedCursor":
+        self._finish()
+        self._sql, self._elapsed = sql, 0.0
+        self._timed(super().executemany, sql, seq_of_parameters)
+        self._rows = max(self.rowcount, 0)
+        return self
+
+    def fetchone(self) -> Any:
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> list:
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self) -> list:
+        rows = self._timed(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self) -> Any:
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+    def close(self) -> None:
+        self._finish()
+        super().close()
+
+    def __del__(self) -> None:
+        # conn.execute(...).fetchone() и DML без fetch завершаются здесь
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(tracer.on_trace)
+
+    def cursor(self, factory: type = TracedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any]) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+async def handler_middleware(handler, event, data):
+    """aiogram inner middleware: remember which handler issues the queries."""
+    callback = getattr(data.get("handler"), "callback", None)
+    token = HANDLER.set(getattr(callback, "__name__", ""))
+    try:
+        return await handler(event, data)
+    finally:
+        HANDLER.reset(token)
+
+
+def format_table(entries: Iterable[StatementStats]) -> list[str]:
+    lines = []
+    for entry in entries:
+        lines.append(
+            f"calls={entry.calls} total={entry.total * 1000:.1f}ms avg={entry.avg * 1000:.2f}ms "
+            f"max={entry.max * 1000:.1f}ms rows={entry.rows} slow={entry.slow} "
+            f"by={entry.top_caller() or '-'} | {entry.sql}"
+        )
+    return lines
+
+
+def summarize_log(path: str) -> dict[str, StatementStats]:
+    """Aggregate a slow-query log file by normalised statement."""
+    stats: dict[str, StatementStats] = {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            key = event.get("sql") or normalize(event.get("raw", ""))
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = StatementStats(key)
+            elapsed = float(event.get("ms", 0)) / 1000
+            entry.calls += 1
+            entry.slow += 1
+            entry.total += elapsed
+            entry.max = max(entry.max, elapsed)
+            entry.rows += int(event.get("rows", 0))
+            caller = "/".join(part for part in (event.get("handler"), event.get("site")) if part) or "-"
+            entry.callers[caller] = entry.callers.get(caller, 0) + 1
+    return stats
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m utils.sql_trace", description="Top statements of a slow-query log.")
+    parser.add_argument("log", nargs="?", default=SLOW_LOG)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--order", choices=ORDERS, default="total")
+    args = parser.parse_args(argv[1:])
+    try:
+        stats = summarize_log(args.log)
+    except OSError as err:
+        print(f"[SQLTRACE] {err}")
+        return 1
+    entries = sorted(stats.values(), key=lambda entry: getattr(entry, args.order), reverse=True)[: args.top]
+    for line in format_table(entries):
+        print(line)
+    print(f"[SQLTRACE] {len(stats)} distinct slow statements in {args.log}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,314 @@
+"""Shared SQLite gateway.
+
+All modules talk to the database through one :class:`Storage` instance:
+
+* writes are serialised onto a single long-lived writer connection that lives
+  on its own thread and is fed through a queue, so the asyncio loop never
+  blocks on ``connect``/``commit``;
+* reads go to a small pool of read-only WAL connections running in worker
+  threads;
+* PRAGMAs are applied once per connection, when it is opened.
+
+Handlers use the awaitable :func:`execute` / :func:`fetch` helpers (or
+:func:`write` for multi-statement transactions).
+"""
+import asyncio
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+from utils import metrics, sql_trace
+
+DB = os.getenv("DB_PATH", "bot.sqlite3")
+READER_POOL_SIZE = int(os.getenv("DB_READERS", "3"))
+# сколько задач писатель максимум склеивает в одну транзакцию
+WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH", "64"))
+
+PRAGMAS = (
+    ("busy_timeout", int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))),
+    ("mmap_size", int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))),
+    # отрицательное значение — размер в KiB
+    ("cache_size", -int(os.getenv("DB_CACHE_SIZE_KB", "16384"))),
+    ("temp_store", "MEMORY"),
+    ("foreign_keys", "ON"),
+)
+
+
+WRITE_TX_SECONDS = metrics.histogram(
+    "sqlite_write_transaction_seconds", "Duration of one writer transaction (a batch of write jobs)."
+)
+WRITE_JOBS = metrics.counter("sqlite_write_jobs_total", "Write jobs executed by the writer thread.", ("outcome",))
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _apply_pragmas(conn: sqlite3.Connection) -> None:
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name}={value};")
+
+
+def connect(path: str = DB, *, readonly: bool = False, **kwargs: Any) -> sqlite3.Connection:
+    """Open a connection with the project-wide PRAGMAs applied."""
+    if sql_trace.ENABLED:
+        kwargs.setdefault("factory", sql_trace.TracedConnection)
+    if readonly:
+        uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, **kwargs)
+    else:
+        conn = sqlite3.connect(path, **kwargs)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+    _apply_pragmas(conn)
+    return conn
+
+
+class _WriteJob:
+    __slots__ = ("fn", "args", "future", "loop", "origin")
+
+    def __init__(
+        self,
+        fn: Callable[..., Any],
+        args: tuple,
+        future: asyncio.Future,
+        loop: asyncio.AbstractEventLoop,
+        origin: Optional[sql_trace.Origin] = None,
+    ):
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.loop = loop
+        self.origin = origin
+
+
+def _resolve(job: _WriteJob, result: Any = None, error: Optional[BaseException] = None) -> None:
+    def _set() -> None:
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    job.loop.call_soon_threadsafe(_set)
+
+
+class Storage:
+    def __init__(self, path: str = DB, readers: int = READER_POOL_SIZE):
+        self.path = path
+        self.readers = max(1, readers)
+        self._lock = threading.Lock()
+        self._queue: "queue.SimpleQueue[Optional[_WriteJob]]" = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._reader_local = threading.local()
+        self._reader_conns: list[sqlite3.Connection] = []
+
+    # ---- lifecycle
+    def start(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                ready = threading.Event()
+                failure: list[BaseException] = []
+                self._writer = threading.Thread(
+                    target=self._writer_loop, args=(ready, failure), name="sqlite-writer", daemon=True
+                )
+                self._writer.start()
+                # писатель создаёт файл и включает WAL до того, как откроются читатели
+                ready.wait()
+                if failure:
+                    # без писателя задачи записи ждали бы в очереди вечно
+                    self._writer.join()
+                    self._writer = None
+                    raise failure[0]
+            if self._reader_pool is None:
+                self._reader_pool = ThreadPoolExecutor(
+                    max_workers=self.readers,
+                    thread_name_prefix="sqlite-reader",
+                )
+
+    @property
+    def started(self) -> bool:
+        return self._writer is not None
+
+    async def close(self) -> None:
+        with self._lock:
+            writer, self._writer = self._writer, None
+            pool, self._reader_pool = self._reader_pool, None
+        if writer is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(writer.join)
+        if pool is not None:
+            await asyncio.to_thread(pool.shutdown, True)
+        for conn in self._reader_conns:
+            conn.close()
+        self._reader_conns.clear()
+        self._reader_local = threading.local()
+
+    # ---- writer
+    def _writer_loop(self, ready: threading.Event, failure: list[BaseException]) -> None:
+        try:
+            conn = connect(self.path, isolation_level=None, check_same_thread=False)
+        except BaseException as err:
+            failure.append(err)
+            return
+        finally:
+            ready.set()
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    break
+                batch = [job]
+                stop = False
+                while len(batch) < WRITE_BATCH_MAX:
+                    try:
+                        nxt = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt is None:
+                        stop = True
+                        break
+                    batch.append(nxt)
+                self._run_batch(conn, batch)
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _run_batch(conn: sqlite3.Connection, batch: list[_WriteJob]) -> None:
+        # Все задачи пачки идут одной транзакцией (один fsync), но каждая — в своём
+        # SAVEPOINT, чтобы ошибка одной не откатывала соседей.
+        outcomes: list[tuple[_WriteJob, Any, Optional[BaseException]]] = []
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for job in batch:
+                conn.execute("SAVEPOINT job;")
+                try:
+                    result = sql_trace.tracer.call(job.origin, job.fn, conn, *job.args)
+                except Exception as err:
+                    conn.execute("ROLLBACK TO job;")
+                    conn.execute("RELEASE job;")
+                    outcomes.append((job, None, err))
+                else:
+                    conn.execute("RELEASE job;")
+                    outcomes.append((job, result, None))
+            conn.execute("COMMIT;")
+        except Exception as err:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            WRITE_JOBS.inc(len(batch), outcome="rolled_back")
+            for job in batch:
+                _resolve(job, error=err)
+            return
+        WRITE_TX_SECONDS.observe(time.perf_counter() - started)
+        for job, result, error in outcomes:
+            WRITE_JOBS.inc(outcome="error" if error else "ok")
+            _resolve(job, result, error)
+
+    async def write(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run ``fn(conn, *args)`` on the writer connection inside a transaction."""
+        if self._writer is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put(_WriteJob(fn, args, future, loop, sql_trace.origin()))
+        return await future
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return await self.write(_execute, sql, tuple(params))
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        return await self.write(_executemany, sql, [tuple(p) for p in seq_of_params])
+
+    # ---- readers
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._reader_local, "conn", None)
+        if conn is None:
+            conn = connect(self.path, readonly=True, check_same_thread=False)
+            self._reader_local.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _run_read(self, fn: Callable[..., Any], args: tuple, origin: Optional[sql_trace.Origin]) -> Any:
+        return sql_trace.tracer.call(origin, fn, self._reader_conn(), *args)
+
+    async def read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run ``fn(conn, *args)`` on a pooled read-only connection."""
+        if self._reader_pool is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader_pool, self._run_read, fn, args, sql_trace.origin())
+
+    async def fetch(self, sql: str, params: Sequence[Any] = ()) -> list[tuple]:
+        return await self.read(_fetchall, sql, tuple(params))
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return await self.read(_fetchone, sql, tuple(params))
+
+
+def _execute(conn: sqlite3.Connection, sql: str, params: tuple) -> int:
+    return conn.execute(sql, params).rowcount
+
+
+def _executemany(conn: sqlite3.Connection, sql: str, seq_of_params: list[tuple]) -> int:
+    return conn.executemany(sql, seq_of_params).rowcount
+
+
+def _fetchall(conn: sqlite3.Connection, sql: str, params: tuple) -> list[tuple]:
+    return conn.execute(sql, params).fetchall()
+
+
+def _fetchone(conn: sqlite3.Connection, sql: str, params: tuple) -> Optional[tuple]:
+    return conn.execute(sql, params).fetchone()
+
+
+storage = Storage()
+
+metrics.gauge("sqlite_db_bytes", "Size of the main SQLite database file.", fn=lambda: _file_size(storage.path))
+metrics.gauge("sqlite_wal_bytes", "Size of the SQLite write-ahead log.", fn=lambda: _file_size(storage.path + "-wal"))
+metrics.gauge("sqlite_write_queue", "Write jobs waiting for the writer thread.", fn=lambda: storage._queue.qsize())
+
+
+async def execute(sql: str, params: Sequence[Any] = ()) -> int:
+    return await storage.execute(sql, params)
+
+
+async def executemany(sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+    return await storage.executemany(sql, seq_of_params)
+
+
+async def fetch(sql: str, params: Sequence[Any] = ()) -> list[tuple]:
+    return await storage.fetch(sql, params)
+
+
+async def fetchone(sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+    return await storage.fetchone(sql, params)
+
+
+async def write(fn: Callable[..., Any], *args: Any) -> Any:
+    return await storage.write(fn, *args)
+
+
+async def read(fn: Callable[..., Any], *args: Any) -> Any:
+    return await storage.read(fn, *args)
+
+
+def start() -> None:
+    storage.start()
+
+
+async def close() -> None:
+    await storage.close()
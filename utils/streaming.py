@@ -0,0 +1,142 @@
+"""Progressive Telegram replies for streamed LLM output.
+
+:class:`StreamingReply` sends a placeholder right away and then edits it as
+tokens arrive.  Edits are throttled to Telegram's rate limits and only ever
+show a *stable* prefix: text cut at a line break whose rendered HTML has all
+tags closed, so a half-written ``<a href=...`` never reaches the API.
+"""
+import asyncio
+import os
+import re
+import time
+from typing import AsyncIterator, Callable, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.5"))
+# не дёргаем правку ради пары новых символов
+MIN_EDIT_GROWTH = int(os.getenv("STREAM_MIN_EDIT_GROWTH", "40"))
+PLACEHOLDER = "…"
+TELEGRAM_TEXT_LIMIT = 4096
+
+_TAG_RE = re.compile(r"<\s*(/?)\s*([a-zA-Z0-9]+)[^>]*>")
+_VOID_TAGS = {"br"}
+
+
+def html_balanced(text: str) -> bool:
+    if text.count("<") != text.count(">"):
+        return False
+    stack: list[str] = []
+    for m in _TAG_RE.finditer(text):
+        closing, tag = m.group(1), m.group(2).lower()
+        if tag in _VOID_TAGS:
+            continue
+        if not closing:
+            stack.append(tag)
+        elif not stack or stack.pop() != tag:
+            return False
+    return not stack
+
+
+def _not_modified(err: TelegramBadRequest) -> bool:
+    return "message is not modified" in str(err)
+
+
+class StreamingReply:
+    def __init__(
+        self,
+        m: Message,
+        *,
+        render: Callable[[str], str],
+        placeholder: str = PLACEHOLDER,
+        interval: float = EDIT_INTERVAL_SEC,
+    ):
+        self.m = m
+        self.render = render
+        self.placeholder = placeholder
+        self.interval = interval
+        self.message: Optional[Message] = None
+        self.text = ""
+        self._shown = ""
+        self._next_edit_at = 0.0
+
+    async def begin(self) -> None:
+        """Send the placeholder now, e.g. before slow preparatory work."""
+        if self.message is None:
+            self.message = await self.m.reply(self.placeholder)
+            self._next_edit_at = time.monotonic() + self.interval
+
+    def _stable_render(self) -> Optional[str]:
+        cut = self.text.rfind("\n")
+        while cut > 0:
+            rendered = self.render(self.text[:cut])
+            if len(rendered) > TELEGRAM_TEXT_LIMIT:
+                return None
+            if html_balanced(rendered):
+                return rendered
+            cut = self.text.rfind("\n", 0, cut)
+        return None
+
+    async def _edit(self, html: str) -> bool:
+        try:
+            await self.message.edit_text(html, disable_web_page_preview=True)
+        except TelegramRetryAfter as err:
+            self._next_edit_at = time.monotonic() + err.retry_after
+            return False
+        except TelegramBadRequest as err:
+            if not _not_modified(err):
+                print(f"[STREAM] Partial edit rejected: {err}")
+            return False
+        self._shown = html
+        return True
+
+    async def _maybe_edit(self) -> None:
+        now = time.monotonic()
+        if now < self._next_edit_at:
+            return
+        rendered = self._stable_render()
+        if not rendered or len(rendered) - len(self._shown) < MIN_EDIT_GROWTH:
+            return
+        self._next_edit_at = now + self.interval
+        await self._edit(rendered)
+
+    async def run(self, chunks: AsyncIterator[str]) -> str:
+        """Consume ``chunks``, editing the reply along the way; return the raw full text."""
+        await self.begin()
+        async for chunk in chunks:
+            self.text += chunk
+            await self._maybe_edit()
+        await self.finish()
+        return self.text
+
+    async def finish(self) -> None:
+        final = self.render(self.text) if self.text.strip() else self.placeholder
+        if final == self._shown:
+            return
+        delay = self._next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            await self.message.edit_text(final, disable_web_page_preview=True)
+        except TelegramRetryAfter as err:
+            await asyncio.sleep(err.retry_after)
+            await self.message.edit_text(final, disable_web_page_preview=True)
+        except TelegramBadRequest as err:
+            if _not_modified(err):
+                return
+            # итоговый HTML не принят — показываем хотя бы текст как есть
+            print(f"[STREAM] Final edit rejected, falling back to plain text: {err}")
+            await self.message.edit_text(self.text[:TELEGRAM_TEXT_LIMIT], parse_mode=None)
+        self._shown = final
+
+    async def fail(self, text: str) -> Message:
+        """Replace the placeholder (or reply, if none was sent) with an error text."""
+        if self.message is None:
+            self.message = await self.m.reply(text)
+        else:
+            try:
+                await self.message.edit_text(text)
+            except TelegramBadRequest:
+                self.message = await self.m.reply(text)
+        return self.message
@@ -0,0 +1,120 @@
+"""Persisted per-chunk summaries for ``/lord_summary``.
+
+A chat's history is cut into consecutive chunks of ``SUMMARY_CHUNK_SIZE``
+messages.  Each full chunk is summarised once, stored in ``summary_chunks``
+and reused by every later report, so a report only sends the model the
+cached chunk notes plus the raw messages of the unfinished tail.  Missing
+chunks are summarised in parallel, at most ``SUMMARY_CHUNK_CONCURRENCY`` at
+a time.
+"""
+import asyncio
+import os
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, NamedTuple, Optional, Sequence
+
+from utils import storage
+
+CHUNK_SIZE = int(os.getenv("SUMMARY_CHUNK_SIZE", "100"))
+CONCURRENCY = int(os.getenv("SUMMARY_CHUNK_CONCURRENCY", "3"))
+
+# (id, user_id, username, text, message_id) — строки messages в порядке id
+Row = tuple[int, int, Optional[str], str, Optional[int]]
+
+
+class Chunk(NamedTuple):
+    start_id: int
+    end_id: int
+    summary: str
+
+
+def _now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+async def chunk_start_covering(chat_id: int, message_id: int) -> Optional[int]:
+    """Start of a stored chunk that contains ``messages.id = message_id``, if any."""
+    row = await storage.fetchone(
+        "SELECT start_id FROM summary_chunks WHERE chat_id=? AND start_id<=? AND end_id>=? "
+        "ORDER BY start_id DESC LIMIT 1;",
+        (chat_id, message_id, message_id),
+    )
+    return row[0] if row else None
+
+
+async def load_chunks(chat_id: int, from_id: int) -> dict[int, Chunk]:
+    rows = await storage.fetch(
+        "SELECT start_id, end_id, summary FROM summary_chunks WHERE chat_id=? AND start_id>=?;",
+        (chat_id, from_id),
+    )
+    return {start: Chunk(start, end, summary) for start, end, summary in rows}
+
+
+async def save_chunk(chat_id: int, rows: Sequence[Row], summary: str) -> Chunk:
+    chunk = Chunk(rows[0][0], rows[-1][0], summary)
+    await storage.execute(
+        "INSERT INTO summary_chunks(chat_id, start_id, end_id, msg_count, summary, created_at) "
+        "VALUES(?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(chat_id, start_id) DO UPDATE SET end_id=excluded.end_id, "
+        "msg_count=excluded.msg_count, summary=excluded.summary, created_at=excluded.created_at;",
+        (chat_id, chunk.start_id, chunk.end_id, len(rows), summary, _now_ts()),
+    )
+    return chunk
+
+
+def plan(rows: Sequence[Row], chunks: dict[int, Chunk], size: int = CHUNK_SIZE) -> tuple[list, list[Row]]:
+    """Split ``rows`` into segments and a raw tail.
+
+    Segments are, in order, either a stored :class:`Chunk` or a list of rows:
+    a full list (``size`` rows) still has to be summarised, a shorter one sits
+    between stored chunks and is passed to the model as is.
+    """
+    segments: list = []
+    pending: list[Row] = []
+    last_id = rows[-1][0] if rows else 0
+    i = 0
+    while i < len(rows):
+        chunk = chunks.get(rows[i][0])
+        if chunk is not None and chunk.end_id <= last_id:
+            if pending:
+                segments.append(pending)
+                pending = []
+            segments.append(chunk)
+            while i < len(rows) and rows[i][0] <= chunk.end_id:
+                i += 1
+            continue
+        pending.append(rows[i])
+        if len(pending) == size:
+            segments.append(pending)
+            pending = []
+        i += 1
+    return segments, pending
+
+
+async def summarize(
+    chat_id: int,
+    rows: Sequence[Row],
+    summarize_chunk: Callable[[Sequence[Row]], Awaitable[str]],
+    *,
+    size: int = CHUNK_SIZE,
+    concurrency: int = CONCURRENCY,
+) -> tuple[list, list[Row]]:
+    """Return ``(parts, tail)``: chunk notes or short raw runs in order, plus the raw tail.
+
+    Full chunks without a stored summary are summarised with
+    ``summarize_chunk`` and persisted before returning.
+    """
+    if not rows:
+        return [], []
+    chunks = await load_chunks(chat_id, rows[0][0])
+    segments, tail = plan(rows, chunks, size)
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def build(segment: list[Row]) -> Chunk:
+        async with sem:
+            summary = (await summarize_chunk(segment)).strip()
+        return await save_chunk(chat_id, segment, summary)
+
+    todo = [seg for seg in segments if isinstance(seg, list) and len(seg) == size]
+    built = dict(zip(map(id, todo), await asyncio.gather(*(build(seg) for seg in todo))))
+    parts = [built.get(id(seg), seg) for seg in segments]
+    return parts, tail